@@ -0,0 +1,508 @@
+#!/usr/bin/env python
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+"""End to end benchmarks of the job loop, printer sync and XMPP.
+
+The real process_jobs_once and sync_printers run against the fake cloud
+print service in cloudprint.fakecloud, the fake XMPP server in
+cloudprint.fakexmpp and a CUPS that throws every job away. Each scenario
+runs in a process of its own so peak RSS means something, and the results
+can be saved as baselines and compared against later:
+
+    python benchmarks/run.py --save      # record baselines.json
+    python benchmarks/run.py             # compare against it
+
+Baselines only mean something on the machine that recorded them, so
+differences are reported but only fail the run with --strict.
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__
+))))
+
+import cups  # noqa: E402
+
+from cloudprint import cloudprint  # noqa: E402
+from cloudprint import fakecloud  # noqa: E402
+from cloudprint import fakexmpp  # noqa: E402
+from cloudprint import journal  # noqa: E402
+from cloudprint import retry  # noqa: E402
+from cloudprint import xmpp  # noqa: E402
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'baselines.json')
+
+# how much worse than its baseline a result may be before it is flagged
+TOLERANCE = 0.25
+
+# jobs fed one at a time, and how many a second, to time each job from
+# being queued to being acknowledged without a backlog in front of it
+LATENCY_JOBS = 50
+LATENCY_RATE = 20.0
+
+SCENARIOS = {
+    'jobs-inline': dict(
+        kind='jobs',
+        printers=1, jobs=200, size=64 * 1024, latency=0.002, workers=0,
+    ),
+    'jobs-workers': dict(
+        kind='jobs',
+        printers=8, jobs=400, size=64 * 1024, latency=0.002, workers=8,
+    ),
+    'jobs-stream': dict(
+        kind='jobs',
+        printers=8, jobs=400, size=1024 * 1024, latency=0.002, workers=8,
+        stream=True,
+    ),
+    'jobs-slow-link': dict(
+        kind='jobs',
+        printers=4, jobs=80, size=256 * 1024, latency=0.02, workers=8,
+        bandwidth=8 * 1024 * 1024,
+    ),
+    'jobs-errors': dict(
+        kind='jobs',
+        printers=4, jobs=200, size=16 * 1024, latency=0.002, workers=4,
+        error_rate=0.05, error_endpoints=['download'],
+    ),
+    'sync': dict(kind='sync', printers=200, latency=0.002),
+    'xmpp-push': dict(kind='push', pushes=200, rate=50, latency=0.002),
+    'xmpp-reconnect': dict(kind='reconnect', drops=20),
+    'xmpp-keepalive': dict(kind='keepalive', period=0.1, duration=2.0),
+    'journal': dict(kind='journal', jobs=2000),
+}
+
+# metric name: True if bigger is better
+METRICS = {
+    'jobs_per_second': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'sync_ms': False,
+    'resync_ms': False,
+    'notify_p50_ms': False,
+    'notify_p99_ms': False,
+    'connect_ms': False,
+    'reconnect_p50_ms': False,
+    'reconnect_p99_ms': False,
+    'keepalive_drift_ms': False,
+    'journal_job_us': False,
+    'peak_rss_kb': False,
+}
+
+
+class NullCups(object):
+    """A CUPS connection that accepts every job and throws it away"""
+
+    def __init__(self, printers=()):
+        self.printers = dict(
+            (name, {'printer-info': name, 'printer-state-change-time': 1})
+            for name in printers
+        )
+        self._job_id = 0
+        # when each job, by title, reached CUPS
+        self.started = {}
+
+    def getPrinters(self):
+        return self.printers
+
+    def getPrinterAttributes(self, name):
+        return self.printers[name]
+
+    def getPPD(self, name):
+        fd, path = tempfile.mkstemp(suffix='.ppd')
+        with os.fdopen(fd, 'w') as ppd:
+            ppd.write('*PPD-Adobe: "4.3"\n*NickName: "%s"\n' % name)
+        return path
+
+    def _next_id(self):
+        self._job_id += 1
+        return self._job_id
+
+    def printFile(self, printer, path, title, options):
+        self.started[title] = time.time()
+        with open(path, 'rb') as document:
+            while document.read(64 * 1024):
+                pass
+        return self._next_id()
+
+    def createJob(self, printer, title, options):
+        self.started[title] = time.time()
+        return self._next_id()
+
+    def startDocument(self, printer, job_id, title, format, last):
+        return cups.HTTP_CONTINUE
+
+    def writeRequestData(self, data, length):
+        return cups.HTTP_CONTINUE
+
+    def finishDocument(self, printer):
+        return cups.IPP_OK
+
+    def cancelJob(self, job_id):
+        pass
+
+
+class NullXmpp(object):
+    """An XMPP connection that never has anything to say"""
+
+    def is_connected(self):
+        return True
+
+    def await_notification(self, timeout, wakeup=()):
+        time.sleep(min(timeout or 0, 0.01))
+        return False
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def new_proxy(tmpdir):
+    auth = cloudprint.CloudPrintAuth(os.path.join(tmpdir, 'auth.json'))
+    fakecloud.authorize(auth)
+    cpp = cloudprint.CloudPrintProxy(auth)
+    cpp.sleeptime = 0
+    return cpp
+
+
+def drain(cloud, cpp, cups_connection, job_executor, job_ids, feeding=None):
+    """Run the job loop until every job in job_ids, which feeding may still
+    be adding to, has been acknowledged"""
+    xmpp_conn = NullXmpp()
+    while (feeding is not None and feeding.is_alive()) or \
+            not cloud.wait_for_jobs(list(job_ids), 0):
+        cloudprint.process_jobs_once(
+            cups_connection, cpp, xmpp_conn, job_executor
+        )
+        if job_executor is not None:
+            job_executor.join()
+
+
+def run_jobs(cloud, cpp, printers, jobs, size, workers=0, stream=False,
+             latency_jobs=LATENCY_JOBS, rate=LATENCY_RATE):
+    """Throughput from a backlog of jobs, then the latency of jobs queued
+    at a steady rate, well below it"""
+    cpp.stream_jobs = stream
+    cpp.retries = retry.RetryScheduler(retries=3, delay=0.01)
+    cups_connection = NullCups()
+    printer_ids = [
+        cloud.add_printer('printer-%d' % i) for i in range(printers)
+    ]
+    cpp.registry.refresh()
+
+    job_executor = None
+    if workers:
+        job_executor = cloudprint.executor.JobExecutor(
+            cloudprint.process_job,
+            workers=workers,
+            connection_factory=NullCups,
+        )
+
+    job_ids = []
+    for i in range(jobs):
+        job_ids.extend(cloud.add_jobs(printer_ids[i % printers], 1, size))
+
+    start = time.time()
+    drain(cloud, cpp, cups_connection, job_executor, job_ids)
+    elapsed = time.time() - start
+
+    # a backlog's latencies are mostly time spent queued behind it
+    fed = []
+
+    def feed():
+        for i in range(latency_jobs):
+            fed.extend(cloud.add_jobs(printer_ids[i % printers], 1, size))
+            time.sleep(1.0 / rate)
+
+    feeding = threading.Thread(target=feed, name='feed')
+    feeding.start()
+    drain(cloud, cpp, cups_connection, job_executor, fed, feeding)
+
+    if job_executor is not None:
+        job_executor.stop()
+
+    latencies = cloud.job_latencies(fed)
+    return {
+        'jobs_per_second': round(jobs / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.5) * 1000, 1),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1),
+    }
+
+
+def run_sync(cloud, cpp, printers):
+    cups_connection = NullCups('printer-%d' % i for i in range(printers))
+
+    start = time.time()
+    cloudprint.sync_printers(cups_connection, cpp)
+    sync = time.time() - start
+
+    start = time.time()
+    cloudprint.sync_printers(cups_connection, cpp)
+    resync = time.time() - start
+
+    return {
+        'sync_ms': round(sync * 1000, 1),
+        'resync_ms': round(resync * 1000, 1),
+    }
+
+
+def run_journal(cloud, cpp, jobs):
+    """The journal writes one job goes through, on a file in a temporary
+    directory"""
+    job_journal = journal.JobJournal(os.path.join(
+        tempfile.mkdtemp(), 'journal.sqlite'
+    ))
+
+    start = time.time()
+    for i in range(jobs):
+        job_id = 'job_%d' % i
+        job_journal.fetched(job_id, 'printer')
+        job_journal.submitted(job_id, i)
+        job_journal.acknowledged(job_id)
+    elapsed = time.time() - start
+
+    return {'journal_job_us': round(elapsed / jobs * 1000000, 1)}
+
+
+def job_loop(cups_connection, cpp, xmpp_conn):
+    """Run the job loop on a daemon thread, which ends with the process"""
+    def run():
+        printer_ids = None
+        while True:
+            printer_ids = cloudprint.process_jobs_once(
+                cups_connection, cpp, xmpp_conn, None, printer_ids
+            )
+
+    thread = threading.Thread(target=run, name='job-loop')
+    thread.daemon = True
+    thread.start()
+
+
+def xmpp_server():
+    # left running until the process ends, or the job loop would log its
+    # going away
+    server = fakexmpp.FakeXmppServer().start()
+    cloudprint.XMPP_SERVER_HOST, cloudprint.XMPP_SERVER_PORT = server.address
+    return server
+
+
+def run_push(cloud, cpp, pushes, rate):
+    """Time from a push notification going out to its job reaching CUPS"""
+    cups_connection = NullCups()
+    printer_id = cloud.add_printer('printer')
+    cpp.registry.refresh()
+    # notifications only, no polling
+    cpp.sleeptime = None
+
+    server = xmpp_server()
+    job_loop(cups_connection, cpp, xmpp.XmppConnection())
+    server.wait_for_subscribers(1, 10)
+
+    sent = {}
+    for _ in range(pushes):
+        job_id, = cloud.add_jobs(printer_id, 1, 1024)
+        sent[job_id] = server.push(printer_id)
+        time.sleep(1.0 / rate)
+    cloud.wait_for_jobs(list(sent), 30)
+
+    latencies = []
+    for job in cloud.jobs.values():
+        title = cloudprint.job_title(job.as_json(cloud.url))
+        latencies.append(cups_connection.started[title] - sent[job.id])
+    return {
+        'notify_p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+        'notify_p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run_reconnect(cloud, cpp, drops):
+    """Time from the server dropping the connection to the proxy being
+    subscribed again. FAIL_RETRY is taken out, so this is the cost of
+    noticing and of the handshake."""
+    cloudprint.FAIL_RETRY = 0
+    # every drop is logged with a traceback
+    cloudprint.LOGGER.disabled = True
+    cpp.sleeptime = None
+
+    server = xmpp_server()
+    start = time.time()
+    job_loop(NullCups(), cpp, xmpp.XmppConnection())
+    server.wait_for_subscribers(1, 10)
+    connect = time.time() - start
+
+    times = []
+    for i in range(drops):
+        start = time.time()
+        server.drop_connections()
+        while server.subscriptions < i + 2:
+            time.sleep(0.0005)
+        times.append(time.time() - start)
+
+    return {
+        'connect_ms': round(connect * 1000, 2),
+        'reconnect_p50_ms': round(percentile(times, 0.5) * 1000, 2),
+        'reconnect_p99_ms': round(percentile(times, 0.99) * 1000, 2),
+    }
+
+
+def run_keepalive(cloud, cpp, period, duration):
+    """How far the gaps between keepalives stray from the period asked
+    for, on an idle connection"""
+    cpp.sleeptime = None
+    server = xmpp_server()
+    job_loop(NullCups(), cpp, xmpp.XmppConnection(keepalive_period=period))
+    server.wait_for_subscribers(1, 10)
+    time.sleep(duration)
+
+    client, = server.clients()
+    times = client.keepalive_times
+    gaps = [b - a for a, b in zip(times, times[1:])]
+    drift = sum(abs(gap - period) for gap in gaps) / max(len(gaps), 1)
+    return {'keepalive_drift_ms': round(drift * 1000, 2)}
+
+
+RUNNERS = {
+    'jobs': run_jobs,
+    'sync': run_sync,
+    'push': run_push,
+    'reconnect': run_reconnect,
+    'keepalive': run_keepalive,
+    'journal': run_journal,
+}
+
+
+def run_scenario(name):
+    settings = dict(SCENARIOS[name])
+    runner = RUNNERS[settings.pop('kind')]
+    cloud = fakecloud.FakeCloudPrint(
+        latency=settings.pop('latency', 0.0),
+        bandwidth=settings.pop('bandwidth', None),
+        error_rate=settings.pop('error_rate', 0.0),
+        error_endpoints=settings.pop('error_endpoints', None),
+        seed=1,
+    )
+    tmpdir = tempfile.mkdtemp()
+    with cloud:
+        cloudprint.PRINT_CLOUD_URL = cloud.url
+        cpp = new_proxy(tmpdir)
+        result = runner(cloud, cpp, **settings)
+
+    result['peak_rss_kb'] = resource.getrusage(
+        resource.RUSAGE_SELF
+    ).ru_maxrss
+    return result
+
+
+def compare(name, result, baseline, tolerance):
+    """Print result against baseline. Returns the regressed metrics."""
+    regressed = []
+    for metric, value in sorted(result.items()):
+        line = '  {0:16} {1:>10}'.format(metric, value)
+        old = baseline.get(metric)
+        if old:
+            change = (value - old) / float(old)
+            worse = -change if METRICS[metric] else change
+            line += '  {0:+.0%} vs {1}'.format(change, old)
+            if worse > tolerance:
+                line += '  REGRESSION'
+                regressed.append(metric)
+        print(line)
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument(
+        'scenarios',
+        nargs='*',
+        help='scenarios to run (default all: %s)' % ', '.join(
+            sorted(SCENARIOS)
+        ),
+    )
+    parser.add_argument(
+        '--save',
+        action='store_true',
+        help='store the results as the new baselines',
+    )
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=TOLERANCE,
+        help='how much worse than baseline counts as a regression '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--strict',
+        action='store_true',
+        help='exit non-zero on a regression',
+    )
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # sync_printers chats on stdout; the result is the last line
+        print(json.dumps(run_scenario(args.child)))
+        return
+
+    names = args.scenarios or sorted(SCENARIOS)
+    unknown = set(names) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenario ' + ', '.join(sorted(unknown)))
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+
+    results = {}
+    regressions = []
+    for name in names:
+        output = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), '--child', name]
+        )
+        result = json.loads(output.decode('utf-8').strip().split('\n')[-1])
+        results[name] = result
+        print(name)
+        regressed = compare(
+            name, result, baselines.get(name, {}), args.tolerance
+        )
+        regressions.extend((name, metric) for metric in regressed)
+
+    if args.save:
+        baselines.update(results)
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('saved ' + BASELINES)
+    elif regressions and args.strict:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+from __future__ import absolute_import
+
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+try:
+    from cloudprint import journal
+    from cloudprint import metrics
+    from cloudprint import retry
+except Exception:
+    import journal
+    import metrics
+    import retry
+
+LOGGER = logging.getLogger('cloudprint.ack')
+
+# job statuses reported through the control API; only DONE and ERROR end a
+# job
+IN_PROGRESS = 'IN_PROGRESS'
+DONE = 'DONE'
+ERROR = 'ERROR'
+
+# threads sending acknowledgements for each account
+ACK_THREADS = 2
+
+# backoff, in seconds, before an acknowledgement that failed is sent again;
+# it doubles with every further failure up to ACK_RETRY_MAX_DELAY
+ACK_RETRY_DELAY = 5.0
+ACK_RETRY_MAX_DELAY = 300.0
+
+
+def acknowledge(cpp, job_id, status, printer_name=None):
+    """Tell the cloud job_id ended as status, DONE or ERROR, and record that
+    in the journal, or that it is IN_PROGRESS. Raises if the cloud couldn't
+    be told."""
+    start = time.time()
+    if status == IN_PROGRESS:
+        cpp.progress_job(job_id)
+        cpp.tracer.span(job_id, 'progress', start)
+        return
+    if status == DONE:
+        cpp.finish_job(job_id)
+    else:
+        cpp.fail_job(job_id)
+    end = time.time()
+    cpp.journal.acknowledged(job_id)
+    if cpp.leases is not None:
+        # renewed until the cloud knows, however long a queued
+        # acknowledgement takes to get through
+        cpp.leases.done(job_id)
+    if printer_name is not None:
+        metrics.CONTROL_SECONDS.labels(printer_name).observe(end - start)
+    cpp.tracer.span(job_id, 'control', start, end, status=status)
+    cpp.tracer.finish(job_id, status.lower())
+
+
+def report(cpp, job_id, status, printer_name=None):
+    """Acknowledge a job through cpp.acks if there is one, otherwise
+    straight away. The caller records the job as SUBMITTED or FAILED in the
+    journal first, so a queued acknowledgement outlives a restart."""
+    if cpp.acks is not None:
+        cpp.acks.queue(job_id, status, printer_name)
+    else:
+        acknowledge(cpp, job_id, status, printer_name)
+
+
+def status_for(state):
+    """The status to acknowledge a job with, from its journal state"""
+    return ERROR if state == journal.FAILED else DONE
+
+
+class Acknowledger(object):
+    """Sends acknowledgements from background threads, so a worker moves on
+    to its next job instead of waiting on the control round trip.
+
+    Acknowledgements queued for the same job before it is sent are merged
+    into one. The control API takes a single job per call, so a burst of
+    finished jobs goes out as back to back requests on the kept-alive
+    connections, spread over the threads. One that fails is queued again
+    after a backoff, as often as it takes; until it gets through the
+    journal keeps the job as SUBMITTED or FAILED, and acknowledge_submitted
+    queues it again after a restart."""
+
+    def __init__(self, cpp, threads=ACK_THREADS, delay=ACK_RETRY_DELAY,
+                 max_delay=ACK_RETRY_MAX_DELAY):
+        self.cpp = cpp
+        self.threads = threads
+        self._backoff = retry.RetryScheduler(delay=delay, max_delay=max_delay)
+
+        self._cond = threading.Condition()
+        # job id -> [status, printer name, failed attempts, due]
+        self._pending = OrderedDict()
+        # job id -> status, of those being sent
+        self._sending = {}
+        self._stopping = False
+        self._threads = []
+
+    def queue(self, job_id, status, printer_name=None):
+        """Acknowledge job_id as status in the background"""
+        with self._cond:
+            if (status == IN_PROGRESS and
+                    self._sending.get(job_id) in (DONE, ERROR)):
+                return
+            entry = self._pending.get(job_id)
+            if entry is not None:
+                # not sent yet; the latest status is the one that counts,
+                # except that a job that has ended stays ended
+                if status != IN_PROGRESS:
+                    entry[0] = status
+                return
+            self._pending[job_id] = [status, printer_name, 0, 0]
+            self._cond.notify()
+
+    def pending(self):
+        """Number of acknowledgements queued or being sent"""
+        with self._cond:
+            return len(self._pending) + len(self._sending)
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopping = False
+        for i in range(self.threads):
+            thread = threading.Thread(
+                target=self._work,
+                name='cloudprint-ack-%d' % i,
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def join(self, timeout=None):
+        """Wait until every queued acknowledgement has been sent"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while self._pending or self._sending:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self, wait=True):
+        """Send what is due, then shut the threads down. Acknowledgements
+        still waiting for a retry are left to the journal."""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def _next(self, now):
+        """The first acknowledgement that is due, and the seconds until the
+        next one is if none is"""
+        wait = None
+        for job_id, entry in self._pending.items():
+            if job_id in self._sending:
+                continue
+            if entry[3] <= now:
+                del self._pending[job_id]
+                return (job_id, entry), None
+            if wait is None or entry[3] - now < wait:
+                wait = entry[3] - now
+        return None, wait
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    item, wait = self._next(time.time())
+                    if item is not None:
+                        break
+                    if self._stopping:
+                        return
+                    self._cond.wait(wait)
+                job_id, entry = item
+                self._sending[job_id] = entry[0]
+
+            status, printer_name, attempts, _ = entry
+            try:
+                acknowledge(self.cpp, job_id, status, printer_name)
+                sent = True
+            except Exception:
+                LOGGER.warning(
+                    'Could not acknowledge job %s as %s, will retry',
+                    job_id, status, exc_info=True,
+                )
+                sent = False
+
+            with self._cond:
+                self._sending.pop(job_id, None)
+                if not sent and job_id not in self._pending:
+                    attempts += 1
+                    due = time.time() + self._backoff.backoff(attempts)
+                    self._pending[job_id] = [
+                        status, printer_name, attempts, due
+                    ]
+                self._cond.notify_all()
@@ -0,0 +1,634 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+"""The --async runtime.
+
+XMPP notifications and keepalives, polling and the Cloud Print API calls of
+every job in flight share one asyncio event loop. Only the blocking pycups
+calls leave it, for a small thread pool. Requires aiohttp."""
+
+from __future__ import absolute_import
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import os
+import ssl
+import tempfile
+import time
+
+from xml.etree.ElementTree import XMLParser
+
+import aiohttp
+import cups
+
+from cloudprint import ack
+from cloudprint import cloudprint
+from cloudprint import cupspool
+from cloudprint import journal
+from cloudprint import metrics
+from cloudprint import xmpp
+
+LOGGER = logging.getLogger('cloudprint.aio')
+
+# most jobs in flight at once when -w isn't given
+MAX_JOBS = 32
+
+# threads, and so CUPS connections, used for the blocking CUPS calls
+CUPS_THREADS = 4
+
+# bytes read from the XMPP stream at a time
+RECV_SIZE = 16384
+
+
+class AsyncXmppConnection(xmpp.XmppNotifications):
+    """The asyncio twin of xmpp.XmppConnection"""
+
+    def __init__(self, keepalive_period=60.0, ssl_context=None):
+        xmpp.XmppNotifications.__init__(self)
+        self._keepalive_period = keepalive_period
+        self._ssl_context = ssl_context
+        self._connected = False
+        self._connections = 0
+        self._reader = None
+        self._writer = None
+        self._nextkeepalive = 0
+
+    def _touch(self):
+        loop = asyncio.get_event_loop()
+        self._nextkeepalive = loop.time() + self._keepalive_period
+
+    async def _write(self, msg):
+        LOGGER.debug('>>> %s', msg)
+        self._touch()
+        self._writer.write(msg.encode('utf-8'))
+        await self._writer.drain()
+
+    async def _read(self, timeout=None):
+        data = await asyncio.wait_for(self._reader.read(RECV_SIZE), timeout)
+        if not data:
+            raise Exception("xmpp socket closed")
+        self._touch()
+        LOGGER.debug('<<< %r', data)
+        self._xmlparser.feed(data)
+
+    async def _msg(self, msg=None):
+        """send a message to the XMPP server, and wait for a response
+        returns the XML element tree of the response"""
+        if msg is not None:
+            await self._write(msg)
+
+        while True:
+            elem = self._handler.get_elem()
+            if elem is not None:
+                return elem
+            await self._read()
+
+    async def connect(self, host, port, auth):
+        """Establish a new connection to the XMPP server"""
+        self.close()
+
+        LOGGER.info("Establishing connection to xmpp server %s:%i" %
+                    (host, port))
+        ssl_context = self._ssl_context
+        if ssl_context is None:
+            ssl_context = ssl.create_default_context()
+
+        try:
+            self._reader, self._writer = await asyncio.open_connection(
+                host, port, ssl=ssl_context,
+            )
+            self._handler = xmpp.XmppXmlHandler()
+            self._xmlparser = XMLParser(target=self._handler)
+
+            await self._msg(xmpp.STREAM_OPEN)
+            await self._msg(xmpp.auth_message(auth))
+            await self._msg(xmpp.STREAM_OPEN)
+            bare_jid = xmpp.bound_jid(await self._msg(xmpp.BIND))
+            await self._msg(xmpp.SESSION)
+            await self._msg(xmpp.SUBSCRIBE % bare_jid)
+        except Exception:
+            self.close()
+            raise
+
+        LOGGER.info("xmpp connection established")
+        self._connected = True
+        self._connections += 1
+        if self._connections > 1:
+            metrics.XMPP_RECONNECTS.inc()
+
+    def close(self):
+        """Close the connection to the XMPP server"""
+        if self._writer is not None:
+            try:
+                self._writer.close()
+            except Exception:
+                LOGGER.debug("Error encountered closing XMPP socket")
+        self._reader = None
+        self._writer = None
+        self._connected = False
+
+    def is_connected(self):
+        return self._connected
+
+    async def await_notification(self, timeout):
+        """wait for a timeout or event notification, sending keepalives
+        while we wait"""
+        loop = asyncio.get_event_loop()
+        timeoutend = None
+        if timeout is not None:
+            timeoutend = loop.time() + timeout
+
+        try:
+            while True:
+                if self._check_for_notification():
+                    return True
+
+                now = loop.time()
+                if timeoutend is not None and timeoutend <= now:
+                    return False
+
+                waittime = self._nextkeepalive - now
+                if timeoutend is not None:
+                    waittime = min(waittime, timeoutend - now)
+
+                try:
+                    await self._read(max(waittime, 0))
+                except asyncio.TimeoutError:
+                    pass
+
+                if self._nextkeepalive <= loop.time():
+                    LOGGER.info("Sending XMPP keepalive")
+                    await self._write(" ")
+        except Exception:
+            self.close()
+            raise
+
+
+class AsyncCloudPrintProxy(object):
+    """Non-blocking versions of the CloudPrintProxy API calls. Auth, site
+    prefix and registry are those of the wrapped CloudPrintProxy."""
+
+    def __init__(self, cpp, session):
+        self.cpp = cpp
+        self.session = session
+
+    def headers(self):
+        return {
+            'X-CloudPrint-Proxy': 'ArmoooIsAnOEM',
+            'Authorization': 'Bearer {0}'.format(self.cpp.auth.access_token),
+        }
+
+    async def _post(self, action, data):
+        data = dict(data, output='json')
+        async with self.session.post(
+            cloudprint.PRINT_CLOUD_URL + action,
+            data=data,
+            headers=self.headers(),
+        ) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+
+    async def get_printers(self):
+        printers = await self._post('list', {'proxy': self.cpp.auth.guid})
+        return self.cpp.printers_from_list(printers)
+
+    async def get_jobs(self, printer_id):
+        docs = await self._post('fetch', {'printerid': printer_id})
+        return self.cpp.jobs_from_fetch(docs)
+
+    async def get_job_options(self, ticket_url):
+        async with self.session.get(
+            ticket_url,
+            headers=self.headers(),
+        ) as response:
+            response.raise_for_status()
+            return cloudprint.ticket_options(
+                await response.json(content_type=None)
+            )
+
+    async def finish_job(self, job_id):
+        await self._post('control', {'jobid': job_id, 'status': 'DONE'})
+        LOGGER.debug('Finished Job' + job_id)
+
+    async def fail_job(self, job_id):
+        await self._post('control', {'jobid': job_id, 'status': 'ERROR'})
+        LOGGER.debug('Failed Job' + job_id)
+
+
+class AsyncRunner(object):
+    """Listen for notifications, poll, and run up to max_jobs jobs at once
+    (per_printer of them on any one printer, in FIFO order) on the current
+    event loop."""
+
+    def __init__(self, cpp, max_jobs=MAX_JOBS, per_printer=1,
+                 cups_threads=CUPS_THREADS,
+                 connection_factory=cupspool.ReconnectingConnection):
+        self.cpp = cpp
+        self.max_jobs = max_jobs
+        self.per_printer = per_printer
+        self.cups_threads = cups_threads
+        self.connection_factory = connection_factory
+
+        self.api = None
+        self.xmpp_conn = AsyncXmppConnection(
+            keepalive_period=cloudprint.KEEPALIVE
+        )
+        self._cups = concurrent.futures.ThreadPoolExecutor(cups_threads)
+        self._connections = []
+        self._connection_count = 0
+        self._connection_freed = None
+        self._job_slots = None
+        self._printer_slots = {}
+        self._tasks = set()
+        # when the pending check on printers with expiring leases runs
+        self._refetch_at = None
+        # set when a retry is scheduled
+        self._retry_wakeup = None
+
+    async def run(self):
+        self._job_slots = asyncio.Semaphore(self.max_jobs)
+        self._connection_freed = asyncio.Condition()
+        self._retry_wakeup = asyncio.Event()
+        connector = aiohttp.TCPConnector(limit=self.cpp.auth.pool_size)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            self.api = AsyncCloudPrintProxy(self.cpp, session)
+            await asyncio.gather(
+                self._listen(), self._poll(), self._retries()
+            )
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def _call(self, func, *args):
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self._cups, functools.partial(func, *args))
+
+    async def _listen(self):
+        connected_before = False
+        while True:
+            try:
+                if not self.xmpp_conn.is_connected():
+                    await self.xmpp_conn.connect(
+                        cloudprint.XMPP_SERVER_HOST,
+                        cloudprint.XMPP_SERVER_PORT,
+                        self.cpp.auth,
+                    )
+                    if connected_before:
+                        # notifications sent while we were away are lost
+                        self._spawn(self.check_printers(None))
+                    connected_before = True
+
+                if await self.xmpp_conn.await_notification(None):
+                    printer_ids = self.xmpp_conn.pop_notified_printers()
+                    self.cpp.tracer.notified(printer_ids)
+                    self._spawn(self.check_printers(printer_ids))
+            except Exception:
+                LOGGER.exception(
+                    'ERROR: Could not Connect to XMPP. '
+                    'Will Try again in %d Seconds' %
+                    cloudprint.FAIL_RETRY
+                )
+                await asyncio.sleep(cloudprint.FAIL_RETRY)
+
+    async def _poll(self):
+        while True:
+            await self.check_printers(None)
+            if self.cpp.sleeptime is None:
+                return
+            await asyncio.sleep(self.cpp.sleeptime)
+
+    async def _printers(self, printer_ids):
+        registry = self.cpp.registry
+        if registry.is_stale():
+            registry.update(await self.api.get_printers())
+
+        if printer_ids is not None:
+            printers = [registry.get(p, refresh=False) for p in printer_ids]
+            if None not in printers:
+                return printers
+            LOGGER.debug('Notified about an unknown printer, checking all')
+            registry.update(await self.api.get_printers())
+        return registry.printers()
+
+    async def _fetch(self, printer):
+        start = time.time()
+        jobs = await self.api.get_jobs(printer.id)
+        return jobs, self.cpp.tracer.fetched(printer.id, start)
+
+    async def check_printers(self, printer_ids):
+        """Fetch the jobs of printer_ids, or of every printer if it is None,
+        and start them"""
+        try:
+            printers = await self._printers(printer_ids)
+            fetches = await asyncio.gather(*[
+                self._fetch(printer) for printer in printers
+            ])
+        except Exception:
+            LOGGER.exception('ERROR: Could not fetch jobs')
+            return
+
+        for printer, (jobs, fetch) in zip(printers, fetches):
+            for job in jobs:
+                if not self.cpp.retries.is_scheduled(job['id']):
+                    self.start_job(printer, job, fetch)
+
+    def _retry_soon(self):
+        """Have _retries look at the scheduler again, after a job failed"""
+        if self._retry_wakeup is not None:
+            self._retry_wakeup.set()
+
+    async def _retries(self):
+        """Start retries as they fall due, for as long as the runner runs"""
+        while True:
+            self._retry_wakeup.clear()
+            for printer, job in self.cpp.retries.pop_due():
+                self.start_job(printer, job)
+            try:
+                await asyncio.wait_for(
+                    self._retry_wakeup.wait(),
+                    self.cpp.retries.next_due_in(),
+                )
+            except asyncio.TimeoutError:
+                pass
+
+    def _refetch_later(self):
+        due_in = self.cpp.leases.next_due_in()
+        if due_in is None:
+            return
+        refetch_at = time.time() + due_in
+        if self._refetch_at is not None and self._refetch_at <= refetch_at:
+            return
+        self._refetch_at = refetch_at
+        self._spawn(self._refetch(refetch_at, due_in))
+
+    async def _refetch(self, refetch_at, delay):
+        await asyncio.sleep(delay)
+        if self._refetch_at == refetch_at:
+            self._refetch_at = None
+        printer_ids = self.cpp.leases.due_printers()
+        if printer_ids:
+            await self.check_printers(printer_ids)
+        self._refetch_later()
+
+    def start_job(self, printer, job, fetch=None):
+        """Run a job in the background unless it is already in flight"""
+        if not self.cpp.jobs.claim(job):
+            LOGGER.debug('Job %s is already being handled', job['id'])
+            return None
+        leases = self.cpp.leases
+        try:
+            if leases is not None and not leases.acquire(job['id']):
+                LOGGER.debug('Job %s is leased to another node', job['id'])
+                self.cpp.jobs.release(job)
+                # look again once the lease runs out, in case that node
+                # has gone
+                leases.watch(printer.id, job['id'])
+                self._refetch_later()
+                return None
+            self.cpp.tracer.begin(job['id'], printer, fetch)
+            # _run_job releases the claim from here on
+            return self._spawn(self._run_job(printer, job))
+        except Exception:
+            # left unreleased the claim would keep the job from this node
+            # for good
+            LOGGER.exception('Could not start job %s', job['id'])
+            self.cpp.jobs.release(job)
+            return None
+
+    async def _run_job(self, printer, job):
+        slot = self._printer_slots.get(printer.id)
+        if slot is None:
+            slot = self._printer_slots[printer.id] = asyncio.Semaphore(
+                self.per_printer
+            )
+        completed = False
+        try:
+            # the printer slot is taken first so jobs queued behind a busy
+            # printer don't tie up slots other printers could use
+            async with slot:
+                async with self._job_slots:
+                    completed = await self.process_job(printer, job)
+        except Exception:
+            LOGGER.exception('Error processing job %s', job['id'])
+        finally:
+            self.cpp.jobs.release(job, completed)
+
+    async def _checkout(self):
+        async with self._connection_freed:
+            while not self._connections and \
+                    self._connection_count >= self.cups_threads:
+                await self._connection_freed.wait()
+            if self._connections:
+                return self._connections.pop()
+            self._connection_count += 1
+
+        try:
+            return await self._call(self.connection_factory)
+        except Exception:
+            await self._checkin(None, healthy=False)
+            raise
+
+    async def _checkin(self, connection, healthy=True):
+        async with self._connection_freed:
+            if healthy:
+                self._connections.append(connection)
+            else:
+                self._connection_count -= 1
+            self._connection_freed.notify()
+
+    async def process_job(self, printer, job):
+        """Print a job. Returns True once the cloud has been told how it
+        ended, or the telling is queued, False if it is to be retried."""
+        completed = False
+        try:
+            state = self.cpp.journal.state(job['id'])
+            if state == journal.FAILED:
+                # given up on already, only the acknowledgement went missing
+                await self.acknowledge(printer, job['id'], ack.ERROR)
+                completed = True
+                return True
+            if state in (journal.SUBMITTED, journal.ACKNOWLEDGED):
+                # printed already, only the acknowledgement went missing
+                LOGGER.info(cloudprint.unicode_escape(
+                    'Job %s already printed' % job['title']
+                ))
+            else:
+                self.cpp.journal.fetched(job['id'], printer.id)
+                cups_job_id = await self.print_job(printer, job)
+                self.cpp.journal.submitted(job['id'], cups_job_id)
+                LOGGER.info(
+                    cloudprint.unicode_escape('SUCCESS ' + job['title'])
+                )
+
+            await self.acknowledge(printer, job['id'], ack.DONE)
+            self.cpp.retries.succeeded(job['id'])
+            completed = True
+            metrics.JOBS.labels(printer.name, 'done').inc()
+            return True
+
+        except Exception:
+            printed = (
+                self.cpp.journal.state(job['id']) == journal.SUBMITTED
+            )
+            retry = self.cpp.retries.failed(printer, job)
+            if retry:
+                metrics.RETRIES.labels(printer.name).inc()
+                LOGGER.info(cloudprint.unicode_escape(
+                    'Job %s failed - Will retry' % job['title']
+                ))
+            elif printed:
+                # only telling the cloud failed; a job that printed is
+                # never reported as an error
+                retry = self.cpp.retries.failed(printer, job)
+                LOGGER.warning(cloudprint.unicode_escape(
+                    'Job %s printed but could not be acknowledged - '
+                    'Will retry' % job['title']
+                ))
+            if retry:
+                self._retry_soon()
+            if retry or printed:
+                return False
+
+            self.cpp.journal.failed(job['id'])
+            await self.acknowledge(printer, job['id'], ack.ERROR)
+            completed = True
+            metrics.JOBS.labels(printer.name, 'error').inc()
+            LOGGER.error(cloudprint.unicode_escape('ERROR ' + job['title']))
+            return True
+
+        finally:
+            if not completed:
+                self.cpp.tracer.finish(job['id'], 'retry')
+
+    async def acknowledge(self, printer, job_id, status):
+        """Tell the cloud how a job ended, through the background
+        acknowledger if there is one"""
+        if self.cpp.acks is not None:
+            self.cpp.acks.queue(job_id, status, printer.name)
+            return
+        start = time.time()
+        if status == ack.DONE:
+            await self.api.finish_job(job_id)
+        else:
+            await self.api.fail_job(job_id)
+        end = time.time()
+        self.cpp.journal.acknowledged(job_id)
+        if self.cpp.leases is not None:
+            self.cpp.leases.done(job_id)
+        metrics.CONTROL_SECONDS.labels(printer.name).observe(end - start)
+        self.cpp.tracer.span(job_id, 'control', start, end, status=status)
+        self.cpp.tracer.finish(job_id, status.lower())
+
+    async def print_job(self, printer, job):
+        """Download job and hand it to CUPS. Returns the CUPS job id."""
+        async def fetch_ticket():
+            start = time.time()
+            options = await self.api.get_job_options(job['ticketUrl'])
+            end = time.time()
+            metrics.TICKET_SECONDS.labels(printer.name).observe(end - start)
+            self.cpp.tracer.span(job['id'], 'ticket', start, end)
+            return options
+
+        ticket = asyncio.ensure_future(fetch_ticket())
+        try:
+            async with self.api.session.get(
+                job['fileUrl'],
+                headers=self.api.headers(),
+            ) as document:
+                document.raise_for_status()
+                options = await ticket
+
+                connection = await self._checkout()
+                healthy = False
+                try:
+                    cups_job_id = await self.submit(
+                        connection,
+                        printer.name,
+                        cloudprint.job_title(job),
+                        options,
+                        document,
+                    )
+                    healthy = True
+                finally:
+                    await self._checkin(connection, healthy)
+        finally:
+            ticket.cancel()
+        return cups_job_id
+
+    async def submit(self, connection, printer_name, title, options,
+                     document):
+        """Send an aiohttp download to CUPS, streaming it unless that is
+        turned off or unsupported. Returns the CUPS job id."""
+        chunks = document.content.iter_chunked(self.cpp.chunk_size)
+        if not (self.cpp.stream_jobs and hasattr(connection, 'createJob')):
+            tmp = tempfile.NamedTemporaryFile(delete=False)
+            try:
+                with tmp:
+                    async for chunk in chunks:
+                        tmp.write(chunk)
+                return await self._call(
+                    connection.printFile, printer_name, tmp.name, title,
+                    options,
+                )
+            finally:
+                os.unlink(tmp.name)
+
+        cups_job_id = await self._call(
+            connection.createJob, printer_name, title, options,
+        )
+        try:
+            cloudprint.check_http_status(await self._call(
+                connection.startDocument,
+                printer_name,
+                cups_job_id,
+                title,
+                cups.CUPS_FORMAT_AUTO,
+                1,
+            ))
+            async for chunk in chunks:
+                cloudprint.check_http_status(await self._call(
+                    connection.writeRequestData, chunk, len(chunk),
+                ))
+            await self._call(connection.finishDocument, printer_name)
+        except Exception:
+            try:
+                await self._call(connection.cancelJob, cups_job_id)
+            except Exception:
+                LOGGER.debug('Could not cancel CUPS job %s', cups_job_id)
+            raise
+        return cups_job_id
+
+
+def run(cpp, workers=0, per_printer=1):
+    """Run the job loop on a new event loop until the process is stopped"""
+    cpp.auth.start_refresher()
+    if cpp.leases is not None:
+        cpp.leases.start()
+    if cpp.acks is not None:
+        cpp.acks.start()
+    cloudprint.acknowledge_submitted(cpp)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    runner = AsyncRunner(
+        cpp,
+        max_jobs=workers or MAX_JOBS,
+        per_printer=per_printer,
+    )
+    loop.run_until_complete(runner.run())
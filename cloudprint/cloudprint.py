@@ -20,6 +20,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import argparse
+import collections
+import contextlib
 import cups
 import datetime
 import hashlib
@@ -28,18 +30,41 @@ import json
 import logging
 import logging.handlers
 import os
+import random
 import re
 import requests
+import requests.adapters
 import shutil
 import stat
 import sys
 import tempfile
+import threading
 import time
 import uuid
 
 try:
+    from cloudprint import ack
+    from cloudprint import completion
+    from cloudprint import cupspool
+    from cloudprint import executor
+    from cloudprint import inflight
+    from cloudprint import journal
+    from cloudprint import lease
+    from cloudprint import metrics
+    from cloudprint import retry
+    from cloudprint import tracing
     from cloudprint import xmpp
 except Exception:
+    import ack
+    import completion
+    import cupspool
+    import executor
+    import inflight
+    import journal
+    import lease
+    import metrics
+    import retry
+    import tracing
     import xmpp
 
 XMPP_SERVER_HOST = 'talk.google.com'
@@ -63,9 +88,33 @@ FAIL_RETRY = 60
 # how often, in seconds, to send a keepalive character over xmpp
 KEEPALIVE = 600.0
 
-# failed job retries
-RETRIES = 1
-num_retries = 0
+# how long before expiry, in seconds, the access token is renewed, and the
+# random jitter added so many proxies don't refresh in lock step
+TOKEN_REFRESH_SLOP = 900
+TOKEN_REFRESH_JITTER = 60.0
+
+# backoff bounds, in seconds, when a background token refresh fails
+TOKEN_RETRY_MIN = 5.0
+TOKEN_RETRY_MAX = 300.0
+
+# size of the HTTP connection pool kept open to the cloud print service
+HTTP_POOL_SIZE = 10
+
+# how often, in seconds, the cached list of cloud printers is refreshed
+REGISTRY_REFRESH = 3600.0
+
+# fetch errorCode meaning the printer simply has no jobs waiting
+FETCH_NO_JOBS = 413
+
+# where cupsd keeps the PPD of each queue; read directly when we can, to
+# save CUPS writing a temporary copy for us
+CUPS_PPD_DIR = '/etc/cups/ppd'
+
+# bytes read from a job download at a time when streaming it into CUPS
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# settings an account in the --accounts file may have
+ACCOUNT_KEYS = frozenset(['auth', 'site', 'include', 'exclude', 'journal'])
 
 LOGGER = logging.getLogger('cloudprint')
 LOGGER.setLevel(logging.INFO)
@@ -79,31 +128,138 @@ def unicode_escape(string):
     return string.encode('unicode-escape').decode('ascii')
 
 
+def caps_hash(ppd):
+    return hashlib.sha1(ppd.encode('utf-8')).hexdigest()
+
+
 class CloudPrintAuth(object):
     AUTH_POLL_PERIOD = 10.0
 
-    def __init__(self, auth_path):
+    def __init__(self, auth_path, pool_size=HTTP_POOL_SIZE, keepalive=True,
+                 adapter=None):
         self.auth_path = auth_path
         self.guid = None
         self.email = None
         self.xmpp_jid = None
         self.exp_time = None
+        self.token_expiry = None
         self.refresh_token = None
         self._access_token = None
-
-    @property
-    def session(self):
+        self.pool_size = pool_size
+        self.keepalive = keepalive
+        # an HTTPAdapter shared with other accounts, so they share one pool
+        self.adapter = adapter
+        self._session = None
+        self._refresh_lock = threading.Lock()
+        self._refresh_count = 0
+        self._refresher = None
+        self._stop_refresher = threading.Event()
+
+    def _new_session(self):
         s = requests.session()
+        adapter = self.adapter
+        if adapter is None:
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size,
+            )
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
         s.headers['X-CloudPrint-Proxy'] = 'ArmoooIsAnOEM'
-        s.headers['Authorization'] = 'Bearer {0}'.format(self.access_token)
+        if not self.keepalive:
+            s.headers['Connection'] = 'close'
         return s
 
+    @property
+    def session(self):
+        """The long lived, pooled session used for all authenticated API
+        calls. The Authorization header is kept in step with the current
+        access token, so a token refresh never costs a new connection."""
+        if self._session is None:
+            self._session = self._new_session()
+        self._session.headers['Authorization'] = 'Bearer {0}'.format(
+            self.access_token
+        )
+        return self._session
+
+    def close(self):
+        self.stop_refresher()
+        if self._session is not None:
+            # closing the session closes its adapter, which may be shared
+            if self.adapter is None:
+                self._session.close()
+            self._session = None
+
+    def _token_valid(self):
+        return (
+            self._access_token is not None and
+            self.token_expiry is not None and
+            datetime.datetime.now() < self.token_expiry
+        )
+
     @property
     def access_token(self):
         if datetime.datetime.now() > self.exp_time:
-            self.refresh()
+            if self._refresher is not None and self._token_valid():
+                # the background refresher owns renewal; keep serving the
+                # current token until it is really gone
+                return self._access_token
+            try:
+                self.refresh()
+            except Exception:
+                if not self._token_valid():
+                    raise
+                LOGGER.exception('Token refresh failed, using current token')
         return self._access_token
 
+    def start_refresher(self):
+        """Renew the access token in a background thread ahead of expiry,
+        so jobs never wait on accounts.google.com."""
+        if self._refresher is not None:
+            return
+        self._stop_refresher.clear()
+        self._refresher = threading.Thread(
+            target=self._refresh_loop,
+            name='cloudprint-token-refresh',
+        )
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def stop_refresher(self):
+        refresher = self._refresher
+        if refresher is None:
+            return
+        self._stop_refresher.set()
+        if refresher is not threading.current_thread():
+            refresher.join()
+        self._refresher = None
+
+    def _refresh_loop(self):
+        failures = 0
+        while not self._stop_refresher.is_set():
+            if failures:
+                delay = min(
+                    TOKEN_RETRY_MAX,
+                    TOKEN_RETRY_MIN * 2 ** (failures - 1),
+                )
+            else:
+                delay = (
+                    self.exp_time - datetime.datetime.now()
+                ).total_seconds()
+                delay -= random.uniform(0, TOKEN_REFRESH_JITTER)
+            if self._stop_refresher.wait(max(delay, 0)):
+                break
+
+            try:
+                self.refresh()
+                failures = 0
+            except Exception:
+                failures += 1
+                LOGGER.warning(
+                    'Token refresh failed (attempt %d), retrying', failures,
+                    exc_info=True,
+                )
+
     def no_auth(self):
         return not os.path.exists(self.auth_path)
 
@@ -119,7 +275,7 @@ class CloudPrintAuth(object):
                 'defaults': ppd.encode('utf-8'),
                 'status': 'OK',
                 'description': description,
-                'capsHash': hashlib.sha1(ppd.encode('utf-8')).hexdigest(),
+                'capsHash': caps_hash(ppd),
             },
             headers={'X-CloudPrint-Proxy': 'ArmoooIsAnOEM'},
         ).json()
@@ -161,20 +317,35 @@ class CloudPrintAuth(object):
         self.save()
 
     def refresh(self):
-        token = requests.post(
-            'https://accounts.google.com/o/oauth2/token',
-            data={
-                'client_id': CLIENT_ID,
-                'client_secret': CLIENT_KEY,
-                'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token,
-            }
-        ).json()
-        self._access_token = token['access_token']
-
-        slop_time = datetime.timedelta(minutes=15)
-        expires_in = datetime.timedelta(seconds=token['expires_in'])
-        self.exp_time = datetime.datetime.now() + (expires_in - slop_time)
+        # Only one refresh is ever in flight; callers that queued up behind
+        # it reuse its result instead of asking for yet another token.
+        count = self._refresh_count
+        with self._refresh_lock:
+            if self._refresh_count != count:
+                return
+
+            try:
+                token = requests.post(
+                    'https://accounts.google.com/o/oauth2/token',
+                    data={
+                        'client_id': CLIENT_ID,
+                        'client_secret': CLIENT_KEY,
+                        'grant_type': 'refresh_token',
+                        'refresh_token': self.refresh_token,
+                    }
+                ).json()
+                self._access_token = token['access_token']
+            except Exception:
+                metrics.TOKEN_REFRESHES.labels('error').inc()
+                raise
+            metrics.TOKEN_REFRESHES.labels('ok').inc()
+
+            slop_time = datetime.timedelta(seconds=TOKEN_REFRESH_SLOP)
+            expires_in = datetime.timedelta(seconds=token['expires_in'])
+            now = datetime.datetime.now()
+            self.token_expiry = now + expires_in
+            self.exp_time = now + (expires_in - slop_time)
+            self._refresh_count += 1
 
     def load(self):
         if os.path.exists(self.auth_path):
@@ -211,9 +382,23 @@ class CloudPrintProxy(object):
     def __init__(self, auth):
         self.auth = auth
         self.sleeptime = 0
+        # when process_jobs_once next checks every printer
+        self.sweep_at = 0
         self.site = ''
-        self.include = []
-        self.exclude = []
+        self.printer_filter = PrinterFilter()
+        self.stream_jobs = True
+        self.chunk_size = STREAM_CHUNK_SIZE
+        self.registry = PrinterRegistry(self)
+        self.retries = retry.RetryScheduler()
+        self.journal = journal.JobJournal()
+        self.jobs = inflight.JobTracker()
+        # job leases shared with other nodes, None when running alone
+        self.leases = None
+        self.tracer = tracing.Tracer()
+        # background acknowledger, None to acknowledge jobs as they end
+        self.acks = None
+        # CUPS job tracker, None to count a job done once CUPS has it
+        self.completions = None
 
     def get_printers(self):
         printers = self.auth.session.post(
@@ -223,11 +408,17 @@ class CloudPrintProxy(object):
                 'proxy': self.auth.guid,
             },
         ).json()
+        return self.printers_from_list(printers)
+
+    def printers_from_list(self, printers):
+        """Build PrinterProxy objects from a list response"""
         return [
             PrinterProxy(
                 self,
                 p['id'],
-                re.sub('^' + self.site + '-', '', p['name'])
+                re.sub('^' + self.site + '-', '', p['name']),
+                caps_hash=p.get('capsHash'),
+                description=p.get('description'),
             )
             for p in printers['printers']
         ]
@@ -255,7 +446,7 @@ class CloudPrintProxy(object):
                 'defaults': ppd.encode('utf-8'),
                 'status': 'OK',
                 'description': description,
-                'capsHash': hashlib.sha1(ppd.encode('utf-8')).hexdigest(),
+                'capsHash': caps_hash(ppd),
             },
         ).raise_for_status()
         LOGGER.debug('Added Printer ' + name)
@@ -274,7 +465,7 @@ class CloudPrintProxy(object):
                 'defaults': ppd.encode('utf-8'),
                 'status': 'OK',
                 'description': description,
-                'capsHash': hashlib.sha1(ppd.encode('utf-8')).hexdigest(),
+                'capsHash': caps_hash(ppd),
             },
         ).raise_for_status()
         LOGGER.debug('Updated Printer ' + name)
@@ -287,8 +478,15 @@ class CloudPrintProxy(object):
                 'printerid': printer_id,
             },
         ).json()
+        return self.jobs_from_fetch(docs)
 
+    def jobs_from_fetch(self, docs):
+        """Pull the job list out of a fetch response"""
         if 'jobs' not in docs:
+            if docs.get('errorCode', FETCH_NO_JOBS) != FETCH_NO_JOBS:
+                # most likely the printer is gone; re-list before trusting
+                # the registry again
+                self.registry.invalidate()
             return []
         else:
             return docs['jobs']
@@ -304,6 +502,17 @@ class CloudPrintProxy(object):
         ).json()
         LOGGER.debug('Finished Job' + job_id)
 
+    def progress_job(self, job_id):
+        self.auth.session.post(
+            PRINT_CLOUD_URL + 'control',
+            {
+                'output': 'json',
+                'jobid': job_id,
+                'status': 'IN_PROGRESS',
+            },
+        ).json()
+        LOGGER.debug('Job in progress ' + job_id)
+
     def fail_job(self, job_id):
         self.auth.session.post(
             PRINT_CLOUD_URL + 'control',
@@ -316,11 +525,63 @@ class CloudPrintProxy(object):
         LOGGER.debug('Failed Job' + job_id)
 
 
+class PrinterRegistry(object):
+    """The cloud printers of a proxy, kept in memory and keyed by id and by
+    name so the job loop doesn't need a list call each time round. It is
+    filled by sync_printers and re-listed every refresh_period seconds, or
+    sooner after invalidate()."""
+
+    def __init__(self, cpp, refresh_period=REGISTRY_REFRESH):
+        self.cpp = cpp
+        self.refresh_period = refresh_period
+        self._by_id = {}
+        self._by_name = {}
+        self._expires = 0
+
+    def update(self, printers):
+        self._by_id = dict((p.id, p) for p in printers)
+        self._by_name = dict((p.name, p) for p in printers)
+        self._expires = time.time() + self.refresh_period
+
+    def refresh(self):
+        self.update(self.cpp.get_printers())
+
+    def invalidate(self):
+        self._expires = 0
+
+    def is_stale(self):
+        return time.time() >= self._expires
+
+    def _check(self):
+        if self.is_stale():
+            self.refresh()
+
+    def printers(self):
+        self._check()
+        return list(self._by_id.values())
+
+    def get(self, printer_id, refresh=True):
+        """Look a printer up by id, re-listing once if it isn't known and
+        refresh is set"""
+        if refresh:
+            self._check()
+            if printer_id not in self._by_id:
+                self.refresh()
+        return self._by_id.get(printer_id)
+
+    def get_by_name(self, name):
+        self._check()
+        return self._by_name.get(name)
+
+
 class PrinterProxy(object):
-    def __init__(self, cpp, printer_id, name):
+    def __init__(self, cpp, printer_id, name, caps_hash=None,
+                 description=None):
         self.cpp = cpp
         self.id = printer_id
         self.name = name
+        self.caps_hash = caps_hash
+        self.description = description
 
     def get_jobs(self):
         LOGGER.info('Polling for jobs on ' + self.name)
@@ -333,130 +594,632 @@ class PrinterProxy(object):
         return self.cpp.delete_printer(self.id)
 
 
-# True if printer name matches *any* of the regular expressions in regexps
-def match_re(prn, regexps, empty=False):
-    if len(regexps):
+class PrinterFilter(object):
+    """Decide which local printers are shared from the -i and -x regular
+    expressions, matched against the start of the printer name. With no
+    include patterns every printer is included.
+
+    The patterns are compiled up front, raising ValueError for a bad one,
+    and the answer for each printer name is remembered."""
+
+    def __init__(self, include=(), exclude=()):
+        self.include = self._compile(include)
+        self.exclude = self._compile(exclude)
+        self._results = {}
+
+    @staticmethod
+    def _compile(patterns):
+        compiled = []
+        for pattern in patterns:
+            try:
+                compiled.append(re.compile(pattern, re.UNICODE))
+            except re.error:
+                raise ValueError(
+                    'invalid regular expression: ' + pattern
+                )
+        return compiled
+
+    def _match(self, printer_name):
+        if self.include and not any(
+                r.match(printer_name) for r in self.include):
+            return False
+        return not any(r.match(printer_name) for r in self.exclude)
+
+    def __call__(self, printer_name):
         try:
-            return (
-                re.match(regexps[0], prn, re.UNICODE)
-                or match_re(prn, regexps[1:])
-            )
-        except Exception:
-            sys.stderr.write(
-                'cloudprint: invalid regular expression: ' +
-                regexps[0] +
-                '\n'
-            )
-            sys.exit(1)
-    else:
-        return empty
+            return self._results[printer_name]
+        except KeyError:
+            result = self._results[printer_name] = self._match(printer_name)
+            return result
 
 
-def get_printer_info(cups_connection, printer_name):
+def get_printer_info(cups_connection, printer_name, printer_attrs=None):
         # This is bad it should use the LanguageEncoding in the PPD
         # But a lot of utf-8 PPDs seem to say they are ISOLatin1
         print("The printer is: " + printer_name)
-        ppd_path = cups_connection.getPPD(printer_name)
-        with io.open(ppd_path, encoding='utf-8') as ppd_file:
-            ppd = ppd_file.read()
-
-        printer_attrs = cups_connection.getPrinterAttributes(printer_name)
+        ppd_path = os.path.join(CUPS_PPD_DIR, printer_name + '.ppd')
+        if os.access(ppd_path, os.R_OK):
+            with io.open(ppd_path, encoding='utf-8') as ppd_file:
+                ppd = ppd_file.read()
+        else:
+            ppd_path = cups_connection.getPPD(printer_name)
+            try:
+                with io.open(ppd_path, encoding='utf-8') as ppd_file:
+                    ppd = ppd_file.read()
+            finally:
+                os.unlink(ppd_path)
+
+        if not isinstance(printer_attrs, dict) or \
+                'printer-info' not in printer_attrs:
+            printer_attrs = cups_connection.getPrinterAttributes(printer_name)
         description = printer_attrs['printer-info']
         return ppd, description
 
 
+class PrinterInfoCache(object):
+    """PPD text, PPD hash and description for each local printer.
+
+    Entries are keyed on the identity of the PPD file (inode, size and
+    mtime) or, when the file can't be seen, on the printer's
+    printer-state-change-time from getPrinters(), and are reloaded as soon as
+    that changes. Printers with neither are always reloaded."""
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _identity(self, printer_name, printer_attrs):
+        try:
+            st = os.stat(os.path.join(CUPS_PPD_DIR, printer_name + '.ppd'))
+            return ('ppd', st.st_ino, st.st_size, st.st_mtime)
+        except OSError:
+            pass
+
+        if isinstance(printer_attrs, dict):
+            change_time = printer_attrs.get('printer-state-change-time')
+            if change_time is not None:
+                return ('cups', change_time)
+        return None
+
+    def get(self, cups_connection, printer_name, printer_attrs=None):
+        """Return (ppd, description, ppd hash) for a printer. printer_attrs
+        is its entry from getPrinters(), which saves a getPrinterAttributes
+        call per printer."""
+        identity = self._identity(printer_name, printer_attrs)
+        entry = self._entries.get(printer_name)
+        if identity is not None and entry is not None and \
+                entry[0] == identity:
+            self.hits += 1
+            ppd, description, ppd_hash = entry[1:]
+            if isinstance(printer_attrs, dict):
+                description = printer_attrs.get('printer-info', description)
+            return ppd, description, ppd_hash
+
+        self.misses += 1
+        ppd, description = get_printer_info(
+            cups_connection, printer_name, printer_attrs
+        )
+        ppd_hash = caps_hash(ppd)
+        self._entries[printer_name] = (identity, ppd, description, ppd_hash)
+        return ppd, description, ppd_hash
+
+    def prune(self, printer_names):
+        """Forget printers not in printer_names"""
+        for printer_name in set(self._entries) - set(printer_names):
+            del self._entries[printer_name]
+
+
+printer_info_cache = PrinterInfoCache()
+
+
+SyncResult = collections.namedtuple(
+    'SyncResult',
+    ('added', 'updated', 'unchanged', 'removed'),
+)
+
+
 def sync_printers(cups_connection, cpp):
-    local_printer_names = set(cups_connection.getPrinters().keys())
-    remote_printers = dict([(p.name, p) for p in cpp.get_printers()])
+    """Make the cloud printers match the local CUPS printers. Printers whose
+    PPD hash and description already match what the cloud reported are left
+    alone. Returns a SyncResult of the printer counts."""
+    start = time.time()
+    local_printers = cups_connection.getPrinters()
+    local_printer_names = set(local_printers.keys())
+    printers = cpp.get_printers()
+    cpp.registry.update(printers)
+    remote_printers = dict([(p.name, p) for p in printers])
     remote_printer_names = set(remote_printers)
 
     # Include/exclude local printers
-    local_printer_names = set([
-        prn for prn in local_printer_names
-        if match_re(prn, cpp.include, True)
-    ])
-    local_printer_names = set([
-        prn for prn in local_printer_names
-        if not match_re(prn, cpp.exclude)
-    ])
+    local_printer_names = set(filter(cpp.printer_filter, local_printer_names))
+
+    added = updated = unchanged = removed = 0
 
     # New printers
     for printer_name in local_printer_names - remote_printer_names:
         try:
-            ppd, description = get_printer_info(cups_connection, printer_name)
+            ppd, description, _ = printer_info_cache.get(
+                cups_connection, printer_name, local_printers[printer_name]
+            )
             cpp.add_printer(printer_name, description, ppd)
+            added += 1
         except (cups.IPPError, UnicodeDecodeError):
             LOGGER.exception('Skipping ' + printer_name)
 
     # Existing printers
     for printer_name in local_printer_names & remote_printer_names:
-        ppd, description = get_printer_info(cups_connection, printer_name)
-        remote_printers[printer_name].update(description, ppd)
+        ppd, description, ppd_hash = printer_info_cache.get(
+            cups_connection, printer_name, local_printers[printer_name]
+        )
+        remote_printer = remote_printers[printer_name]
+        if (remote_printer.caps_hash == ppd_hash and
+                remote_printer.description == description):
+            unchanged += 1
+        else:
+            remote_printer.update(description, ppd)
+            updated += 1
 
     # Printers that have left us
     for printer_name in remote_printer_names - local_printer_names:
         remote_printers[printer_name].delete()
+        removed += 1
 
+    printer_info_cache.prune(local_printer_names)
+    if added or removed:
+        cpp.registry.invalidate()
 
-def process_job(cups_connection, cpp, printer, job):
-    global num_retries
+    result = SyncResult(added, updated, unchanged, removed)
+    metrics.SYNC_SECONDS.observe(time.time() - start)
+    LOGGER.info(
+        'Synced printers: %d added, %d updated, %d unchanged, %d removed',
+        *result
+    )
+    return result
+
+
+def check_http_status(status):
+    if status != cups.HTTP_CONTINUE:
+        raise cups.HTTPError(status)
 
+
+def stream_job(cups_connection, printer_name, title, options, document,
+               chunk_size=STREAM_CHUNK_SIZE):
+    """Feed a streamed HTTP download into a new CUPS job as it arrives, so
+    CUPS starts spooling before the download is done and at most chunk_size
+    bytes of the document are held in memory. Returns the CUPS job id."""
+    cups_job_id = cups_connection.createJob(printer_name, title, options)
     try:
-        pdf = cpp.auth.session.get(job['fileUrl'], stream=True)
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        shutil.copyfileobj(pdf.raw, tmp)
-        tmp.flush()
-
-        options = cpp.auth.session.get(job['ticketUrl']).json()
-        if 'request' in options:
-            del options['request']
-
-        options = dict((str(k), str(v)) for k, v in list(options.items()))
-        docTitle = "["+job['ownerId']+"]" + job['title'][:255]
-        # Cap the title length to 255, or cups will complain about invalid
-        # job-name
-        cups_connection.printFile(
+        check_http_status(cups_connection.startDocument(
+            printer_name,
+            cups_job_id,
+            title,
+            cups.CUPS_FORMAT_AUTO,
+            1,
+        ))
+        for chunk in document.iter_content(chunk_size):
+            check_http_status(
+                cups_connection.writeRequestData(chunk, len(chunk))
+            )
+        cups_connection.finishDocument(printer_name)
+    except Exception:
+        try:
+            cups_connection.cancelJob(cups_job_id)
+        except Exception:
+            LOGGER.debug('Could not cancel CUPS job %s', cups_job_id)
+        raise
+    return cups_job_id
+
+
+@contextlib.contextmanager
+def spooled_document(document):
+    """Download a job to a temporary file, for backends that need a seekable
+    file. The file is removed on exit."""
+    tmp = tempfile.NamedTemporaryFile(delete=False)
+    try:
+        with tmp:
+            shutil.copyfileobj(document.raw, tmp)
+        yield tmp.name
+    finally:
+        os.unlink(tmp.name)
+
+
+class MeteredDownload(object):
+    """A streamed download that adds up the bytes read from it and the time
+    spent waiting for them, and notes when the first and last bytes came.
+    Reads through it with iter_content, or through raw as a file."""
+
+    def __init__(self, response):
+        self._response = response
+        self.raw = self
+        self.bytes = 0
+        self.seconds = 0.0
+        self.first_byte = None
+        self.last_byte = None
+
+    def _got(self, data, start):
+        now = time.time()
+        self.seconds += now - start
+        if data:
+            self.bytes += len(data)
+            if self.first_byte is None:
+                self.first_byte = now
+        else:
+            self.last_byte = now
+
+    def read(self, size=-1):
+        start = time.time()
+        data = self._response.raw.read(size)
+        self._got(data, start)
+        return data
+
+    def iter_content(self, chunk_size):
+        chunks = self._response.iter_content(chunk_size)
+        while True:
+            start = time.time()
+            try:
+                chunk = next(chunks)
+            except StopIteration:
+                self._got(b'', start)
+                return
+            self._got(chunk, start)
+            yield chunk
+
+
+class BackgroundCall(threading.Thread):
+    """Run func(*args) on its own thread. result() waits for it to finish and
+    returns its value, or raises what it raised."""
+
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._func = func
+        self._args = args
+        self._value = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._value = self._func(*self._args)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self.join()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+def job_title(job):
+    # Cap the title length to 255, or cups will complain about invalid
+    # job-name
+    return "["+job['ownerId']+"]" + job['title'][:255]
+
+
+def get_job_options(session, ticket_url):
+    """Fetch a job ticket and turn it into CUPS options"""
+    return ticket_options(session.get(ticket_url).json())
+
+
+def ticket_options(options):
+    """Turn a job ticket into CUPS options"""
+    if 'request' in options:
+        del options['request']
+
+    return dict((str(k), str(v)) for k, v in list(options.items()))
+
+
+def print_job(cups_connection, cpp, printer, job):
+    """Download job and hand it to CUPS. Returns the CUPS job id."""
+    session = cpp.auth.session
+
+    def fetch_ticket():
+        start = time.time()
+        options = get_job_options(session, job['ticketUrl'])
+        end = time.time()
+        metrics.TICKET_SECONDS.labels(printer.name).observe(end - start)
+        cpp.tracer.span(job['id'], 'ticket', start, end)
+        return options
+
+    # The ticket is fetched and parsed while the document downloads, so
+    # a job costs the slower of the two round trips, not both.
+    ticket = BackgroundCall(fetch_ticket)
+
+    download_start = time.time()
+    pdf = session.get(job['fileUrl'], stream=True)
+    pdf.raise_for_status()
+    connect_time = time.time() - download_start
+    document = MeteredDownload(pdf)
+
+    docTitle = job_title(job)
+    if cpp.stream_jobs and hasattr(cups_connection, 'createJob'):
+        options = ticket.result()
+        start, waited = time.time(), document.seconds
+        cups_job_id = stream_job(
+            cups_connection,
             printer.name,
-            tmp.name,
             docTitle,
             options,
+            document,
+            cpp.chunk_size,
         )
-        os.unlink(tmp.name)
-        LOGGER.info(unicode_escape('SUCCESS ' + job['title']))
+    else:
+        with spooled_document(document) as path:
+            options = ticket.result()
+            start, waited = time.time(), document.seconds
+            cups_job_id = cups_connection.printFile(
+                printer.name,
+                path,
+                docTitle,
+                options,
+            )
+
+    # time spent on the download while CUPS was fed isn't CUPS' doing
+    end = time.time()
+    submit_time = end - start - (document.seconds - waited)
+    metrics.SUBMIT_SECONDS.labels(printer.name).observe(submit_time)
+    cpp.tracer.span(job['id'], 'submit', start, end, cups_job_id=cups_job_id)
+    if document.first_byte is not None:
+        cpp.tracer.span(
+            job['id'], 'download_first_byte', download_start,
+            document.first_byte,
+        )
+    cpp.tracer.span(
+        job['id'], 'download', download_start, document.last_byte,
+        bytes=document.bytes,
+    )
+    metrics.DOWNLOAD_SECONDS.labels(printer.name).observe(
+        connect_time + document.seconds
+    )
+    metrics.DOWNLOAD_BYTES.labels(printer.name).observe(document.bytes)
+    return cups_job_id
 
-        cpp.finish_job(job['id'])
-        num_retries = 0
 
-    except Exception:
-        if num_retries >= RETRIES:
-            num_retries = 0
-            cpp.fail_job(job['id'])
-            LOGGER.error(unicode_escape('ERROR ' + job['title']))
+def process_job(cups_connection, cpp, printer, job):
+    """Print a job claimed from cpp.jobs, and release it"""
+    completed = False
+    try:
+        state = cpp.journal.state(job['id'])
+        if state == journal.FAILED:
+            # given up on already, only the acknowledgement went missing
+            ack.report(cpp, job['id'], ack.ERROR, printer.name)
+            completed = True
+            return
+        tracker = cpp.completions
+        if tracker is not None and tracker.is_tracking(job['id']):
+            # still printing, only the IN_PROGRESS report went missing
+            completed = True
+            return
+        if state in (journal.SUBMITTED, journal.ACKNOWLEDGED):
+            # printed already, only the acknowledgement went missing
+            LOGGER.info(
+                unicode_escape('Job %s already printed' % job['title'])
+            )
         else:
-            num_retries += 1
+            cpp.journal.fetched(job['id'], printer.id)
+            cups_job_id = print_job(cups_connection, cpp, printer, job)
+            cpp.journal.submitted(job['id'], cups_job_id)
+            LOGGER.info(unicode_escape('SUCCESS ' + job['title']))
+            if tracker is not None:
+                # the tracker reports it DONE once CUPS has printed it,
+                # which may be straight away, so IN_PROGRESS goes first
+                report_progress(cpp, job['id'], printer.name)
+                tracker.track(cups_job_id, cpp, job['id'], printer.name)
+                cpp.retries.succeeded(job['id'])
+                completed = True
+                return
+
+        ack.report(cpp, job['id'], ack.DONE, printer.name)
+        cpp.retries.succeeded(job['id'])
+        completed = True
+        metrics.JOBS.labels(printer.name, 'done').inc()
+
+    except Exception:
+        printed = cpp.journal.state(job['id']) == journal.SUBMITTED
+        if cpp.retries.failed(printer, job):
+            metrics.RETRIES.labels(printer.name).inc()
             LOGGER.info(
                 unicode_escape('Job %s failed - Will retry' % job['title'])
             )
+        elif printed:
+            # only telling the cloud failed; a job that printed is never
+            # reported as an error, so start another round of retries, or
+            # failing that wait for the cloud to offer it again
+            cpp.retries.failed(printer, job)
+            LOGGER.warning(
+                unicode_escape(
+                    'Job %s printed but could not be acknowledged - '
+                    'Will retry' % job['title']
+                )
+            )
+        else:
+            cpp.journal.failed(job['id'])
+            ack.report(cpp, job['id'], ack.ERROR, printer.name)
+            completed = True
+            metrics.JOBS.labels(printer.name, 'error').inc()
+            LOGGER.error(unicode_escape('ERROR ' + job['title']))
 
+    finally:
+        cpp.jobs.release(job, completed)
+        if not completed:
+            cpp.tracer.finish(job['id'], 'retry')
+
+
+def report_progress(cpp, job_id, printer_name):
+    """Tell the cloud CUPS has a job. Only a courtesy, so a failure is
+    logged rather than raised."""
+    try:
+        ack.report(cpp, job_id, ack.IN_PROGRESS, printer_name)
+    except Exception:
+        LOGGER.warning('Could not report job %s in progress', job_id,
+                       exc_info=True)
+
+
+def acknowledge_submitted(cpp):
+    """Acknowledge the jobs an earlier run got into CUPS or gave up on but
+    never reported, so the cloud stops offering them and they aren't
+    printed twice"""
+    for job_id, _, state in cpp.journal.pending_acks():
+        cups_job_id = cpp.journal.cups_job_id(job_id)
+        if (state == journal.SUBMITTED and cpp.completions is not None and
+                cups_job_id is not None):
+            # may still be printing; the tracker looks it up
+            cpp.completions.track(cups_job_id, cpp, job_id)
+            continue
+        try:
+            ack.report(cpp, job_id, ack.status_for(state))
+            LOGGER.info('Acknowledged job %s from an earlier run', job_id)
+        except Exception:
+            # left in the journal; process_job acknowledges it when it is
+            # fetched again
+            LOGGER.exception('Could not acknowledge job %s', job_id)
+    cpp.journal.prune()
+
+
+def job_executor_for(workers, per_printer, connections=None):
+    """The worker pool for -w, or None to process jobs inline"""
+    if not workers:
+        return None
+    if connections is None:
+        connections = cupspool.ConnectionPool(size=workers)
+    # pycups connections are not thread safe, each job checks one out
+    return executor.JobExecutor(
+        process_job,
+        workers=workers,
+        per_printer=per_printer,
+        connections=connections,
+    )
 
-def process_jobs(cups_connection, cpp):
-    xmpp_conn = xmpp.XmppConnection(keepalive_period=KEEPALIVE)
 
+def process_jobs(cups_connection, cpp, workers=0, per_printer=1):
+    xmpp_conn = xmpp.XmppConnection(keepalive_period=KEEPALIVE)
+    # threads are started here rather than in main so they survive
+    # daemonizing
+    cpp.auth.start_refresher()
+    if cpp.leases is not None:
+        cpp.leases.start()
+    if cpp.acks is not None:
+        cpp.acks.start()
+    acknowledge_submitted(cpp)
+    if cpp.completions is not None:
+        cpp.completions.start()
+
+    job_executor = job_executor_for(workers, per_printer)
+
+    printer_ids = None
     while True:
-        process_jobs_once(cups_connection, cpp, xmpp_conn)
+        printer_ids = process_jobs_once(
+            cups_connection, cpp, xmpp_conn, job_executor, printer_ids
+        )
 
 
-def process_jobs_once(cups_connection, cpp, xmpp_conn):
-    printers = cpp.get_printers()
+def dispatch_jobs(cups_connection, cpp, job_executor=None, printer_ids=None):
+    """Start any retries that are due and the jobs waiting on printer_ids, or
+    on every printer if it is None"""
+    def dispatch(printer, job, fetch=None):
+        if not cpp.jobs.claim(job):
+            LOGGER.debug('Job %s is already being handled', job['id'])
+            return
+        try:
+            if cpp.leases is not None and \
+                    not cpp.leases.acquire(job['id']):
+                LOGGER.debug('Job %s is leased to another node', job['id'])
+                cpp.jobs.release(job)
+                # look again once the lease runs out, in case that node
+                # has gone
+                cpp.leases.watch(printer.id, job['id'])
+                return
+            cpp.tracer.begin(job['id'], printer, fetch)
+            if job_executor is not None:
+                job_executor.submit(cpp, printer, job)
+                return
+        except Exception:
+            # such as the lease database staying locked; left unreleased
+            # the claim would keep the job from this node for good
+            cpp.jobs.release(job)
+            raise
+        # releases the claim itself
+        process_job(cups_connection, cpp, printer, job)
+
+    for printer, job in cpp.retries.pop_due():
+        dispatch(printer, job)
+
+    if cpp.leases is not None:
+        # printers with a job leased to another node whose lease ran out
+        due = cpp.leases.due_printers()
+        if printer_ids is not None:
+            printer_ids = set(printer_ids) | due
+
+    printers = None
+    if printer_ids is not None:
+        printers = [cpp.registry.get(p) for p in printer_ids]
+        if None in printers:
+            LOGGER.debug('Notified about an unknown printer, checking all')
+            printers = None
+    if printers is None:
+        printers = cpp.registry.printers()
+
+    for printer in printers:
+        start = time.time()
+        jobs = printer.get_jobs()
+        fetch = cpp.tracer.fetched(printer.id, start)
+        for job in jobs:
+            # a job waiting for its retry is left to the retry timer
+            if not cpp.retries.is_scheduled(job['id']):
+                dispatch(printer, job, fetch)
+
+
+def next_due_in(cpp, now=None):
+    """Seconds until a retry is due or a printer is to be fetched again
+    after a lease ran out, or None if neither is waiting"""
+    due_in = [cpp.retries.next_due_in(now)]
+    if cpp.leases is not None:
+        due_in.append(cpp.leases.next_due_in(now))
+    due_in = [d for d in due_in if d is not None]
+    return min(due_in) if due_in else None
+
+
+def process_jobs_once(cups_connection, cpp, xmpp_conn, job_executor=None,
+                      printer_ids=None):
+    """Handle the jobs waiting on printer_ids, or on every printer if it is
+    None or the periodic sweep is due, and any retries that are due, then
+    wait for a notification, the next retry or the next sweep. Returns the
+    printer ids to check on the next call, or None for all of them."""
     try:
-        for printer in printers:
-            for job in printer.get_jobs():
-                process_job(cups_connection, cpp, printer, job)
+        now = time.time()
+        # the sweep keeps its own deadline, so steady notifications about
+        # one printer don't hold off checking the others
+        if cpp.sweep_at <= now:
+            printer_ids = None
+        if printer_ids is None:
+            if cpp.sleeptime is None:
+                cpp.sweep_at = float('inf')
+            else:
+                cpp.sweep_at = now + cpp.sleeptime
+
+        dispatch_jobs(cups_connection, cpp, job_executor, printer_ids)
 
         if not xmpp_conn.is_connected():
             xmpp_conn.connect(XMPP_SERVER_HOST, XMPP_SERVER_PORT, cpp.auth)
 
-        xmpp_conn.await_notification(cpp.sleeptime)
+        # jobs failing on workers from here on wake the wait below
+        cpp.retries.clear_wakeup()
+        timeout = None
+        if cpp.sweep_at != float('inf'):
+            timeout = max(cpp.sweep_at - time.time(), 0)
+        retry_in = next_due_in(cpp)
+        if retry_in is not None and (timeout is None or retry_in < timeout):
+            timeout = retry_in
+
+        if xmpp_conn.await_notification(timeout, [cpp.retries]):
+            printer_ids = xmpp_conn.pop_notified_printers()
+            cpp.tracer.notified(printer_ids)
+            return printer_ids
+        if cpp.sweep_at > time.time():
+            # woken for a retry, not for the periodic poll
+            return set()
 
     except Exception:
         LOGGER.exception(
@@ -466,6 +1229,148 @@ def process_jobs_once(cups_connection, cpp, xmpp_conn):
         )
         time.sleep(FAIL_RETRY)
 
+    return None
+
+
+class MultiAccountLoop(object):
+    """The job loop for several accounts in one process.
+
+    Every account keeps its own XMPP connection, poll period, filters and
+    retries, but they are all waited on by one select() and share the CUPS
+    connection and the job workers. An account that fails is left alone for
+    FAIL_RETRY seconds while the others carry on."""
+
+    def __init__(self, cups_connection, cpps, job_executor=None):
+        self.cups_connection = cups_connection
+        self.job_executor = job_executor
+        self.accounts = [
+            (cpp, xmpp.XmppConnection(keepalive_period=KEEPALIVE))
+            for cpp in cpps
+        ]
+        # when each account next checks all of its printers
+        self._sweep_at = dict((cpp, 0) for cpp in cpps)
+        # printers named by notifications, waiting to be checked
+        self._notified = {}
+        # accounts that failed are skipped until then
+        self._failed_until = {}
+
+    def _account_once(self, cpp, xmpp_conn, now):
+        printer_ids = self._notified.pop(cpp, set())
+        if self._sweep_at[cpp] <= now:
+            printer_ids = None
+            if cpp.sleeptime is None:
+                self._sweep_at[cpp] = float('inf')
+            else:
+                self._sweep_at[cpp] = now + cpp.sleeptime
+
+        dispatch_jobs(
+            self.cups_connection, cpp, self.job_executor, printer_ids
+        )
+
+        if not xmpp_conn.is_connected():
+            xmpp_conn.connect(XMPP_SERVER_HOST, XMPP_SERVER_PORT, cpp.auth)
+
+    def _wait_time(self, now):
+        wake_at = []
+        for cpp, _ in self.accounts:
+            if cpp in self._failed_until:
+                wake_at.append(self._failed_until[cpp])
+                continue
+            wake_at.append(self._sweep_at[cpp])
+            retry_in = next_due_in(cpp, now)
+            if retry_in is not None:
+                wake_at.append(now + retry_in)
+        timeout = min(wake_at) - now
+        if timeout == float('inf'):
+            return None
+        return max(timeout, 0)
+
+    def run_once(self):
+        now = time.time()
+        for cpp, xmpp_conn in self.accounts:
+            if self._failed_until.get(cpp, 0) > now:
+                continue
+            self._failed_until.pop(cpp, None)
+            try:
+                self._account_once(cpp, xmpp_conn, now)
+            except Exception:
+                LOGGER.exception(
+                    'ERROR: Could not Connect to Cloud Service for %s. '
+                    'Will Try again in %d Seconds',
+                    cpp.auth.auth_path,
+                    FAIL_RETRY,
+                )
+                xmpp_conn.close()
+                self._failed_until[cpp] = now + FAIL_RETRY
+                # notifications may have been lost meanwhile
+                self._sweep_at[cpp] = 0
+
+        connections = dict(
+            (xmpp_conn, cpp) for cpp, xmpp_conn in self.accounts
+        )
+        # jobs failing on workers from here on wake the wait below
+        for cpp, _ in self.accounts:
+            cpp.retries.clear_wakeup()
+        notified = xmpp.await_notifications(
+            list(connections), self._wait_time(time.time()),
+            [cpp.retries for cpp, _ in self.accounts],
+        )
+        for xmpp_conn in notified:
+            cpp = connections[xmpp_conn]
+            printer_ids = xmpp_conn.pop_notified_printers()
+            cpp.tracer.notified(printer_ids)
+            if printer_ids is None:
+                self._sweep_at[cpp] = 0
+            else:
+                self._notified.setdefault(cpp, set()).update(printer_ids)
+
+    def run(self):
+        # threads are started here rather than in main so they survive
+        # daemonizing
+        for cpp, _ in self.accounts:
+            cpp.auth.start_refresher()
+            if cpp.leases is not None:
+                cpp.leases.start()
+            if cpp.acks is not None:
+                cpp.acks.start()
+            acknowledge_submitted(cpp)
+            if cpp.completions is not None:
+                cpp.completions.start()
+        while True:
+            self.run_once()
+
+
+def load_accounts(path):
+    """Read the --accounts file: a JSON list with an object per account,
+    holding the path to its "auth" file and optionally its "site",
+    "include" and "exclude" patterns and "journal" file. Raises ValueError
+    if the file doesn't make sense."""
+    with open(path) as f:
+        try:
+            accounts = json.load(f)
+        except ValueError as e:
+            raise ValueError('{0}: {1}'.format(path, e))
+
+    if not isinstance(accounts, list) or not accounts:
+        raise ValueError('{0}: expected a list of accounts'.format(path))
+    for account in accounts:
+        if not isinstance(account, dict) or 'auth' not in account:
+            raise ValueError(
+                '{0}: every account needs an "auth" file'.format(path)
+            )
+        unknown = set(account) - ACCOUNT_KEYS
+        if unknown:
+            raise ValueError('{0}: unknown account setting {1}'.format(
+                path, ', '.join(sorted(unknown))
+            ))
+        account['auth'] = os.path.expanduser(account['auth'])
+        account.setdefault(
+            'journal',
+            os.path.splitext(account['auth'])[0] + '.journal.sqlite',
+        )
+        account['journal'] = os.path.expanduser(account['journal'])
+    return accounts
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
@@ -495,6 +1400,65 @@ def parse_args():
         default=os.path.expanduser('~/.cloudprintauth.json'),
         help='path to google account ident data (default %(default)s)',
     )
+    parser.add_argument(
+        '--accounts',
+        metavar='accounts_file',
+        help='serve every account listed in this JSON file from one '
+             'process, instead of the one given by -a',
+    )
+    parser.add_argument(
+        '--lease-file',
+        metavar='lease_file',
+        help='share jobs with other nodes running the same accounts, '
+             'through leases kept in this SQLite file',
+    )
+    parser.add_argument(
+        '--lease-ttl',
+        metavar='seconds',
+        type=float,
+        default=lease.LEASE_TTL,
+        help='how long the jobs of a node that stops are held before '
+             'another node takes them (default %(default)s)',
+    )
+    parser.add_argument(
+        '--journal',
+        metavar='journal_file',
+        default=os.path.expanduser('~/.cloudprintjournal.sqlite'),
+        help='path to the job journal, which stops a job being printed '
+             'twice across a crash (default %(default)s)',
+    )
+    parser.add_argument(
+        '--metrics-port',
+        metavar='port',
+        type=int,
+        help='serve job latency and other metrics, in the Prometheus text '
+             'format, on this port of 127.0.0.1',
+    )
+    parser.add_argument(
+        '--metrics-file',
+        metavar='metrics_file',
+        help='write the same metrics to this file every {0:g} '
+             'seconds'.format(metrics.DUMP_PERIOD),
+    )
+    parser.add_argument(
+        '--trace-file',
+        metavar='trace_file',
+        help='append a JSON line with the timed stages of each job to this '
+             'file',
+    )
+    parser.add_argument(
+        '--trace-sample',
+        metavar='fraction',
+        type=float,
+        default=tracing.TRACE_SAMPLE,
+        help='share of jobs to trace (default %(default)s)',
+    )
+    parser.add_argument(
+        '--trace-slow',
+        metavar='seconds',
+        type=float,
+        help='also trace every job that takes this long, sampled or not',
+    )
     parser.add_argument(
         '-c',
         dest='authonly',
@@ -540,6 +1504,104 @@ def parse_args():
         default='',
         help='one-word site-name that will prefix printers',
     )
+    parser.add_argument(
+        '-w',
+        metavar='count',
+        dest='workers',
+        type=int,
+        default=0,
+        help='process jobs on %(metavar)s worker threads '
+             '(default: one job at a time)',
+    )
+    parser.add_argument(
+        '--async',
+        dest='use_async',
+        action='store_true',
+        help='run notifications, polling and jobs on one asyncio event loop '
+             '(requires the aiohttp module)',
+    )
+    parser.add_argument(
+        '--printer-workers',
+        metavar='count',
+        type=int,
+        default=1,
+        help='most jobs running at once on any one printer '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--no-stream',
+        dest='stream',
+        action='store_false',
+        help='download each job to a temporary file before printing it, '
+             'for backends that need a seekable file',
+    )
+    parser.add_argument(
+        '--chunk-size',
+        metavar='bytes',
+        type=int,
+        default=STREAM_CHUNK_SIZE,
+        help='bytes buffered at a time when streaming jobs into CUPS '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--retries',
+        metavar='count',
+        type=int,
+        default=retry.RETRIES,
+        help='times to retry a failed job (default %(default)s)',
+    )
+    parser.add_argument(
+        '--retry-delay',
+        metavar='seconds',
+        type=float,
+        default=retry.RETRY_DELAY,
+        help='wait before the first retry of a job, doubling with each '
+             'further failure (default %(default)s)',
+    )
+    parser.add_argument(
+        '--ack-threads',
+        metavar='count',
+        type=int,
+        default=ack.ACK_THREADS,
+        help='threads telling the cloud how jobs ended, so workers need not '
+             'wait on it; 0 to tell it as each job ends '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--track-completion',
+        action='store_true',
+        help='report a job done only once CUPS has printed it, and as an '
+             'error if CUPS aborts it, rather than once CUPS accepts it',
+    )
+    parser.add_argument(
+        '--completion-poll',
+        metavar='seconds',
+        type=float,
+        default=completion.COMPLETION_POLL,
+        help='how often to ask CUPS which jobs have ended '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--registry-refresh',
+        metavar='seconds',
+        type=float,
+        default=REGISTRY_REFRESH,
+        help='how often to re-list the cloud printers (default %(default)s)',
+    )
+    parser.add_argument(
+        '--http-pool-size',
+        metavar='count',
+        type=int,
+        default=HTTP_POOL_SIZE,
+        help='HTTP connections to keep open to the cloud print service '
+             '(default %(default)s)',
+    )
+    parser.add_argument(
+        '--no-keepalive',
+        dest='keepalive',
+        action='store_false',
+        help='close HTTP connections after every request',
+    )
 
     return parser.parse_args()
 
@@ -547,6 +1609,12 @@ def parse_args():
 def main():
     args = parse_args()
 
+    try:
+        printer_filter = PrinterFilter(args.include, args.exclude)
+    except ValueError as e:
+        sys.stderr.write('cloudprint: {0}\n'.format(e))
+        sys.exit(1)
+
     if args.syslog_address and not args.daemon:
         print('syslog_address is only valid in daemon mode')
         sys.exit(1)
@@ -580,40 +1648,132 @@ def main():
         requests_log.setLevel(logging.DEBUG)
         requests_log.propagate = True
 
-    auth = CloudPrintAuth(args.authfile)
+    if args.track_completion and args.use_async:
+        print('--track-completion can not be used with --async')
+        sys.exit(1)
+
+    pool_size = max(args.http_pool_size, args.workers)
+    adapter = None
+    if args.accounts:
+        if args.use_async:
+            print('--accounts can not be used with --async')
+            sys.exit(1)
+        try:
+            accounts = load_accounts(args.accounts)
+            for account in accounts:
+                account['filter'] = PrinterFilter(
+                    account.get('include', args.include),
+                    account.get('exclude', args.exclude),
+                )
+        except (IOError, ValueError) as e:
+            sys.stderr.write('cloudprint: {0}\n'.format(e))
+            sys.exit(1)
+        # one pool of connections to cloud print, whichever account uses it
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+        )
+    else:
+        accounts = [{
+            'auth': args.authfile,
+            'journal': args.journal,
+            'filter': printer_filter,
+        }]
+
+    cpps = []
+    for account in accounts:
+        auth = CloudPrintAuth(
+            account['auth'],
+            pool_size=pool_size,
+            keepalive=args.keepalive,
+            adapter=adapter,
+        )
+        cpp = CloudPrintProxy(auth)
+
+        cpp.sleeptime = POLL_PERIOD
+        if args.fastpoll:
+            cpp.sleeptime = FAST_POLL_PERIOD
+
+        cpp.registry.refresh_period = args.registry_refresh
+        cpp.retries = retry.RetryScheduler(args.retries, args.retry_delay)
+        cpp.stream_jobs = args.stream
+        cpp.chunk_size = args.chunk_size
+        cpp.printer_filter = account['filter']
+        cpp.site = account.get('site', args.site)
+        cpps.append(cpp)
+
     if args.logout:
-        auth.delete()
+        for cpp in cpps:
+            cpp.auth.delete()
         LOGGER.info('logged out')
         return
 
-    cups_connection = cups.Connection()
-    cpp = CloudPrintProxy(auth)
-
-    cpp.sleeptime = POLL_PERIOD
-    if args.fastpoll:
-        cpp.sleeptime = FAST_POLL_PERIOD
-
-    cpp.include = args.include
-    cpp.exclude = args.exclude
-    cpp.site = args.site
+    # survives cupsd restarting underneath us
+    cups_connection = cupspool.ReconnectingConnection()
 
     printers = list(cups_connection.getPrinters().keys())
     if not printers:
         LOGGER.error('No printers found')
         return
 
-    if auth.no_auth():
-        name = printers[0]
-        ppd, description = get_printer_info(cups_connection, name)
-        auth.login(name, description, ppd)
-    else:
-        auth.load()
+    for cpp in cpps:
+        if cpp.auth.no_auth():
+            name = printers[0]
+            ppd, description = get_printer_info(cups_connection, name)
+            cpp.auth.login(name, description, ppd)
+        else:
+            cpp.auth.load()
 
-    sync_printers(cups_connection, cpp)
+        sync_printers(cups_connection, cpp)
 
     if args.authonly:
         sys.exit(0)
 
+    if args.use_async:
+        try:
+            from cloudprint import aio
+        except ImportError:
+            print('aiohttp module required for --async')
+            print('\tpip install aiohttp')
+            sys.exit(1)
+
+    def run():
+        # opened here rather than earlier so the database isn't carried
+        # across the fork into the daemon
+        leases = None
+        if args.lease_file:
+            leases = lease.SQLiteLeases(args.lease_file, ttl=args.lease_ttl)
+        tracer = tracing.Tracer(
+            args.trace_file, args.trace_sample, args.trace_slow
+        )
+        tracker = None
+        if args.track_completion:
+            tracker = completion.CompletionTracker(poll=args.completion_poll)
+        for cpp, account in zip(cpps, accounts):
+            cpp.journal = journal.JobJournal(account['journal'])
+            cpp.leases = leases
+            cpp.tracer = tracer
+            if args.ack_threads:
+                cpp.acks = ack.Acknowledger(cpp, args.ack_threads)
+            cpp.completions = tracker
+        if args.metrics_port:
+            metrics.serve(args.metrics_port)
+        if args.metrics_file:
+            metrics.start_dumper(args.metrics_file)
+
+        if args.use_async:
+            aio.run(cpps[0], args.workers, args.printer_workers)
+        elif args.accounts:
+            MultiAccountLoop(
+                cups_connection,
+                cpps,
+                job_executor_for(args.workers, args.printer_workers),
+            ).run()
+        else:
+            process_jobs(
+                cups_connection, cpps[0], args.workers, args.printer_workers
+            )
+
     if args.daemon:
         try:
             import daemon
@@ -631,10 +1791,10 @@ def main():
             timeout=5,
         )
         with daemon.DaemonContext(pidfile=pidfile):
-            process_jobs(cups_connection, cpp)
+            run()
 
     else:
-        process_jobs(cups_connection, cpp)
+        run()
 
 
 if __name__ == '__main__':
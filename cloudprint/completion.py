@@ -0,0 +1,238 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+from __future__ import absolute_import
+
+import cups
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+try:
+    from cloudprint import ack
+    from cloudprint import cupspool
+    from cloudprint import metrics
+except Exception:
+    import ack
+    import cupspool
+    import metrics
+
+LOGGER = logging.getLogger('cloudprint.completion')
+
+# how often, in seconds, cupsd is asked for the jobs that ended
+COMPLETION_POLL = 5.0
+
+# lifetime, in seconds, asked of cupsd for the subscription; it is renewed
+# once half of it has gone
+SUBSCRIPTION_LEASE = 3600
+
+# job ends seen before the job was tracked, kept in case track() follows
+EARLY_ENDS = 1024
+
+
+def status_for_state(job_state):
+    """The cloud status of a CUPS job in job_state, or None if it is still
+    going"""
+    if job_state == cups.IPP_JOB_COMPLETED:
+        return ack.DONE
+    if job_state in (cups.IPP_JOB_CANCELED, cups.IPP_JOB_ABORTED):
+        return ack.ERROR
+    return None
+
+
+class CompletionTracker(object):
+    """Tells the cloud a job is DONE when CUPS has finished printing it,
+    rather than when CUPS accepted it, and ERROR if CUPS aborted it or it
+    was cancelled.
+
+    A single IPP subscription to job-completed events, made once, covers
+    every job: each poll is one getNotifications call however many jobs
+    are outstanding. Jobs submitted to CUPS are tracked by their CUPS job
+    id. If events may have been missed, because the subscription was lost
+    or cupsd dropped some, the tracked jobs are looked up with two getJobs
+    calls instead. One tracker can serve every account.
+
+    Only the end of a job is taken from CUPS: IN_PROGRESS is reported by
+    process_job as soon as CUPS has accepted the job, before it is
+    tracked."""
+
+    def __init__(self, connection=None, poll=COMPLETION_POLL,
+                 lease=SUBSCRIPTION_LEASE):
+        self.connection = connection or cupspool.ReconnectingConnection()
+        self.poll = poll
+        self.lease = lease
+
+        self._lock = threading.Lock()
+        # CUPS job id -> (cpp, cloud job id, printer name)
+        self._jobs = {}
+        self._tracked_ids = set()
+        # CUPS job id -> job-state, for jobs that ended before track()
+        self._early = OrderedDict()
+
+        self._subscription = None
+        self._renew_at = 0
+        self._sequence = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def track(self, cups_job_id, cpp, job_id, printer_name=None):
+        """Report job_id of cpp once CUPS job cups_job_id ends"""
+        with self._lock:
+            job_state = self._early.pop(cups_job_id, None)
+            if job_state is None:
+                self._jobs[cups_job_id] = (cpp, job_id, printer_name)
+                self._tracked_ids.add(job_id)
+                return
+        self._report(cpp, job_id, printer_name, job_state)
+
+    def is_tracking(self, job_id):
+        with self._lock:
+            return job_id in self._tracked_ids
+
+    def __len__(self):
+        with self._lock:
+            return len(self._jobs)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='cloudprint-completion',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                self.poll_once()
+            except Exception:
+                LOGGER.exception('Could not check on CUPS jobs')
+                # start over; anything that ended meanwhile is found by
+                # the resync
+                self._subscription = None
+            if self._stop.wait(self.poll):
+                return
+
+    def poll_once(self, now=None):
+        """Subscribe if need be, then report the jobs that ended since the
+        last call"""
+        if now is None:
+            now = time.time()
+        if self._subscription is None:
+            self._subscribe(now)
+            self.resync()
+            return
+        if now >= self._renew_at:
+            self.connection.renewSubscription(self._subscription, self.lease)
+            self._renew_at = now + self.lease / 2
+
+        try:
+            notifications = self.connection.getNotifications(
+                [self._subscription], [self._sequence + 1],
+            )
+        except cups.IPPError as e:
+            # cupsd no longer has the subscription
+            if e.args and e.args[0] == cups.IPP_NOT_FOUND:
+                LOGGER.info('CUPS dropped the job subscription, renewing')
+                self._subscription = None
+                return
+            raise
+
+        missed = False
+        for event in notifications.get('events', []):
+            sequence = event.get('notify-sequence-number', 0)
+            if sequence <= self._sequence:
+                continue
+            if sequence > self._sequence + 1:
+                missed = True
+            self._sequence = sequence
+            self._ended(
+                event.get('notify-job-id'), event.get('job-state'),
+            )
+        if missed:
+            LOGGER.info('Missed CUPS job events, checking every job')
+            self.resync()
+
+    def _subscribe(self, now):
+        self._subscription = self.connection.createSubscription(
+            'ipp://localhost/',
+            events=['job-completed'],
+            lease_duration=self.lease,
+        )
+        self._renew_at = now + self.lease / 2
+        self._sequence = 0
+
+    def resync(self):
+        """Look the tracked jobs up directly, for when events may have been
+        missed. Jobs cupsd has forgotten altogether are taken to be done."""
+        with self._lock:
+            if not self._jobs:
+                return
+        ended = self.connection.getJobs(
+            which_jobs='completed',
+            requested_attributes=['job-id', 'job-state'],
+        )
+        going = self.connection.getJobs(
+            which_jobs='not-completed',
+            requested_attributes=['job-id'],
+        )
+        with self._lock:
+            tracked = list(self._jobs)
+        for cups_job_id in tracked:
+            if cups_job_id in ended:
+                self._ended(
+                    cups_job_id, ended[cups_job_id].get('job-state'),
+                )
+            elif cups_job_id not in going:
+                self._ended(cups_job_id, cups.IPP_JOB_COMPLETED)
+
+    def _ended(self, cups_job_id, job_state):
+        if status_for_state(job_state) is None:
+            return
+        with self._lock:
+            job = self._jobs.pop(cups_job_id, None)
+            if job is None:
+                self._early[cups_job_id] = job_state
+                while len(self._early) > EARLY_ENDS:
+                    self._early.popitem(last=False)
+                return
+            self._tracked_ids.discard(job[1])
+        self._report(job[0], job[1], job[2], job_state)
+
+    def _report(self, cpp, job_id, printer_name, job_state):
+        status = status_for_state(job_state)
+        outcome = 'done' if status == ack.DONE else 'error'
+        if printer_name is not None:
+            metrics.JOBS.labels(printer_name, outcome).inc()
+        try:
+            if status == ack.ERROR:
+                LOGGER.error('CUPS could not print job %s', job_id)
+                cpp.journal.failed(job_id)
+            ack.report(cpp, job_id, status, printer_name)
+        except Exception:
+            # still in the journal; acknowledged after a restart
+            LOGGER.exception('Could not acknowledge job %s', job_id)
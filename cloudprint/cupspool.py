@@ -0,0 +1,160 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+from __future__ import absolute_import
+
+import contextlib
+import cups
+import logging
+import socket
+import threading
+import time
+
+try:
+    from cloudprint import metrics
+except Exception:
+    import metrics
+
+LOGGER = logging.getLogger('cloudprint.cupspool')
+
+# connections kept to cupsd when no size is given
+CUPS_POOL_SIZE = 4
+
+# seconds a pooled connection may sit idle before it is checked on checkout
+CUPS_IDLE_CHECK = 30.0
+
+# operations that are sent again on a new connection after a transport
+# error, because they only read. Anything that submits a job is not: cupsd
+# may have queued it before the connection went, so sending it again could
+# print it twice. That job fails instead and goes through the journaled
+# retry.
+RETRY_SAFE = frozenset([
+    'getDefault',
+    'getPPD',
+    'getPrinterAttributes',
+    'getPrinters',
+])
+
+
+def is_transport_error(error):
+    """True if error came from losing the connection to cupsd, such as when
+    it restarts, rather than from cupsd refusing the request"""
+    if isinstance(error, cups.HTTPError):
+        return True
+    if isinstance(error, cups.IPPError):
+        # what libcups reports when it couldn't get through to cupsd at
+        # all, rather than cupsd turning the request down
+        return bool(error.args) and \
+            error.args[0] == cups.IPP_SERVICE_UNAVAILABLE
+    # cups.Connection() raises RuntimeError when cupsd is unreachable
+    return isinstance(error, (RuntimeError, socket.error))
+
+
+class ReconnectingConnection(object):
+    """A cups.Connection that opens a new connection after a transport
+    error, and sends RETRY_SAFE operations again on it once.
+
+    It is used exactly like the connection it wraps. The connection is
+    opened on first use, so making one never fails."""
+
+    def __init__(self, factory=None):
+        self._factory = factory or cups.Connection
+        self._connection = None
+        self.last_used = time.time()
+
+    def _get(self):
+        if self._connection is None:
+            self._connection = self._factory()
+        return self._connection
+
+    def reconnect(self):
+        """Drop the connection; the next call opens a new one"""
+        self._connection = None
+        metrics.CUPS_RECONNECTS.inc()
+
+    def check(self):
+        """Make sure cupsd still answers, dropping the connection if not"""
+        try:
+            self._get().getDefault()
+        except Exception as e:
+            if is_transport_error(e):
+                LOGGER.info('CUPS connection went stale, reconnecting')
+                self.reconnect()
+
+    def __getattr__(self, name):
+        attr = getattr(self._get(), name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            try:
+                return getattr(self._get(), name)(*args, **kwargs)
+            except Exception as e:
+                if not is_transport_error(e):
+                    raise
+                self.reconnect()
+                if name not in RETRY_SAFE:
+                    raise
+                LOGGER.info('Lost the CUPS connection, sending %s again', name)
+            return getattr(self._get(), name)(*args, **kwargs)
+        return call
+
+
+class ConnectionPool(object):
+    """CUPS connections for the threads that talk to cupsd.
+
+    pycups connections aren't thread safe, so each is checked out by one
+    thread at a time; at most size are ever open. Connections are
+    ReconnectingConnections, and one that sat idle for idle_check seconds
+    is checked on checkout, so a cupsd restart costs a reconnect instead of
+    failed jobs."""
+
+    def __init__(self, factory=None, size=CUPS_POOL_SIZE,
+                 idle_check=CUPS_IDLE_CHECK):
+        self._factory = factory
+        self.size = size
+        self.idle_check = idle_check
+        self._cond = threading.Condition()
+        self._idle = []
+        self._count = 0
+
+    def checkout(self):
+        """A connection for this thread alone, until it is checked in"""
+        with self._cond:
+            while not self._idle and self._count >= self.size:
+                self._cond.wait()
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                self._count += 1
+                return ReconnectingConnection(self._factory)
+
+        if time.time() - connection.last_used > self.idle_check:
+            connection.check()
+        return connection
+
+    def checkin(self, connection):
+        connection.last_used = time.time()
+        with self._cond:
+            self._idle.append(connection)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self.checkout()
+        try:
+            yield connection
+        finally:
+            self.checkin(connection)
@@ -0,0 +1,146 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+from __future__ import absolute_import
+
+import logging
+import threading
+
+from collections import deque, OrderedDict
+
+try:
+    from cloudprint import cupspool
+except Exception:
+    import cupspool
+
+LOGGER = logging.getLogger('cloudprint.executor')
+
+
+class JobExecutor(object):
+    """Run print jobs on a pool of worker threads.
+
+    Jobs for one printer start in the order they were submitted, with at most
+    per_printer of them running at once. Jobs for different printers run side
+    by side, up to workers in total, so one slow job only holds up its own
+    printer.
+
+    Each job runs on a CUPS connection checked out of connections, a
+    cupspool.ConnectionPool, or of a pool of connection_factory's
+    connections if that is given instead."""
+
+    def __init__(self, process, workers=4, per_printer=1,
+                 connection_factory=None, connections=None):
+        self._process = process
+        if connections is None and connection_factory is not None:
+            connections = cupspool.ConnectionPool(
+                connection_factory, size=workers,
+            )
+        self._connections = connections
+        self.workers = workers
+        self.per_printer = per_printer
+
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()
+        self._active = {}
+        self._pending = set()
+        self._stopping = False
+
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(
+                target=self._work,
+                name='cloudprint-worker-%d' % i,
+            )
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, cpp, printer, job):
+        """Queue a job behind any others for the same printer. Returns False
+        if the job is already queued or running."""
+        with self._cond:
+            if job['id'] in self._pending:
+                return False
+            self._pending.add(job['id'])
+            self._queues.setdefault(printer.id, deque()).append(
+                (cpp, printer, job)
+            )
+            self._cond.notify()
+            return True
+
+    def pending(self):
+        """Number of jobs queued or running."""
+        with self._cond:
+            return len(self._pending)
+
+    def join(self, timeout=None):
+        """Wait until every submitted job has finished"""
+        with self._cond:
+            while self._pending:
+                if not self._cond.wait(timeout) and timeout is not None:
+                    return False
+        return True
+
+    def stop(self, wait=True):
+        """Finish the queued jobs, then shut the workers down"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _next(self):
+        for printer_id, queue in self._queues.items():
+            if self._active.get(printer_id, 0) >= self.per_printer:
+                continue
+
+            item = queue.popleft()
+            # rotate the printer to the back so every printer gets a turn
+            del self._queues[printer_id]
+            if queue:
+                self._queues[printer_id] = queue
+            self._active[printer_id] = self._active.get(printer_id, 0) + 1
+            return printer_id, item
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    task = self._next()
+                    if task is not None:
+                        break
+                    if self._stopping and not self._queues:
+                        return
+                    self._cond.wait()
+
+            printer_id, (cpp, printer, job) = task
+            connection = None
+            try:
+                if self._connections is not None:
+                    connection = self._connections.checkout()
+                self._process(connection, cpp, printer, job)
+            except Exception:
+                LOGGER.exception('Error processing job %s', job['id'])
+            finally:
+                if connection is not None:
+                    self._connections.checkin(connection)
+                with self._cond:
+                    self._active[printer_id] -= 1
+                    if not self._active[printer_id]:
+                        del self._active[printer_id]
+                    self._pending.discard(job['id'])
+                    self._cond.notify_all()
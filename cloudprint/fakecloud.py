@@ -0,0 +1,366 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+"""A local stand-in for the cloud print service, for tests and benchmarks.
+
+It speaks the parts of the API the proxy uses (list, register, update,
+delete, fetch, control, plus the document and ticket URLs of each job)
+over plain HTTP on 127.0.0.1, and can be made slow, narrow or unreliable.
+Point the proxy at it by setting cloudprint.PRINT_CLOUD_URL to its url.
+"""
+
+from __future__ import absolute_import
+
+import datetime
+import json
+import random
+import socket
+import sys
+import threading
+import time
+import uuid
+
+from collections import OrderedDict
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+# bytes written at a time when serving a document
+WRITE_SIZE = 16 * 1024
+
+QUEUED = 'QUEUED'
+DONE = 'DONE'
+ERROR = 'ERROR'
+
+
+def authorize(auth, proxy='proxy'):
+    """Give a CloudPrintAuth a token the fake service accepts, so it never
+    tries to reach google"""
+    tomorrow = datetime.datetime.now() + datetime.timedelta(days=1)
+    auth.guid = proxy
+    auth.xmpp_jid = proxy + '@example.com'
+    auth._access_token = 'fake-token'
+    auth.exp_time = tomorrow
+    auth.token_expiry = tomorrow
+    return auth
+
+
+class FakeJob(object):
+    def __init__(self, job_id, printer_id, size):
+        self.id = job_id
+        self.printer_id = printer_id
+        self.size = size
+        self.status = QUEUED
+        self.created = time.time()
+        self.finished = None
+
+    def as_json(self, url):
+        return {
+            'id': self.id,
+            'printerid': self.printer_id,
+            'title': 'job ' + self.id,
+            'ownerId': 'owner@example.com',
+            'status': self.status,
+            'updateTime': str(int(self.created * 1000)),
+            'fileUrl': url + 'download/' + self.id,
+            'ticketUrl': url + 'ticket/' + self.id,
+        }
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # the proxy's connection pool can open many connections at once
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # a client hanging up on a kept-alive connection is nothing to
+        # report
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body go out in separate writes; without this Nagle
+        # holds the body back for the client's delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def cloud(self):
+        return self.server.cloud
+
+    def _send(self, code, body, content_type='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, obj):
+        self._send(200, json.dumps(obj).encode('utf-8'))
+
+    def _handle(self, form):
+        path = urlparse(self.path).path.strip('/')
+        endpoint, _, arg = path.partition('/')
+        self.cloud._count(endpoint)
+
+        if self.cloud.latency:
+            time.sleep(self.cloud.latency)
+        if self.cloud._should_fail(endpoint):
+            self._send(500, b'injected error', 'text/plain')
+            return
+
+        handler = getattr(self.cloud, '_api_' + endpoint, None)
+        if handler is None:
+            self._send(404, b'not found', 'text/plain')
+            return
+        handler(self, arg, form)
+
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8')
+        form = dict((k, v[0]) for k, v in parse_qs(body).items())
+        self._handle(form)
+
+
+class FakeCloudPrint(object):
+    """The cloud print service, in a thread.
+
+    latency is added to every request, in seconds. bandwidth, in bytes per
+    second, caps how fast each document is served. error_rate is the share
+    of requests answered with a 500, limited to the endpoints named in
+    error_endpoints if that is given. document_size is the size of the
+    documents of jobs added without one."""
+
+    def __init__(self, latency=0.0, bandwidth=None, error_rate=0.0,
+                 error_endpoints=None, document_size=1024, seed=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_endpoints = error_endpoints
+        self.document_size = document_size
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._finished = threading.Condition(self._lock)
+        self.printers = OrderedDict()
+        self.jobs = OrderedDict()
+        self.requests = {}
+
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{0}:{1}/'.format(host, port)
+
+    def start(self):
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.cloud = self
+        self._thread = threading.Thread(
+            target=self._server.serve_forever,
+            name='fake-cloudprint',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def add_printer(self, name, proxy='proxy', **fields):
+        """Register a printer directly, as if a proxy had. Returns its id."""
+        printer_id = str(uuid.uuid4())
+        printer = {
+            'id': printer_id,
+            'name': name,
+            'proxy': proxy,
+            'description': fields.pop('description', ''),
+            'capsHash': fields.pop('capsHash', ''),
+        }
+        printer.update(fields)
+        with self._lock:
+            self.printers[printer_id] = printer
+        return printer_id
+
+    def add_jobs(self, printer_id, count=1, size=None):
+        """Queue count jobs on a printer. Returns their ids."""
+        if size is None:
+            size = self.document_size
+        job_ids = []
+        with self._lock:
+            for _ in range(count):
+                job = FakeJob(str(uuid.uuid4()), printer_id, size)
+                self.jobs[job.id] = job
+                job_ids.append(job.id)
+        return job_ids
+
+    def wait_for_jobs(self, job_ids, timeout=None):
+        """Wait until every job in job_ids is DONE or ERROR. Returns False
+        if the timeout ran out first."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._finished:
+            while any(self.jobs[j].status == QUEUED for j in job_ids):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._finished.wait(remaining)
+        return True
+
+    def job_latencies(self, job_ids=None):
+        """Seconds from queueing to acknowledgement of each finished job"""
+        with self._lock:
+            jobs = [self.jobs[j] for j in job_ids] if job_ids \
+                else list(self.jobs.values())
+            return [
+                job.finished - job.created
+                for job in jobs if job.finished is not None
+            ]
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def _should_fail(self, endpoint):
+        if not self.error_rate:
+            return False
+        if self.error_endpoints is not None and \
+                endpoint not in self.error_endpoints:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _api_list(self, handler, arg, form):
+        with self._lock:
+            printers = [
+                dict(p) for p in self.printers.values()
+                if p['proxy'] == form.get('proxy')
+            ]
+        handler._send_json({'success': True, 'printers': printers})
+
+    def _printer_fields(self, form):
+        return {
+            'name': form.get('printer'),
+            'description': form.get('description', ''),
+            'capsHash': form.get('capsHash', ''),
+        }
+
+    def _api_register(self, handler, arg, form):
+        printer_id = self.add_printer(
+            proxy=form.get('proxy'), **self._printer_fields(form)
+        )
+        handler._send_json({'success': True, 'printers': [
+            self.printers[printer_id]
+        ]})
+
+    def _api_update(self, handler, arg, form):
+        with self._lock:
+            printer = self.printers.get(form.get('printerid'))
+            if printer is not None:
+                printer.update(self._printer_fields(form))
+        handler._send_json({'success': printer is not None})
+
+    def _api_delete(self, handler, arg, form):
+        with self._lock:
+            printer = self.printers.pop(form.get('printerid'), None)
+        handler._send_json({'success': printer is not None})
+
+    def _api_fetch(self, handler, arg, form):
+        printer_id = form.get('printerid')
+        with self._lock:
+            if printer_id not in self.printers:
+                handler._send_json({'success': False, 'errorCode': 111})
+                return
+            jobs = [
+                job.as_json(self.url) for job in self.jobs.values()
+                if job.printer_id == printer_id and job.status == QUEUED
+            ]
+        if not jobs:
+            handler._send_json({
+                'success': False,
+                'errorCode': 413,
+                'message': 'No print job available on specified printer.',
+            })
+            return
+        handler._send_json({'success': True, 'jobs': jobs})
+
+    def _api_control(self, handler, arg, form):
+        with self._finished:
+            job = self.jobs.get(form.get('jobid'))
+            status = form.get('status')
+            # IN_PROGRESS is only a courtesy; the job is still to be ended
+            if job is not None and job.status == QUEUED and \
+                    status in (DONE, ERROR):
+                job.status = status
+                job.finished = time.time()
+                self._finished.notify_all()
+        handler._send_json({'success': job is not None})
+
+    def _api_ticket(self, handler, arg, form):
+        handler._send_json({'copies': 1, 'collate': True})
+
+    def _api_download(self, handler, arg, form):
+        with self._lock:
+            job = self.jobs.get(arg)
+        if job is None:
+            handler._send(404, b'no such job', 'text/plain')
+            return
+
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'application/pdf')
+        handler.send_header('Content-Length', str(job.size))
+        handler.end_headers()
+
+        chunk = b'%' * WRITE_SIZE
+        remaining = job.size
+        start = time.time()
+        sent = 0
+        while remaining:
+            data = chunk[:min(remaining, WRITE_SIZE)]
+            handler.wfile.write(data)
+            remaining -= len(data)
+            sent += len(data)
+            if self.bandwidth:
+                ahead = sent / float(self.bandwidth) - (time.time() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
@@ -0,0 +1,333 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+"""A local stand-in for talk.google.com, for tests and benchmarks.
+
+It speaks the server half of the handshake XmppConnection.connect goes
+through (TLS, SASL X-OAUTH2, bind, session and the google:push
+subscription) and can then push notifications, drop connections and be
+made slow to answer. Point the proxy at it by setting
+cloudprint.XMPP_SERVER_HOST and XMPP_SERVER_PORT to its address.
+"""
+
+from __future__ import absolute_import
+
+import base64
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+
+from xml.etree.ElementTree import Element, XMLParser
+
+from cloudprint import xmpp
+
+SASL_NS = 'urn:ietf:params:xml:ns:xmpp-sasl'
+BIND_NS = 'urn:ietf:params:xml:ns:xmpp-bind'
+SESSION_NS = 'urn:ietf:params:xml:ns:xmpp-session'
+PUSH_NS = 'google:push'
+
+STREAM_HEADER = (
+    '<stream:stream from="gmail.com" id="%d" version="1.0" '
+    'xmlns:stream="http://etherx.jabber.org/streams" '
+    'xmlns="jabber:client">'
+)
+AUTH_FEATURES = (
+    '<stream:features>'
+    '<mechanisms xmlns="urn:ietf:params:xml:ns:xmpp-sasl">'
+    '<mechanism>X-OAUTH2</mechanism>'
+    '</mechanisms>'
+    '</stream:features>'
+)
+BIND_FEATURES = (
+    '<stream:features>'
+    '<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind"/>'
+    '<session xmlns="urn:ietf:params:xml:ns:xmpp-session"/>'
+    '</stream:features>'
+)
+SUCCESS = '<success xmlns="urn:ietf:params:xml:ns:xmpp-sasl"/>'
+FAILURE = (
+    '<failure xmlns="urn:ietf:params:xml:ns:xmpp-sasl">'
+    '<not-authorized/>'
+    '</failure>'
+)
+BOUND = (
+    '<iq type="result" id="%s">'
+    '<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind">'
+    '<jid>%s/cloud_print%d</jid>'
+    '</bind>'
+    '</iq>'
+)
+RESULT = '<iq type="result" id="%s"/>'
+PUSH = (
+    '<message from="cloudprint.google.com" to="%s">'
+    '<push:push channel="cloudprint.google.com" xmlns:push="google:push">'
+    '<push:recipient to="%s"></push:recipient>'
+    '<push:data>%s</push:data>'
+    '</push:push>'
+    '</message>'
+)
+
+
+def self_signed_cert(directory):
+    """Make a throwaway key and certificate with openssl. Returns their
+    paths."""
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call([
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-days', '1', '-subj', '/CN=localhost',
+            '-keyout', keyfile, '-out', certfile,
+        ], stdout=devnull, stderr=devnull)
+    return certfile, keyfile
+
+
+class _ServerHandler(xmpp.XmppXmlHandler):
+    """The proxy's own stanza splitter, also handing out an empty
+    <stream:stream> element whenever the client opens a stream"""
+
+    def start(self, tag, attrib):
+        if tag == self.STREAM_TAG:
+            self._results.append(Element(tag))
+            return
+        super(_ServerHandler, self).start(tag, attrib)
+
+
+class FakeClient(object):
+    """One client connection to the FakeXmppServer"""
+
+    def __init__(self, server, sock, number):
+        self.server = server
+        self.sock = sock
+        self.number = number
+        self.jid = None
+        self.token = None
+        self.subscribed = False
+        self.keepalive_times = []
+        self._write_lock = threading.Lock()
+
+    def send(self, data):
+        with self._write_lock:
+            self.sock.sendall(data.encode('utf-8'))
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        self.sock.close()
+
+
+class FakeXmppServer(object):
+    """talk.google.com, in a thread.
+
+    response_delay, in seconds, is waited before every answer during the
+    handshake. If tokens is given, only those access tokens are let in."""
+
+    def __init__(self, response_delay=0.0, tokens=None, certfile=None,
+                 keyfile=None):
+        self.response_delay = response_delay
+        self.tokens = tokens
+        self._tmpdir = None
+        if certfile is None:
+            self._tmpdir = tempfile.mkdtemp()
+            certfile, keyfile = self_signed_cert(self._tmpdir)
+        # PROTOCOL_TLS_SERVER is python 3.6 and up
+        self._context = ssl.SSLContext(
+            getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23)
+        )
+        self._context.load_cert_chain(certfile, keyfile)
+
+        self._lock = threading.Condition()
+        self._clients = []
+        self._count = 0
+        self.keepalives = 0
+        self.subscriptions = 0
+        self._listener = None
+        self._thread = None
+
+    @property
+    def address(self):
+        return self._listener.getsockname()[:2]
+
+    def start(self):
+        self._listener = socket.socket()
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(('127.0.0.1', 0))
+        self._listener.listen(16)
+        self._thread = threading.Thread(
+            target=self._accept,
+            name='fake-xmpp',
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        self.drop_connections()
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def clients(self):
+        """The clients that have subscribed to push notifications"""
+        with self._lock:
+            return [c for c in self._clients if c.subscribed]
+
+    def wait_for_subscribers(self, count=1, timeout=None):
+        """Wait until count clients are subscribed. Returns False if the
+        timeout ran out first."""
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while len([c for c in self._clients if c.subscribed]) < count:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self._lock.wait(remaining)
+        return True
+
+    def push(self, printer_id):
+        """Notify every subscribed client about printer_id. Returns the time
+        the notification was sent."""
+        data = base64.b64encode(printer_id.encode('utf-8')).decode('ascii')
+        sent = time.time()
+        for client in self.clients():
+            try:
+                client.send(PUSH % (client.jid, client.jid, data))
+            except Exception:
+                client.close()
+        return sent
+
+    def push_at_rate(self, printer_ids, rate):
+        """Push a notification for each of printer_ids, rate per second, from
+        a background thread. Returns the thread."""
+        def run():
+            for i, printer_id in enumerate(printer_ids):
+                delay = start + i / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self.push(printer_id)
+
+        start = time.time()
+        thread = threading.Thread(target=run, name='fake-xmpp-pusher')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def drop_connections(self):
+        """Hang up on every client, as a server restart would"""
+        with self._lock:
+            clients, self._clients = self._clients, []
+        for client in clients:
+            client.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self._listener.accept()
+            except Exception:
+                return
+            thread = threading.Thread(
+                target=self._serve,
+                args=(sock,),
+                name='fake-xmpp-client',
+            )
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, sock):
+        # answers are small and each one is waited for
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock = self._context.wrap_socket(sock, server_side=True)
+        except Exception:
+            sock.close()
+            return
+
+        with self._lock:
+            self._count += 1
+            client = FakeClient(self, sock, self._count)
+            self._clients.append(client)
+
+        handler = _ServerHandler()
+        parser = XMLParser(target=handler)
+        try:
+            while True:
+                data = sock.recv(16384)
+                if not data:
+                    break
+                if not data.strip():
+                    client.keepalive_times.append(time.time())
+                    with self._lock:
+                        self.keepalives += 1
+                    continue
+                parser.feed(data)
+                for event in iter(handler.get_elem, None):
+                    if self.response_delay:
+                        time.sleep(self.response_delay)
+                    self._respond(client, event)
+        except Exception:
+            pass
+        finally:
+            with self._lock:
+                if client in self._clients:
+                    self._clients.remove(client)
+                self._lock.notify_all()
+            client.close()
+
+    def _respond(self, client, event):
+        if event.tag == _ServerHandler.STREAM_TAG:
+            header = STREAM_HEADER % client.number
+            if client.token is None:
+                client.send(header + AUTH_FEATURES)
+            else:
+                client.send(header + BIND_FEATURES)
+            return
+
+        if event.tag == '{%s}auth' % SASL_NS:
+            auth = base64.b64decode(event.text or '').decode('utf-8')
+            _, jid, token = auth.split('\0')
+            if self.tokens is not None and token not in self.tokens:
+                client.send(FAILURE)
+                raise Exception('bad token')
+            client.jid = jid
+            client.token = token
+            client.send(SUCCESS)
+        elif event.find('{%s}bind' % BIND_NS) is not None:
+            client.send(BOUND % (event.get('id'), client.jid, client.number))
+        elif event.find('{%s}session' % SESSION_NS) is not None:
+            client.send(RESULT % event.get('id'))
+        elif event.find('{%s}subscribe' % PUSH_NS) is not None:
+            client.send(RESULT % event.get('id'))
+            with self._lock:
+                client.subscribed = True
+                self.subscriptions += 1
+                self._lock.notify_all()
@@ -0,0 +1,73 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+from __future__ import absolute_import
+
+import threading
+
+from collections import OrderedDict
+
+# how many finished jobs are remembered
+COMPLETED_SIZE = 1024
+
+
+def job_key(job):
+    """A job is the same job until the cloud changes it"""
+    return job['id'], job.get('updateTime')
+
+
+class JobTracker(object):
+    """The jobs being worked on, and the ones finished lately.
+
+    The poll, XMPP notifications and retries can all turn up a job that is
+    already being printed, or one that was just finished but whose fetch
+    raced the acknowledgement. Every source claims a job here before
+    touching it and drops it if the claim fails, so it is downloaded
+    once."""
+
+    def __init__(self, completed_size=COMPLETED_SIZE):
+        self.completed_size = completed_size
+        self._lock = threading.Lock()
+        self._inflight = set()
+        self._completed = OrderedDict()
+
+    def claim(self, job):
+        """Mark job in flight. Returns False if it already is, or if this
+        version of it has been finished."""
+        key = job_key(job)
+        with self._lock:
+            if job['id'] in self._inflight or key in self._completed:
+                return False
+            self._inflight.add(job['id'])
+            return True
+
+    def release(self, job, completed=False):
+        """job is no longer being worked on; completed if the cloud has been
+        told how it ended"""
+        key = job_key(job)
+        with self._lock:
+            self._inflight.discard(job['id'])
+            if completed:
+                self._completed[key] = True
+                while len(self._completed) > self.completed_size:
+                    self._completed.popitem(last=False)
+
+    def is_inflight(self, job_id):
+        with self._lock:
+            return job_id in self._inflight
+
+    def __len__(self):
+        with self._lock:
+            return len(self._inflight)
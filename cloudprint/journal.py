@@ -0,0 +1,133 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+from __future__ import absolute_import
+
+import sqlite3
+import threading
+import time
+
+# job states, in the order a job goes through them; a job that can't be
+# printed goes from FETCHED to FAILED instead of SUBMITTED
+FETCHED = 'fetched'
+SUBMITTED = 'submitted'
+FAILED = 'failed'
+ACKNOWLEDGED = 'acknowledged'
+
+# how long, in seconds, acknowledged jobs are remembered
+JOURNAL_KEEP = 7 * 24 * 3600
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS jobs ('
+    'job_id TEXT PRIMARY KEY, '
+    'printer_id TEXT, '
+    'state TEXT NOT NULL, '
+    'cups_job_id INTEGER, '
+    'updated REAL NOT NULL)'
+)
+
+
+class JobJournal(object):
+    """Record of where each job got to, kept in SQLite so it outlives the
+    process.
+
+    A job that reached CUPS but was never acknowledged to the cloud is
+    still queued there, and would be printed a second time after a
+    restart. The journal lets the job loop spot those and acknowledge them
+    instead. The database runs in WAL mode without a sync per commit, so a
+    state change costs a write to the log rather than an fsync; a power
+    cut can lose the last few, a crash of the daemon can't."""
+
+    def __init__(self, path=':memory:'):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(SCHEMA)
+
+    def _set(self, job_id, state, printer_id=None, cups_job_id=None):
+        now = time.time()
+        with self._lock:
+            cursor = self._db.execute(
+                'UPDATE jobs SET state = ?, '
+                'printer_id = COALESCE(?, printer_id), '
+                'cups_job_id = COALESCE(?, cups_job_id), updated = ? '
+                'WHERE job_id = ?',
+                (state, printer_id, cups_job_id, now, job_id),
+            )
+            if not cursor.rowcount:
+                self._db.execute(
+                    'INSERT INTO jobs VALUES (?, ?, ?, ?, ?)',
+                    (job_id, printer_id, state, cups_job_id, now),
+                )
+
+    def fetched(self, job_id, printer_id):
+        """The job is about to be downloaded"""
+        self._set(job_id, FETCHED, printer_id=printer_id)
+
+    def submitted(self, job_id, cups_job_id):
+        """CUPS has the job, as cups_job_id"""
+        self._set(job_id, SUBMITTED, cups_job_id=cups_job_id)
+
+    def failed(self, job_id):
+        """The job was given up on, and is to be reported as an error"""
+        self._set(job_id, FAILED)
+
+    def acknowledged(self, job_id):
+        """The cloud has been told the job is finished"""
+        self._set(job_id, ACKNOWLEDGED)
+
+    def state(self, job_id):
+        """The last state recorded for job_id, or None"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT state FROM jobs WHERE job_id = ?', (job_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def cups_job_id(self, job_id):
+        """The CUPS job id job_id was submitted as, or None"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT cups_job_id FROM jobs WHERE job_id = ?', (job_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def pending_acks(self):
+        """(job id, printer id, state) of every job that was submitted to
+        CUPS or failed but whose end was never acknowledged"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT job_id, printer_id, state FROM jobs '
+                'WHERE state IN (?, ?) ORDER BY updated',
+                (SUBMITTED, FAILED),
+            ).fetchall()
+
+    def prune(self, keep=JOURNAL_KEEP):
+        """Forget acknowledged jobs older than keep seconds"""
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM jobs WHERE state = ? AND updated < ?',
+                (ACKNOWLEDGED, time.time() - keep),
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
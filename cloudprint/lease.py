@@ -0,0 +1,292 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+from __future__ import absolute_import
+
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+LOGGER = logging.getLogger('cloudprint.lease')
+
+# how long, in seconds, a lease lasts unless its holder renews it
+LEASE_TTL = 300.0
+
+# seconds to wait for another node holding the lease database locked
+LEASE_DB_TIMEOUT = 10.0
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS leases ('
+    'key TEXT PRIMARY KEY, '
+    'owner TEXT NOT NULL, '
+    'expires REAL NOT NULL)'
+)
+
+
+def default_node_id():
+    return '{0}-{1}'.format(socket.gethostname(), os.getpid())
+
+
+class Leases(object):
+    """Leases on jobs, so that several proxies sharing one account print
+    each job once.
+
+    A node acquires the lease on a job before downloading it. The leases it
+    holds are renewed in the background while it works on them, and until
+    the cloud has been told how the job ended; then the lease is left to
+    run out rather than released, so a node whose fetch raced the
+    acknowledgement can't take it. If a node dies
+    its leases expire after ttl seconds and another node picks the work up:
+    a node turned away from a job calls watch(), and fetches the jobs of
+    the printer again once due_printers() says the lease has run out.
+
+    Subclasses store the leases."""
+
+    def __init__(self, node_id=None, ttl=LEASE_TTL):
+        self.node_id = node_id or default_node_id()
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._held = set()
+        self._renewer = None
+        self._stop_renewer = threading.Event()
+        # printer id -> when to fetch its jobs again
+        self._refetch = {}
+
+    def acquire(self, key):
+        """Take the lease on key, or extend it if we hold it already.
+        Returns False if another node holds it."""
+        if not self._acquire(key, time.time()):
+            return False
+        with self._lock:
+            self._held.add(key)
+        return True
+
+    def done(self, key):
+        """Stop renewing the lease on key and let it run out"""
+        with self._lock:
+            self._held.discard(key)
+
+    def release(self, key):
+        """Give the lease on key up, so any node may take it straight away"""
+        self.done(key)
+        self._release(key)
+
+    def watch(self, printer_id, key, now=None):
+        """Have due_printers() return printer_id once the lease another
+        node holds on key runs out, in case that node has gone"""
+        if now is None:
+            now = time.time()
+        expires = self._expires(key)
+        due = now if expires is None else max(expires, now)
+        with self._lock:
+            if due < self._refetch.get(printer_id, float('inf')):
+                self._refetch[printer_id] = due
+
+    def due_printers(self, now=None):
+        """The printers whose jobs are to be fetched again now"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            due = set(p for p, t in self._refetch.items() if t <= now)
+            for printer_id in due:
+                del self._refetch[printer_id]
+        return due
+
+    def next_due_in(self, now=None):
+        """Seconds until a printer is due for another fetch, or None"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if not self._refetch:
+                return None
+            return max(min(self._refetch.values()) - now, 0)
+
+    def held(self):
+        with self._lock:
+            return set(self._held)
+
+    def renew(self):
+        """Extend every lease we still hold"""
+        lost = self._renew(self.held(), time.time())
+        for key in lost:
+            LOGGER.warning('Lost the lease on %s', key)
+            self.done(key)
+
+    def start(self):
+        """Renew the leases held from a background thread"""
+        if self._renewer is not None:
+            return
+        self._stop_renewer.clear()
+        self._renewer = threading.Thread(
+            target=self._renew_loop,
+            name='cloudprint-lease-renewer',
+        )
+        self._renewer.daemon = True
+        self._renewer.start()
+
+    def stop(self):
+        if self._renewer is None:
+            return
+        self._stop_renewer.set()
+        self._renewer.join()
+        self._renewer = None
+
+    def _renew_loop(self):
+        while not self._stop_renewer.wait(self.ttl / 3):
+            try:
+                self.renew()
+                self._expire(time.time())
+            except Exception:
+                LOGGER.exception('Could not renew leases')
+
+    def _acquire(self, key, now):
+        raise NotImplementedError
+
+    def _renew(self, keys, now):
+        """Extend keys; returns the ones no longer ours"""
+        raise NotImplementedError
+
+    def _release(self, key):
+        raise NotImplementedError
+
+    def _expires(self, key):
+        """When the lease on key runs out, or None if there is none"""
+        raise NotImplementedError
+
+    def _expire(self, now):
+        """Forget leases that have run out"""
+
+
+class LocalLeases(Leases):
+    """Leases kept in memory. Nodes sharing a store dict share leases, which
+    is only useful within one process: for tests, or a single node."""
+
+    def __init__(self, node_id=None, ttl=LEASE_TTL, store=None):
+        Leases.__init__(self, node_id, ttl)
+        self.store = {} if store is None else store
+        self._store_lock = threading.Lock()
+
+    def _acquire(self, key, now):
+        with self._store_lock:
+            lease = self.store.get(key)
+            if lease is not None and lease[0] != self.node_id \
+                    and lease[1] > now:
+                return False
+            self.store[key] = (self.node_id, now + self.ttl)
+            return True
+
+    def _renew(self, keys, now):
+        lost = []
+        with self._store_lock:
+            for key in keys:
+                lease = self.store.get(key)
+                if lease is None or lease[0] != self.node_id:
+                    lost.append(key)
+                else:
+                    self.store[key] = (self.node_id, now + self.ttl)
+        return lost
+
+    def _release(self, key):
+        with self._store_lock:
+            lease = self.store.get(key)
+            if lease is not None and lease[0] == self.node_id:
+                del self.store[key]
+
+    def _expires(self, key):
+        with self._store_lock:
+            lease = self.store.get(key)
+        return None if lease is None else lease[1]
+
+    def _expire(self, now):
+        with self._store_lock:
+            for key, lease in list(self.store.items()):
+                if lease[1] <= now:
+                    del self.store[key]
+
+
+class SQLiteLeases(Leases):
+    """Leases kept in an SQLite file that every node can reach, such as one
+    on a shared filesystem. The file needs working POSIX locks, which some
+    network filesystems don't provide."""
+
+    def __init__(self, path, node_id=None, ttl=LEASE_TTL):
+        Leases.__init__(self, node_id, ttl)
+        self.path = path
+        self._db_lock = threading.Lock()
+        self._db = sqlite3.connect(
+            path,
+            timeout=LEASE_DB_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._db.execute(SCHEMA)
+
+    def _acquire(self, key, now):
+        with self._db_lock:
+            # taken before the read, so two nodes can't both see the lease
+            # free and both take it
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute(
+                    'SELECT owner, expires FROM leases WHERE key = ?', (key,)
+                ).fetchone()
+                if row is not None and row[0] != self.node_id \
+                        and row[1] > now:
+                    return False
+                self._db.execute(
+                    'INSERT OR REPLACE INTO leases VALUES (?, ?, ?)',
+                    (key, self.node_id, now + self.ttl),
+                )
+            finally:
+                self._db.execute('COMMIT')
+            return True
+
+    def _renew(self, keys, now):
+        lost = []
+        with self._db_lock:
+            for key in keys:
+                cursor = self._db.execute(
+                    'UPDATE leases SET expires = ? '
+                    'WHERE key = ? AND owner = ?',
+                    (now + self.ttl, key, self.node_id),
+                )
+                if not cursor.rowcount:
+                    lost.append(key)
+        return lost
+
+    def _release(self, key):
+        with self._db_lock:
+            self._db.execute(
+                'DELETE FROM leases WHERE key = ? AND owner = ?',
+                (key, self.node_id),
+            )
+
+    def _expires(self, key):
+        with self._db_lock:
+            row = self._db.execute(
+                'SELECT expires FROM leases WHERE key = ?', (key,)
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def _expire(self, now):
+        with self._db_lock:
+            self._db.execute('DELETE FROM leases WHERE expires <= ?', (now,))
+
+    def close(self):
+        with self._db_lock:
+            self._db.close()
@@ -0,0 +1,339 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+"""Counters and histograms of what the proxy spends its time on, in the
+Prometheus text format.
+
+Recording a value costs a dict lookup and a short lock, so the job path
+records unconditionally; nothing is formatted until the metrics are read
+over HTTP (serve) or written out (dump)."""
+
+from __future__ import absolute_import
+
+import bisect
+import logging
+import os
+import tempfile
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+LOGGER = logging.getLogger('cloudprint.metrics')
+
+# how often, in seconds, --metrics-file is rewritten
+DUMP_PERIOD = 60.0
+
+# bucket upper bounds, in seconds and in bytes
+TIME_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+    60.0,
+)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(10))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace(
+        '"', '\\"'
+    )
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{0}="{1}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra is not None:
+        pairs.append('{0}="{1}"'.format(*extra))
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(int(value))
+    return repr(value)
+
+
+class Registry(object):
+    """A set of metrics rendered together"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            lines.extend(metric.samples())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+        self._children = {}
+        if registry is not None:
+            registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """The series for one set of label values, made on first use"""
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError('{0} takes labels {1}'.format(
+                    self.name, ', '.join(self.label_names)
+                ))
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _series(self):
+        with self._lock:
+            children = sorted(self._children.items())
+        return [(values, child.snapshot()) for values, child in children]
+
+
+class _CounterChild(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        with self._lock:
+            return self.value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def samples(self):
+        for values, value in self._series():
+            yield '{0}{1} {2}'.format(
+                self.name,
+                _format_labels(self.label_names, values),
+                _format_value(value),
+            )
+
+
+class _HistogramChild(object):
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        # a count per bucket, then one for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, amount):
+        index = bisect.bisect_left(self._buckets, amount)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += amount
+
+    def snapshot(self):
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS,
+                 registry=REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        _Metric.__init__(self, name, help, labels, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, amount):
+        self.labels().observe(amount)
+
+    def samples(self):
+        bounds = self.buckets + (float('inf'),)
+        for values, (counts, total) in self._series():
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield '{0}_bucket{1} {2}'.format(
+                    self.name,
+                    _format_labels(
+                        self.label_names,
+                        values,
+                        ('le', _format_value(float(bound))),
+                    ),
+                    cumulative,
+                )
+            labels = _format_labels(self.label_names, values)
+            yield '{0}_sum{1} {2}'.format(
+                self.name, labels, _format_value(total)
+            )
+            yield '{0}_count{1} {2}'.format(self.name, labels, cumulative)
+
+
+DOWNLOAD_SECONDS = Histogram(
+    'cloudprint_job_download_seconds',
+    'Time spent waiting on the download of each job document.',
+    ['printer'],
+)
+DOWNLOAD_BYTES = Histogram(
+    'cloudprint_job_download_bytes',
+    'Size of each job document.',
+    ['printer'],
+    buckets=SIZE_BUCKETS,
+)
+TICKET_SECONDS = Histogram(
+    'cloudprint_job_ticket_seconds',
+    'Time to fetch and parse the ticket of each job.',
+    ['printer'],
+)
+SUBMIT_SECONDS = Histogram(
+    'cloudprint_job_submit_seconds',
+    'Time spent handing each job to CUPS, not counting the download.',
+    ['printer'],
+)
+CONTROL_SECONDS = Histogram(
+    'cloudprint_job_control_seconds',
+    'Time to acknowledge each job to the cloud.',
+    ['printer'],
+)
+JOBS = Counter(
+    'cloudprint_jobs_total',
+    'Jobs finished, by outcome: done or error.',
+    ['printer', 'outcome'],
+)
+RETRIES = Counter(
+    'cloudprint_job_retries_total',
+    'Job attempts that failed and were scheduled to run again.',
+    ['printer'],
+)
+XMPP_RECONNECTS = Counter(
+    'cloudprint_xmpp_reconnects_total',
+    'XMPP connections made after the first.',
+)
+CUPS_RECONNECTS = Counter(
+    'cloudprint_cups_reconnects_total',
+    'CUPS connections dropped after a transport error.',
+)
+TOKEN_REFRESHES = Counter(
+    'cloudprint_token_refreshes_total',
+    'Access token refreshes, by result: ok or error.',
+    ['result'],
+)
+SYNC_SECONDS = Histogram(
+    'cloudprint_sync_seconds',
+    'Time to bring the cloud printers in line with CUPS.',
+)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve the metrics over HTTP from a background thread. Returns the
+    server."""
+    server = HTTPServer((host, port), _Handler)
+    server.registry = registry
+    thread = threading.Thread(
+        target=server.serve_forever,
+        name='cloudprint-metrics',
+    )
+    thread.daemon = True
+    thread.start()
+    LOGGER.info('Serving metrics on http://%s:%d/', host, port)
+    return server
+
+
+def dump(path, registry=REGISTRY):
+    """Write the metrics to path, replacing it in one go so a reader never
+    sees half a file"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.metrics')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(registry.render())
+        os.rename(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def start_dumper(path, period=DUMP_PERIOD, registry=REGISTRY):
+    """Rewrite path every period seconds from a background thread"""
+    def write():
+        try:
+            dump(path, registry)
+        except Exception:
+            LOGGER.exception('Could not write metrics to %s', path)
+
+    def run():
+        write()
+        while not stop.wait(period):
+            write()
+
+    stop = threading.Event()
+    thread = threading.Thread(target=run, name='cloudprint-metrics-dump')
+    thread.daemon = True
+    thread.start()
+    return stop
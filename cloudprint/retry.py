@@ -0,0 +1,176 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+from __future__ import absolute_import
+
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import random
+import threading
+import time
+
+# failed job retries
+RETRIES = 1
+
+# backoff, in seconds, before the first retry of a job; it doubles with
+# every further failure up to RETRY_MAX_DELAY
+RETRY_DELAY = 10.0
+RETRY_MAX_DELAY = 600.0
+
+# fraction of the backoff added or taken away at random
+RETRY_JITTER = 0.25
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+class RetryScheduler(object):
+    """Per-job retry bookkeeping.
+
+    Every failed job gets its own attempt count and becomes due again after
+    an exponential backoff with jitter. Nothing is run from here: the job
+    loop asks for the jobs that are due with pop_due(), and next_due_in()
+    tells it how long it may wait before asking again.
+
+    Jobs run on worker threads fail while the loop is already waiting, so
+    the scheduler is also selectable: its fileno() turns readable when a
+    retry is scheduled sooner than any other, and the loop calls
+    clear_wakeup() before working out its next wait."""
+
+    def __init__(self, retries=RETRIES, delay=RETRY_DELAY,
+                 max_delay=RETRY_MAX_DELAY, jitter=RETRY_JITTER):
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+        self._lock = threading.Lock()
+        self._attempts = {}
+        self._due = []
+        self._scheduled = {}
+        self._counter = itertools.count()
+        # self-pipe waking the job loop, made on the first fileno()
+        self._wakeup = None
+
+    def backoff(self, attempt):
+        """Seconds to wait before retry number attempt"""
+        delay = min(self.max_delay, self.delay * 2 ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def failed(self, printer, job):
+        """Record a failed attempt at job. Returns True if it will be retried,
+        False if it has used up its retries and should be failed."""
+        job_id = job['id']
+        with self._lock:
+            attempt = self._attempts.get(job_id, 0) + 1
+            if attempt > self.retries:
+                self._attempts.pop(job_id, None)
+                return False
+
+            self._attempts[job_id] = attempt
+            due = time.time() + self.backoff(attempt)
+            entry = (due, next(self._counter), job_id)
+            self._scheduled[job_id] = (printer, job, entry)
+            heapq.heappush(self._due, entry)
+            if self._due[0] is entry:
+                self._wake()
+            return True
+
+    def succeeded(self, job_id):
+        """Forget a job once it has been printed"""
+        with self._lock:
+            self._attempts.pop(job_id, None)
+            self._scheduled.pop(job_id, None)
+
+    def attempts(self, job_id):
+        """Failed attempts at job_id so far"""
+        with self._lock:
+            return self._attempts.get(job_id, 0)
+
+    def is_scheduled(self, job_id):
+        """True if job_id is waiting for its retry, in which case a poll that
+        turns it up again should leave it alone"""
+        with self._lock:
+            return job_id in self._scheduled
+
+    def pop_due(self, now=None):
+        """Return (printer, job) for every job whose retry is due"""
+        if now is None:
+            now = time.time()
+        due = []
+        with self._lock:
+            while self._due and self._due[0][0] <= now:
+                entry = heapq.heappop(self._due)
+                scheduled = self._scheduled.get(entry[2])
+                if scheduled is not None and scheduled[2] is entry:
+                    del self._scheduled[entry[2]]
+                    due.append(scheduled[:2])
+        return due
+
+    def next_due_in(self, now=None):
+        """Seconds until the next retry is due, or None if none is waiting"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            while self._due:
+                entry = self._due[0]
+                scheduled = self._scheduled.get(entry[2])
+                if scheduled is not None and scheduled[2] is entry:
+                    return max(entry[0] - now, 0)
+                # the job succeeded or was rescheduled since
+                heapq.heappop(self._due)
+        return None
+
+    def fileno(self):
+        """A descriptor for select() that is readable once a retry has been
+        scheduled sooner than next_due_in() last said"""
+        with self._lock:
+            if self._wakeup is None:
+                self._wakeup = os.pipe()
+                for fd in self._wakeup:
+                    _set_nonblocking(fd)
+            return self._wakeup[0]
+
+    def clear_wakeup(self):
+        """Drain fileno(); call it before next_due_in(). Returns True if it
+        was readable."""
+        fd = self.fileno()
+        woken = False
+        try:
+            while os.read(fd, 512):
+                woken = True
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+        return woken
+
+    def _wake(self):
+        if self._wakeup is None:
+            return
+        try:
+            os.write(self._wakeup[1], b'x')
+        except OSError as e:
+            # a full pipe wakes the loop just as well
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def __len__(self):
+        with self._lock:
+            return len(self._scheduled)
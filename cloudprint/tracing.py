@@ -0,0 +1,154 @@
+# Copyright 2014 Jason Michalski <armooo@armooo.net>
+# This file is part of cloudprint.
+#
+# cloudprint is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# cloudprint is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+
+from __future__ import absolute_import
+
+import json
+import logging
+import random
+import threading
+import time
+import uuid
+
+LOGGER = logging.getLogger('cloudprint.tracing')
+
+# share of jobs traced when tracing is on
+TRACE_SAMPLE = 1.0
+
+
+class Tracer(object):
+    """Timed spans through the life of each job, written out one JSON line
+    per job attempt once it ends.
+
+    Spans are kept by job id from begin() to finish(), so the code a job
+    passes through only needs the job's id to add to its trace. A trace
+    looks like:
+
+        {"trace_id": "...", "job_id": "...", "printer": "...",
+         "start": <epoch seconds>, "duration": 1.2, "outcome": "done",
+         "spans": [{"name": "fetch", "start": 0.01, "duration": 0.2}, ...]}
+
+    where each span's start is in seconds from the start of the trace.
+    sample_rate is the share of jobs traced; jobs that take slow seconds or
+    more are written whether sampled or not. With no path every call
+    returns straight away."""
+
+    def __init__(self, path=None, sample_rate=TRACE_SAMPLE, slow=None):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow = slow
+        self._lock = threading.Lock()
+        self._file = None
+        if path is not None:
+            self._file = open(path, 'a')
+        # printer id -> when a notification about it was last received
+        self._notified = {}
+        # job id -> [trace id, printer, sampled, began, spans]
+        self._traces = {}
+
+    @property
+    def enabled(self):
+        return self._file is not None
+
+    def notified(self, printer_ids):
+        """Note that notifications about printer_ids just arrived"""
+        if self._file is None or not printer_ids:
+            return
+        now = time.time()
+        with self._lock:
+            for printer_id in printer_ids:
+                self._notified.setdefault(printer_id, now)
+
+    def fetched(self, printer_id, start):
+        """Note that the jobs of printer_id, asked for at start, just came
+        back. Returns what begin() needs to add the fetch to the traces of
+        those jobs."""
+        if self._file is None:
+            return None
+        with self._lock:
+            notified = self._notified.pop(printer_id, None)
+        return notified, start, time.time()
+
+    def begin(self, job_id, printer, fetch=None):
+        """Start tracing a job, with the fetch that found it if known"""
+        if self._file is None:
+            return
+        sampled = random.random() < self.sample_rate
+        if not sampled and self.slow is None:
+            return
+        spans = []
+        if fetch is not None:
+            notified, start, end = fetch
+            if notified is not None:
+                spans.append(('notification', notified, notified, {}))
+            spans.append(('fetch', start, end, {}))
+        with self._lock:
+            self._traces[job_id] = [
+                uuid.uuid4().hex, printer.name, sampled, time.time(), spans
+            ]
+
+    def span(self, job_id, name, start, end=None, **attrs):
+        """Add a span to the trace of a job. end defaults to now."""
+        trace = self._traces.get(job_id)
+        if trace is None:
+            return
+        if end is None:
+            end = time.time()
+        with self._lock:
+            trace[4].append((name, start, end, attrs))
+
+    def finish(self, job_id, outcome):
+        """End the trace of a job, writing it out if it was sampled or slow"""
+        if self._file is None:
+            return
+        with self._lock:
+            trace = self._traces.pop(job_id, None)
+        if trace is None:
+            return
+        trace_id, printer_name, sampled, began, spans = trace
+        end = time.time()
+        start = min([s[1] for s in spans] + [began])
+        if not sampled and end - start < self.slow:
+            return
+
+        record = {
+            'trace_id': trace_id,
+            'job_id': job_id,
+            'printer': printer_name,
+            'start': start,
+            'duration': end - start,
+            'outcome': outcome,
+            'spans': [],
+        }
+        for name, span_start, span_end, attrs in sorted(
+                spans, key=lambda s: s[1]):
+            span = dict(attrs)
+            span['name'] = name
+            span['start'] = span_start - start
+            span['duration'] = span_end - span_start
+            record['spans'].append(span)
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            try:
+                self._file.write(line)
+                self._file.flush()
+            except Exception:
+                LOGGER.exception('Could not write trace to %s', self.path)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
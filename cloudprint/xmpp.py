@@ -17,6 +17,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import base64
+import binascii
 import logging
 import ssl
 import socket
@@ -26,34 +27,116 @@ import time
 from collections import deque
 from xml.etree.ElementTree import XMLParser, TreeBuilder
 
+try:
+    from cloudprint import metrics
+except Exception:
+    import metrics
+
 LOGGER = logging.getLogger('cloudprint.xmpp')
 
+# bytes read from the socket at a time
+RECV_BUFFER_SIZE = 16384
+
+PUSH_DATA_PATH = '{google:push}push/{google:push}data'
+
+# The client half of the handshake, in order.
+# https://developers.google.com/cloud-print/docs/rawxmpp
+STREAM_OPEN = (
+    '<stream:stream to="gmail.com" xml:lang="en" version="1.0" '
+    'xmlns:stream="http://etherx.jabber.org/streams" '
+    'xmlns="jabber:client">'
+)
+AUTH = (
+    '<auth xmlns="urn:ietf:params:xml:ns:xmpp-sasl" '
+    'mechanism="X-OAUTH2">%s</auth>'
+)
+BIND = (
+    '<iq type="set" id="0">'
+    '<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind">'
+    '<resource>cloud_print</resource>'
+    '</bind>'
+    '</iq>'
+)
+SESSION = (
+    '<iq type="set" id="2">'
+    '<session xmlns="urn:ietf:params:xml:ns:xmpp-session"/>'
+    '</iq>'
+)
+SUBSCRIBE = (
+    '<iq type="set" id="3" to="%s">'
+    '<subscribe xmlns="google:push">'
+    '<item channel="cloudprint.google.com" '
+    'from="cloudprint.google.com"/>'
+    '</subscribe>'
+    '</iq>'
+)
+
+
+def auth_message(auth):
+    """The SASL X-OAUTH2 auth element for a CloudPrintAuth"""
+    raw_auth_string = '\0{0}\0{1}'.format(
+        auth.xmpp_jid,
+        auth.access_token
+    ).encode('utf-8')
+    return AUTH % base64.b64encode(raw_auth_string).decode('utf-8')
+
+
+def bound_jid(iq):
+    """The bare jid from the server's answer to BIND"""
+    return iq[0][0].text.split('/')[0]
+
+
+def parse_push(elem):
+    """Return the printer id a google:push notification is about, or None
+    if the stanza isn't a push notification we can decode."""
+    data = elem.find(PUSH_DATA_PATH)
+    if data is None or not data.text:
+        return None
+    try:
+        printer_id = base64.b64decode(data.text.strip()).decode('utf-8')
+    except (TypeError, ValueError, binascii.Error):
+        return None
+    return printer_id or None
+
 
 class XmppXmlHandler(object):
+    """Turn the XMPP stream into one Element per top-level stanza.
+
+    Every stanza is built by a TreeBuilder of its own, which is dropped as
+    soon as the stanza is complete, so nothing is left behind once get_elem()
+    has handed it out and memory stays flat on a connection that lives for
+    weeks."""
     STREAM_TAG = '{http://etherx.jabber.org/streams}stream'
 
     def __init__(self):
         self._stack = 0
-        self._builder = TreeBuilder()
-        self._builder.start('root', {})
+        self._builder = None
         self._results = deque()
 
     def data(self, data):
-        self._builder.data(data)
+        # whitespace between stanzas (keepalives) has nowhere to go
+        if self._builder is not None:
+            self._builder.data(data)
 
     def start(self, tag, attrib):
         if tag == self.STREAM_TAG:
             return
 
+        if self._builder is None:
+            self._builder = TreeBuilder()
         self._builder.start(tag, attrib)
         self._stack += 1
 
     def end(self, tag):
+        if tag == self.STREAM_TAG:
+            return
+
         self._stack -= 1
-        elem = self._builder.end(tag)
+        self._builder.end(tag)
 
         if self._stack == 0:
-            self._results.append(elem)
+            self._results.append(self._builder.close())
+            self._builder = None
 
     def get_elem(self):
         """If a top-level XML element has been completed since the last call to
@@ -70,33 +153,90 @@ class XmppXmlHandler(object):
             return None
 
 
-class XmppConnection(object):
+class XmppNotifications(object):
+    """Tracks which printers the push notifications received so far were
+    about. Shared by the blocking and the asyncio connections."""
+
+    def __init__(self):
+        self._handler = None
+        self._notified_printers = set()
+        self._full_sweep = False
+
+    def _check_for_notification(self):
+        """Check for any notifications which have already been received"""
+        notified = False
+        while True:
+            elem = self._handler.get_elem()
+            if elem is None:
+                return notified
+
+            notified = True
+            printer_id = parse_push(elem)
+            if printer_id is None:
+                self._full_sweep = True
+            else:
+                self._notified_printers.add(printer_id)
+
+    def pop_notified_printers(self):
+        """Return the ids of the printers named by the notifications received
+        since the last call, or None if any of them couldn't be decoded and
+        every printer should be checked."""
+        printer_ids = self._notified_printers
+        full_sweep = self._full_sweep
+        self._notified_printers = set()
+        self._full_sweep = False
+        if full_sweep:
+            return None
+        return printer_ids
+
+
+class XmppConnection(XmppNotifications):
     def __init__(self, keepalive_period=60.0):
+        XmppNotifications.__init__(self)
         self._connected = False
+        self._connections = 0
         self._wrappedsock = None
         self._keepalive_period = keepalive_period
         self._nextkeepalive = time.time() + self._keepalive_period
+        self._recv_buffer = bytearray(RECV_BUFFER_SIZE)
+        self._recv_view = memoryview(self._recv_buffer)
 
-    def _read_socket(self):
-        """read pending data from the socket, and send it to the XML parser.
-        return False if the socket is closed, True if it is ok"""
+    def _recv(self):
         try:
-            self._nextkeepalive = time.time() + self._keepalive_period
-            data = self._wrappedsock.recv(1024)
-            if data is None or len(data) == 0:
+            nbytes = self._wrappedsock.recv_into(self._recv_buffer)
+            if not nbytes:
                 # socket closed
                 raise Exception("xmpp socket closed")
         except:
             self._connected = False
             raise
+        # pyexpat on python 2 takes a string, not a memoryview
+        return self._recv_view[:nbytes].tobytes()
 
-        data = data.decode('utf-8')
-        LOGGER.debug('<<< %s' % data)
-        self._xmlparser.feed(data)
+    def _read_socket(self):
+        """read pending data from the socket, and send it to the XML parser.
+        Raises if the socket is closed.
+
+        The parser is fed raw bytes and does the UTF-8 decoding itself, so a
+        character split between two reads is fine."""
+        self._nextkeepalive = time.time() + self._keepalive_period
+        while True:
+            data = self._recv()
+            if LOGGER.isEnabledFor(logging.DEBUG):
+                LOGGER.debug(
+                    '<<< %s', data.decode('utf-8', 'replace')
+                )
+            self._xmlparser.feed(data)
+
+            # TLS can hold on to more decrypted data than one read returns,
+            # and select() won't report it
+            pending = getattr(self._wrappedsock, 'pending', None)
+            if pending is None or not pending():
+                return
 
     def _write_socket(self, msg):
         """write a message to the XMPP server"""
-        LOGGER.debug('>>> %s' % msg)
+        LOGGER.debug('>>> %s', msg)
         try:
             self._nextkeepalive = time.time() + self._keepalive_period
             self._wrappedsock.sendall(msg.encode('utf-8'))
@@ -119,10 +259,6 @@ class XmppConnection(object):
             # need more data; block until it becomes available
             self._read_socket()
 
-    def _check_for_notification(self):
-        """Check for any notifications which have already been received"""
-        return(self._handler.get_elem() is not None)
-
     def _send_keepalive(self):
         LOGGER.info("Sending XMPP keepalive")
         self._write_socket(" ")
@@ -136,11 +272,6 @@ class XmppConnection(object):
                     (host, port))
         self._xmppsock = socket.socket()
         self._wrappedsock = self._xmppsock
-        raw_auth_string = '\0{0}\0{1}'.format(
-            auth.xmpp_jid,
-            auth.access_token
-        ).encode('utf-8')
-        auth_string = base64.b64encode(raw_auth_string).decode('utf-8')
 
         try:
             self._wrappedsock = ssl.wrap_socket(self._xmppsock)
@@ -149,50 +280,21 @@ class XmppConnection(object):
             self._handler = XmppXmlHandler()
             self._xmlparser = XMLParser(target=self._handler)
 
-            # https://developers.google.com/cloud-print/docs/rawxmpp
-            self._msg(
-                '<stream:stream to="gmail.com" xml:lang="en" version="1.0" '
-                'xmlns:stream="http://etherx.jabber.org/streams" '
-                'xmlns="jabber:client">'
-            )
-            self._msg(
-                '<auth xmlns="urn:ietf:params:xml:ns:xmpp-sasl" '
-                'mechanism="X-OAUTH2">%s</auth>'
-                % auth_string
-            )
-            self._msg(
-                '<stream:stream to="gmail.com" xml:lang="en" version="1.0" '
-                'xmlns:stream="http://etherx.jabber.org/streams" '
-                'xmlns="jabber:client">'
-            )
-            iq = self._msg(
-                '<iq type="set" id="0">'
-                '<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind">'
-                '<resource>cloud_print</resource>'
-                '</bind>'
-                '</iq>'
-            )
-            bare_jid = iq[0][0].text.split('/')[0]
-            self._msg(
-                '<iq type="set" id="2">'
-                '<session xmlns="urn:ietf:params:xml:ns:xmpp-session"/>'
-                '</iq>'
-            )
-            self._msg(
-                '<iq type="set" id="3" to="%s">'
-                '<subscribe xmlns="google:push">'
-                '<item channel="cloudprint.google.com" '
-                'from="cloudprint.google.com"/>'
-                '</subscribe>'
-                '</iq>'
-                % bare_jid
-            )
+            self._msg(STREAM_OPEN)
+            self._msg(auth_message(auth))
+            self._msg(STREAM_OPEN)
+            bare_jid = bound_jid(self._msg(BIND))
+            self._msg(SESSION)
+            self._msg(SUBSCRIBE % bare_jid)
         except:
             self.close()
             raise
 
         LOGGER.info("xmpp connection established")
         self._connected = True
+        self._connections += 1
+        if self._connections > 1:
+            metrics.XMPP_RECONNECTS.inc()
 
     def close(self):
         """Close the connection to the XMPP server"""
@@ -212,37 +314,45 @@ class XmppConnection(object):
         returns true if the connection is active; false otherwise"""
         return self._connected
 
-    def await_notification(self, timeout):
-        """wait for a timeout or event notification"""
+    def await_notification(self, timeout, wakeup=()):
+        """wait for a timeout or event notification; returns False early if
+        any of wakeup, objects with a fileno(), turns readable"""
         now = time.time()
 
         timeoutend = None
         if timeout is not None:
             timeoutend = now + timeout
 
+        woken = False
         while True:
             try:
                 if self._check_for_notification():
                     return True
 
+                if woken:
+                    # the caller is to work out its timeout again
+                    return False
+
                 if timeoutend is not None and timeoutend - now <= 0:
                     # timeout
                     return False
 
                 waittime = self._nextkeepalive - now
-                LOGGER.debug("%f seconds until next keepalive" % waittime)
+                LOGGER.debug("%f seconds until next keepalive", waittime)
 
                 if timeoutend is not None:
                     remaining = timeoutend - now
                     if remaining < waittime:
                         waittime = remaining
-                        LOGGER.debug("%f seconds until timeout" % waittime)
+                        LOGGER.debug("%f seconds until timeout", waittime)
 
                 if waittime < 0:
                     waittime = 0
 
                 sock = self._wrappedsock
-                (r, w, e) = select.select([sock], [], [sock], waittime)
+                (r, w, e) = select.select(
+                    [sock] + list(wakeup), [], [sock], waittime
+                )
 
                 now = time.time()
 
@@ -256,6 +366,87 @@ class XmppConnection(object):
                     LOGGER.warn("Error in xmpp connection")
                     raise Exception("xmpp connection errror")
 
+                if len(r) > (sock in r):
+                    woken = True
+
             except:
                 self.close()
                 raise
+
+
+def await_notifications(connections, timeout, wakeup=()):
+    """Wait on several connections at once, the way
+    XmppConnection.await_notification waits on one, keeping each of them
+    alive. Returns the connections that have notifications waiting, or none
+    if the timeout passed or one of wakeup turned readable first.
+
+    A connection that fails is closed and left out rather than raising, so
+    one account losing its connection doesn't stop the others."""
+    now = time.time()
+
+    timeoutend = None
+    if timeout is not None:
+        timeoutend = now + timeout
+
+    def fail(conn):
+        LOGGER.exception('Error in xmpp connection')
+        conn.close()
+
+    woken = False
+    while True:
+        notified = []
+        live = []
+        for conn in connections:
+            if not conn.is_connected():
+                continue
+            try:
+                if conn._check_for_notification():
+                    notified.append(conn)
+                live.append(conn)
+            except Exception:
+                fail(conn)
+        if notified:
+            return notified
+
+        if woken or (timeoutend is not None and timeoutend - now <= 0):
+            return []
+
+        waittime = None
+        if live:
+            waittime = min(conn._nextkeepalive for conn in live) - now
+        if timeoutend is not None:
+            remaining = timeoutend - now
+            if waittime is None or remaining < waittime:
+                waittime = remaining
+        if waittime is not None and waittime < 0:
+            waittime = 0
+
+        if not live:
+            # nothing to listen to until the caller reconnects
+            if waittime is not None:
+                if wakeup:
+                    select.select(list(wakeup), [], [], waittime)
+                else:
+                    time.sleep(waittime)
+            return []
+
+        socks = dict((conn._wrappedsock, conn) for conn in live)
+        (r, w, e) = select.select(
+            list(socks) + list(wakeup), [], list(socks), waittime
+        )
+        woken = any(s not in socks for s in r)
+
+        now = time.time()
+
+        for sock, conn in socks.items():
+            try:
+                if conn._nextkeepalive - now <= 0:
+                    conn._send_keepalive()
+
+                if sock in r:
+                    conn._read_socket()
+
+                if sock in e:
+                    raise Exception("xmpp connection errror")
+            except Exception:
+                fail(conn)
@@ -1,9 +1,22 @@
+import sys
+
 import mock
 import pytest
 import requests as requests_lib
 
 import requests_mock
 
+from cloudprint import cloudprint
+from cloudprint import inflight
+from cloudprint import journal
+from cloudprint import retry
+from cloudprint import tracing
+
+collect_ignore = []
+if sys.version_info < (3, 5):
+    # async/await is a syntax error before python 3.5
+    collect_ignore.append('test/test_aio.py')
+
 
 @pytest.yield_fixture
 def requests():
@@ -18,21 +31,35 @@ def cpp(monkeypatch):
     def add_printer(name):
         printer = mock.Mock(name='cpp printer ' + name)
         printer.name = name
+        printer.id = 'id of ' + name
+        printer.ppd = 'ppd for ' + name
+        printer.description = 'description of ' + name
         printers[name] = printer
         return printer
 
     cpp = mock.Mock(name='cpp')
     cpp.auth.session = requests_lib
     cpp.get_printers.side_effect = lambda: list(printers.values())
-    cpp.include = []
-    cpp.exclude = []
+    cpp.registry = cloudprint.PrinterRegistry(cpp)
+    cpp.retries = retry.RetryScheduler(delay=0)
+    cpp.journal = journal.JobJournal()
+    cpp.jobs = inflight.JobTracker()
+    cpp.leases = None
+    cpp.tracer = tracing.Tracer()
+    cpp.acks = None
+    cpp.completions = None
+    cpp.sleeptime = cloudprint.POLL_PERIOD
+    cpp.sweep_at = 0
+    cpp.printer_filter = cloudprint.PrinterFilter()
+    cpp.stream_jobs = False
+    cpp.chunk_size = 4
 
-    def get_printer_info(cpp, name):
+    def get_printer_info(cups, name, attrs=None):
         try:
             printer = printers[name]
             return printer.ppd, printer.description
         except KeyError:
-            return None, None
+            return 'ppd for ' + name, 'description of ' + name
 
     monkeypatch.setattr(
         'cloudprint.cloudprint.get_printer_info',
@@ -52,6 +79,8 @@ def cups():
 
     cups = mock.Mock(name='cups')
     cups.getPrinters.side_effect = printers.copy
+    cups.printFile.return_value = 1
+    cups.createJob.return_value = 1
 
     cups.test_add_printer = add_printer
     return cups
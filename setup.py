@@ -35,5 +35,6 @@ setup(
     ],
     extras_require={
         'daemon': ['python-daemon >= 2.0.0'],
+        'async': ['aiohttp >= 3.0'],
     },
 )
@@ -0,0 +1,126 @@
+import json
+
+import mock
+import pytest
+
+from cloudprint import cloudprint
+from cloudprint import retry
+
+
+@pytest.fixture
+def accounts_file(tmpdir):
+    def write(accounts):
+        path = tmpdir.join('accounts.json')
+        path.write(json.dumps(accounts))
+        return str(path)
+    return write
+
+
+@pytest.fixture
+def loop(monkeypatch):
+    monkeypatch.setattr('cloudprint.xmpp.XmppConnection', mock.Mock)
+    await_notifications = mock.Mock(return_value=[])
+    monkeypatch.setattr(
+        'cloudprint.xmpp.await_notifications', await_notifications
+    )
+    dispatch_jobs = mock.Mock()
+    monkeypatch.setattr('cloudprint.cloudprint.dispatch_jobs', dispatch_jobs)
+
+    cpps = []
+    for name in ('a', 'b'):
+        cpp = mock.Mock(name='cpp ' + name)
+        cpp.sleeptime = 100
+        cpp.retries = retry.RetryScheduler()
+        cpp.leases = None
+        cpps.append(cpp)
+
+    loop = cloudprint.MultiAccountLoop(mock.sentinel.cups, cpps)
+    for cpp, xmpp_conn in loop.accounts:
+        xmpp_conn.is_connected.return_value = True
+    loop.await_notifications = await_notifications
+    loop.dispatch_jobs = dispatch_jobs
+    return loop
+
+
+def test_load_accounts(accounts_file):
+    path = accounts_file([
+        {'auth': '/auth/a.json', 'site': 'a'},
+        {'auth': '/auth/b.json', 'journal': '/journal/b', 'include': ['x']},
+    ])
+
+    accounts = cloudprint.load_accounts(path)
+
+    assert accounts[0]['journal'] == '/auth/a.journal.sqlite'
+    assert accounts[1]['journal'] == '/journal/b'
+    assert accounts[1]['include'] == ['x']
+
+
+@pytest.mark.parametrize('accounts', [
+    [],
+    {'auth': 'a.json'},
+    [{'site': 'a'}],
+    [{'auth': 'a.json', 'colour': 'blue'}],
+])
+def test_load_accounts_invalid(accounts_file, accounts):
+    with pytest.raises(ValueError):
+        cloudprint.load_accounts(accounts_file(accounts))
+
+
+def test_first_pass_sweeps_every_account(loop):
+    loop.run_once()
+
+    assert loop.dispatch_jobs.call_args_list == [
+        mock.call(mock.sentinel.cups, cpp, None, None)
+        for cpp, _ in loop.accounts
+    ]
+    connections = loop.await_notifications.call_args[0][0]
+    assert set(connections) == set(conn for _, conn in loop.accounts)
+    assert loop.await_notifications.call_args[0][1] == pytest.approx(100, 1)
+
+
+def test_notification_checks_only_its_account(loop):
+    (cpp_a, conn_a), (cpp_b, conn_b) = loop.accounts
+    loop.await_notifications.return_value = [conn_b]
+    conn_b.pop_notified_printers.return_value = set(['printer'])
+    loop.run_once()
+    loop.await_notifications.return_value = []
+    loop.dispatch_jobs.reset_mock()
+
+    loop.run_once()
+
+    assert loop.dispatch_jobs.call_args_list == [
+        mock.call(mock.sentinel.cups, cpp_a, None, set()),
+        mock.call(mock.sentinel.cups, cpp_b, None, set(['printer'])),
+    ]
+
+
+def test_failed_account_does_not_stop_others(loop):
+    (cpp_a, conn_a), (cpp_b, conn_b) = loop.accounts
+    loop.dispatch_jobs.side_effect = [Exception('down'), None]
+
+    loop.run_once()
+    loop.dispatch_jobs.reset_mock()
+    loop.dispatch_jobs.side_effect = None
+    loop.run_once()
+
+    assert conn_a.close.called
+    # a is left alone until FAIL_RETRY is up
+    assert loop.dispatch_jobs.call_args_list == [
+        mock.call(mock.sentinel.cups, cpp_b, None, set()),
+    ]
+
+
+def test_shared_adapter():
+    adapter = mock.Mock(name='adapter')
+    auths = [
+        cloudprint.CloudPrintAuth('a.json', adapter=adapter),
+        cloudprint.CloudPrintAuth('b.json', adapter=adapter),
+    ]
+
+    for auth in auths:
+        session = auth._new_session()
+        assert session.get_adapter('https://www.google.com') is adapter
+        auth._session = session
+        auth.close()
+
+    assert not adapter.close.called
@@ -0,0 +1,106 @@
+import threading
+
+from cloudprint import ack
+from cloudprint import journal
+from cloudprint import lease
+
+
+def submitted(cpp, job_id):
+    cpp.journal.fetched(job_id, 'printer')
+    cpp.journal.submitted(job_id, 1)
+
+
+def test_acknowledged_in_background(cpp):
+    acks = ack.Acknowledger(cpp, delay=0)
+    submitted(cpp, 'job_1')
+
+    acks.queue('job_1', ack.DONE, 'printer')
+    assert not cpp.finish_job.called
+    acks.start()
+
+    assert acks.join(5)
+    cpp.finish_job.assert_called_once_with('job_1')
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
+    acks.stop()
+
+
+def test_error(cpp):
+    acks = ack.Acknowledger(cpp, delay=0)
+    cpp.journal.failed('job_1')
+
+    acks.queue('job_1', ack.ERROR)
+    acks.start()
+
+    assert acks.join(5)
+    cpp.fail_job.assert_called_once_with('job_1')
+    assert not cpp.finish_job.called
+    acks.stop()
+
+
+def test_coalesced(cpp):
+    acks = ack.Acknowledger(cpp, delay=0)
+
+    acks.queue('job_1', ack.DONE)
+    acks.queue('job_2', ack.DONE)
+    acks.queue('job_1', ack.ERROR)
+    # a job that has ended is not put back in progress
+    acks.queue('job_1', ack.IN_PROGRESS)
+    acks.queue('job_3', ack.IN_PROGRESS)
+    acks.queue('job_3', ack.DONE)
+    assert acks.pending() == 3
+    acks.start()
+
+    assert acks.join(5)
+    assert sorted(c[0][0] for c in cpp.finish_job.call_args_list) == [
+        'job_2', 'job_3'
+    ]
+    cpp.fail_job.assert_called_once_with('job_1')
+    assert not cpp.progress_job.called
+    acks.stop()
+
+
+def test_retried_until_sent(cpp):
+    acks = ack.Acknowledger(cpp, threads=1, delay=0)
+    submitted(cpp, 'job_1')
+    cpp.finish_job.side_effect = [Exception('control failed')] * 2 + [None]
+
+    acks.queue('job_1', ack.DONE)
+    acks.start()
+
+    assert acks.join(5)
+    assert cpp.finish_job.call_count == 3
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
+    acks.stop()
+
+
+def test_lease_kept_until_sent(cpp):
+    cpp.leases = lease.LocalLeases()
+    acks = ack.Acknowledger(cpp, threads=1, delay=0)
+    submitted(cpp, 'job_1')
+    cpp.leases.acquire('job_1')
+    sent = threading.Event()
+    cpp.finish_job.side_effect = lambda job_id: sent.wait(5)
+
+    acks.queue('job_1', ack.DONE)
+    acks.start()
+    assert cpp.leases.held() == set(['job_1'])
+
+    sent.set()
+    assert acks.join(5)
+    assert not cpp.leases.held()
+    acks.stop()
+
+
+def test_report_inline(cpp):
+    ack.report(cpp, 'job_1', ack.DONE)
+
+    cpp.finish_job.assert_called_once_with('job_1')
+
+
+def test_report_queued(cpp):
+    cpp.acks = ack.Acknowledger(cpp)
+
+    ack.report(cpp, 'job_1', ack.DONE)
+
+    assert not cpp.finish_job.called
+    assert cpp.acks.pending() == 1
@@ -0,0 +1,229 @@
+import asyncio
+import base64
+
+import mock
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from aiohttp import web  # noqa: E402
+
+from cloudprint import aio  # noqa: E402
+from cloudprint import cloudprint  # noqa: E402
+from cloudprint import metrics  # noqa: E402
+from cloudprint import retry  # noqa: E402
+
+SERVER_STREAM = (
+    b'<stream:stream from="gmail.com" id="1" version="1.0" '
+    b'xmlns:stream="http://etherx.jabber.org/streams" '
+    b'xmlns="jabber:client"><stream:features/>'
+)
+
+HANDSHAKE = [
+    SERVER_STREAM,
+    b'<success xmlns="urn:ietf:params:xml:ns:xmpp-sasl"/>',
+    SERVER_STREAM,
+    b'<iq type="result" id="0">'
+    b'<bind xmlns="urn:ietf:params:xml:ns:xmpp-bind">'
+    b'<jid>me@example.com/cloud_print</jid></bind></iq>',
+    b'<iq type="result" id="2"/>',
+    b'<iq type="result" id="3"/>',
+]
+
+
+def push(printer_id):
+    return (
+        '<message from="cloudprint.google.com">'
+        '<push:push channel="cloudprint.google.com" xmlns:push="google:push">'
+        '<push:data>%s</push:data></push:push></message>'
+    ) % base64.b64encode(printer_id.encode('utf-8')).decode('ascii')
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def test_xmpp_notification():
+    received = []
+
+    async def serve(reader, writer):
+        for answer in HANDSHAKE:
+            received.append(await reader.read(4096))
+            writer.write(answer)
+        writer.write(push('printer-1').encode('utf-8'))
+        await writer.drain()
+        received.append(await reader.read(4096))
+        await reader.read(4096)
+        writer.close()
+
+    async def test():
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        auth = mock.Mock(xmpp_jid='me@example.com', access_token='token')
+
+        conn = aio.AsyncXmppConnection(keepalive_period=0.1, ssl_context=False)
+        await conn.connect('127.0.0.1', port, auth)
+        assert conn.is_connected()
+        assert await conn.await_notification(5)
+        assert conn.pop_notified_printers() == set(['printer-1'])
+        assert not await conn.await_notification(0.15)
+        conn.close()
+        server.close()
+
+    run(test())
+
+    assert b'X-OAUTH2' in received[1]
+    assert b'to="me@example.com"' in received[5]
+    # a keepalive went out while waiting
+    assert received[6] == b' '
+
+
+def test_xmpp_reconnects_counted():
+    async def serve(reader, writer):
+        for answer in HANDSHAKE:
+            await reader.read(4096)
+            writer.write(answer)
+        await writer.drain()
+        await reader.read(4096)
+        writer.close()
+
+    async def test():
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        auth = mock.Mock(xmpp_jid='me@example.com', access_token='token')
+
+        conn = aio.AsyncXmppConnection(ssl_context=False)
+        reconnects = metrics.XMPP_RECONNECTS.labels().snapshot()
+        await conn.connect('127.0.0.1', port, auth)
+        assert metrics.XMPP_RECONNECTS.labels().snapshot() == reconnects
+        await conn.connect('127.0.0.1', port, auth)
+        assert metrics.XMPP_RECONNECTS.labels().snapshot() == reconnects + 1
+        conn.close()
+        server.close()
+
+    run(test())
+
+
+@pytest.fixture
+def cloud(monkeypatch):
+    """A tiny Cloud Print service on an aiohttp server"""
+    state = {'controls': [], 'jobs': []}
+
+    async def fetch(request):
+        return web.json_response({'success': True, 'jobs': state['jobs']})
+
+    async def control(request):
+        data = await request.post()
+        state['controls'].append((data['jobid'], data['status']))
+        return web.json_response({'success': True})
+
+    async def ticket(request):
+        return web.json_response({'request': '', 'copies': 2})
+
+    async def document(request):
+        return web.Response(body=b'This is a PDF')
+
+    app = web.Application()
+    app.router.add_post('/cloudprint/fetch', fetch)
+    app.router.add_post('/cloudprint/control', control)
+    app.router.add_get('/ticket', ticket)
+    app.router.add_get('/file', document)
+
+    async def start():
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        state['url'] = 'http://127.0.0.1:%d/' % port
+        monkeypatch.setattr(
+            cloudprint, 'PRINT_CLOUD_URL', state['url'] + 'cloudprint/'
+        )
+        return runner
+
+    state['start'] = start
+    return state
+
+
+def make_cpp():
+    auth = mock.Mock(name='auth', access_token='token', pool_size=4)
+    cpp = cloudprint.CloudPrintProxy(auth)
+    cpp.chunk_size = 4
+    return cpp
+
+
+def test_runner_streams_job(cloud):
+    cups = mock.Mock(name='cups')
+    cups.createJob.return_value = 7
+    cups.startDocument.return_value = cloudprint.cups.HTTP_CONTINUE
+    cups.writeRequestData.return_value = cloudprint.cups.HTTP_CONTINUE
+
+    cpp = make_cpp()
+    printer = cloudprint.PrinterProxy(cpp, 'p1', 'printer')
+
+    async def test():
+        server = await cloud['start']()
+        cloud['jobs'] = [{
+            'id': 'job_1',
+            'title': 'title',
+            'ownerId': 'owner',
+            'fileUrl': cloud['url'] + 'file',
+            'ticketUrl': cloud['url'] + 'ticket',
+        }]
+        cpp.registry.update([printer])
+
+        runner = aio.AsyncRunner(cpp, connection_factory=lambda: cups)
+        async with aio.aiohttp.ClientSession() as session:
+            runner.api = aio.AsyncCloudPrintProxy(cpp, session)
+            runner._job_slots = asyncio.Semaphore(1)
+            runner._connection_freed = asyncio.Condition()
+            await runner.check_printers(set(['p1']))
+            await asyncio.gather(*runner._tasks)
+        await server.cleanup()
+
+    run(test())
+
+    cups.createJob.assert_called_with('printer', '[owner]title', {
+        'copies': '2',
+    })
+    data = b''.join(
+        call[0][0] for call in cups.writeRequestData.call_args_list
+    )
+    assert data == b'This is a PDF'
+    cups.finishDocument.assert_called_with('printer')
+    assert cloud['controls'] == [('job_1', 'DONE')]
+
+
+def test_retries_of_jobs_failing_together():
+    cpp = make_cpp()
+    cpp.retries = retry.RetryScheduler(retries=3, delay=0.02, jitter=0)
+    printer = cloudprint.PrinterProxy(cpp, 'p1', 'printer')
+    attempts = {'job_a': 0, 'job_b': 0}
+
+    async def test():
+        runner = aio.AsyncRunner(cpp)
+        runner._retry_wakeup = asyncio.Event()
+
+        def start_job(printer, job, fetch=None):
+            # every attempt fails again
+            attempts[job['id']] += 1
+            cpp.retries.failed(printer, job)
+            runner._retry_soon()
+
+        runner.start_job = start_job
+        retries = asyncio.ensure_future(runner._retries())
+        start_job(printer, {'id': 'job_a'})
+        await asyncio.sleep(0.005)
+        start_job(printer, {'id': 'job_b'})
+        await asyncio.sleep(0.5)
+        retries.cancel()
+
+    run(test())
+
+    # each job's retry gets its own turn, however close the failures
+    assert attempts == {'job_a': 4, 'job_b': 4}
+    assert len(cpp.retries) == 0
@@ -1,5 +1,7 @@
 import datetime
 import json
+import threading
+import time
 
 from cloudprint.cloudprint import (
     CLIENT_ID,
@@ -116,3 +118,106 @@ def test_load(tmpdir, requests):
     assert auth.email == 'example@example.com'
     assert auth.xmpp_jid == 'my_xmpp'
     assert auth.refresh_token == 'refresh_123'
+
+
+def test_session_is_reused(tmpdir, requests):
+    requests.post(
+        'https://accounts.google.com/o/oauth2/token',
+        [
+            {
+                'json': {
+                    'access_token': 'access_token-1',
+                    'expires_in': 3600,
+                }
+            },
+            {
+                'json': {
+                    'access_token': 'access_token-2',
+                    'expires_in': 3600,
+                }
+            },
+        ]
+    )
+
+    auth = CloudPrintAuth(str(tmpdir.join('auth')), pool_size=3)
+    auth.refresh_token = 'refresh-123abc'
+    auth.refresh()
+
+    session = auth.session
+    assert session.headers['Authorization'] == 'Bearer access_token-1'
+    assert session.get_adapter('https://').poolmanager.connection_pool_kw[
+        'maxsize'] == 3
+
+    auth.exp_time = datetime.datetime.fromtimestamp(0)
+    assert auth.session is session
+    assert session.headers['Authorization'] == 'Bearer access_token-2'
+
+
+def test_session_without_keepalive(tmpdir):
+    auth = CloudPrintAuth(str(tmpdir.join('auth')), keepalive=False)
+    auth._access_token = 'access_token-123abc'
+    auth.exp_time = datetime.datetime.max
+
+    assert auth.session.headers['Connection'] == 'close'
+
+
+def test_refresh_failure_keeps_valid_token(tmpdir, requests):
+    requests.post(
+        'https://accounts.google.com/o/oauth2/token',
+        status_code=500,
+        json={},
+    )
+
+    auth = CloudPrintAuth(str(tmpdir.join('auth')))
+    auth._access_token = 'still-good'
+    auth.exp_time = datetime.datetime.fromtimestamp(0)
+    auth.token_expiry = datetime.datetime.max
+
+    assert auth.access_token == 'still-good'
+
+
+def test_refresh_is_single_flight(tmpdir, requests):
+    requests.post(
+        'https://accounts.google.com/o/oauth2/token',
+        json={
+            'access_token': 'access_token-123abc',
+            'expires_in': 3600,
+        }
+    )
+
+    auth = CloudPrintAuth(str(tmpdir.join('auth')))
+    count = auth._refresh_count
+    with auth._refresh_lock:
+        waiter = threading.Thread(target=auth.refresh)
+        waiter.start()
+        auth._refresh_count += 1
+    waiter.join()
+
+    assert not requests.called
+    assert auth._refresh_count == count + 1
+
+
+def test_background_refresh(tmpdir, requests):
+    requests.post(
+        'https://accounts.google.com/o/oauth2/token',
+        json={
+            'access_token': 'access_token-new',
+            'expires_in': 3600,
+        }
+    )
+
+    auth = CloudPrintAuth(str(tmpdir.join('auth')))
+    auth._access_token = 'access_token-old'
+    auth.exp_time = datetime.datetime.fromtimestamp(0)
+    auth.token_expiry = datetime.datetime.max
+
+    auth.start_refresher()
+    try:
+        for _ in range(100):
+            if auth._access_token == 'access_token-new':
+                break
+            time.sleep(0.01)
+    finally:
+        auth.stop_refresher()
+
+    assert auth.access_token == 'access_token-new'
@@ -0,0 +1,144 @@
+import cups
+import mock
+import pytest
+
+from cloudprint import ack
+from cloudprint import completion
+from cloudprint import journal
+
+
+@pytest.fixture
+def connection():
+    connection = mock.Mock(name='connection')
+    connection.createSubscription.return_value = 42
+    connection.getNotifications.return_value = {'events': []}
+    connection.getJobs.return_value = {}
+    return connection
+
+
+@pytest.fixture
+def tracker(connection):
+    return completion.CompletionTracker(connection)
+
+
+def submitted(cpp, job_id, cups_job_id):
+    cpp.journal.fetched(job_id, 'printer')
+    cpp.journal.submitted(job_id, cups_job_id)
+
+
+def event(sequence, cups_job_id, job_state):
+    return {
+        'notify-sequence-number': sequence,
+        'notify-job-id': cups_job_id,
+        'job-state': job_state,
+    }
+
+
+def test_subscribed_once(tracker, connection):
+    tracker.poll_once(now=0)
+    tracker.poll_once(now=1)
+    tracker.poll_once(now=2)
+
+    assert connection.createSubscription.call_count == 1
+    assert connection.getNotifications.call_count == 2
+    connection.getNotifications.assert_called_with([42], [1])
+
+
+def test_renewed(tracker, connection):
+    tracker.poll_once(now=0)
+    tracker.poll_once(now=tracker.lease)
+
+    connection.renewSubscription.assert_called_once_with(42, tracker.lease)
+
+
+def test_completed(tracker, connection, cpp):
+    submitted(cpp, 'job_1', 7)
+    tracker.poll_once(now=0)
+    tracker.track(7, cpp, 'job_1', 'printer')
+    assert tracker.is_tracking('job_1')
+
+    connection.getNotifications.return_value = {
+        'events': [event(1, 7, cups.IPP_JOB_COMPLETED)],
+    }
+    tracker.poll_once(now=1)
+
+    cpp.finish_job.assert_called_once_with('job_1')
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
+    assert not tracker.is_tracking('job_1')
+    assert len(tracker) == 0
+
+
+def test_aborted(tracker, connection, cpp):
+    submitted(cpp, 'job_1', 7)
+    tracker.poll_once(now=0)
+    tracker.track(7, cpp, 'job_1', 'printer')
+
+    connection.getNotifications.return_value = {
+        'events': [event(1, 7, cups.IPP_JOB_ABORTED)],
+    }
+    tracker.poll_once(now=1)
+
+    cpp.fail_job.assert_called_once_with('job_1')
+    assert not cpp.finish_job.called
+
+
+def test_ended_before_tracked(tracker, connection, cpp):
+    submitted(cpp, 'job_1', 7)
+    tracker.poll_once(now=0)
+    connection.getNotifications.return_value = {
+        'events': [event(1, 7, cups.IPP_JOB_COMPLETED)],
+    }
+    tracker.poll_once(now=1)
+
+    tracker.track(7, cpp, 'job_1', 'printer')
+
+    cpp.finish_job.assert_called_once_with('job_1')
+    assert len(tracker) == 0
+
+
+def test_missed_events_resync(tracker, connection, cpp):
+    submitted(cpp, 'job_1', 7)
+    submitted(cpp, 'job_2', 8)
+    submitted(cpp, 'job_3', 9)
+    tracker.poll_once(now=0)
+    for cups_job_id, job_id in ((7, 'job_1'), (8, 'job_2'), (9, 'job_3')):
+        tracker.track(cups_job_id, cpp, job_id, 'printer')
+
+    # events 1 to 4 were dropped by cupsd
+    connection.getNotifications.return_value = {
+        'events': [event(5, 100, cups.IPP_JOB_COMPLETED)],
+    }
+    connection.getJobs.side_effect = [
+        {7: {'job-state': cups.IPP_JOB_COMPLETED}},
+        {9: {}},
+    ]
+    tracker.poll_once(now=1)
+
+    # 7 completed, 8 forgotten by cupsd, 9 still printing
+    assert sorted(c[0][0] for c in cpp.finish_job.call_args_list) == [
+        'job_1', 'job_2'
+    ]
+    assert tracker.is_tracking('job_3')
+    connection.getNotifications.return_value = {'events': []}
+    tracker.poll_once(now=2)
+    connection.getNotifications.assert_called_with([42], [6])
+
+
+def test_resubscribe(tracker, connection):
+    tracker.poll_once(now=0)
+    connection.getNotifications.side_effect = cups.IPPError(
+        cups.IPP_NOT_FOUND, 'gone'
+    )
+    tracker.poll_once(now=1)
+    connection.getNotifications.side_effect = None
+    tracker.poll_once(now=2)
+
+    assert connection.createSubscription.call_count == 2
+
+
+def test_status_for_state():
+    assert completion.status_for_state(cups.IPP_JOB_COMPLETED) == \
+        ack.DONE
+    assert completion.status_for_state(cups.IPP_JOB_CANCELED) == \
+        ack.ERROR
+    assert completion.status_for_state(5) is None
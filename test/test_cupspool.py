@@ -0,0 +1,102 @@
+import threading
+
+import mock
+import pytest
+
+from cloudprint import cupspool
+from cloudprint.cloudprint import cups
+
+
+def transport_error():
+    # service-unavailable, as libcups reports an unreachable cupsd
+    return cups.IPPError(0x0502, 'cupsd is gone')
+
+
+@pytest.fixture
+def factory():
+    return mock.Mock(name='factory', side_effect=lambda: mock.Mock())
+
+
+def test_opened_on_first_use(factory):
+    connection = cupspool.ReconnectingConnection(factory)
+    assert not factory.called
+
+    connection.getPrinters()
+    connection.getPrinters()
+
+    assert factory.call_count == 1
+
+
+def test_reconnect_and_retry(factory):
+    connection = cupspool.ReconnectingConnection(factory)
+    connection.getPPD  # open the first connection
+    first = connection._connection
+    first.getPPD.side_effect = transport_error()
+
+    assert connection.getPPD('printer')
+
+    assert factory.call_count == 2
+    assert connection._connection is not first
+    connection._connection.getPPD.assert_called_with('printer')
+
+
+@pytest.mark.parametrize('name, args', [
+    ('writeRequestData', (b'data', 4)),
+    # cupsd may have queued the job before the connection went
+    ('printFile', ('printer', 'path', 'title', {})),
+])
+def test_submit_not_retried(factory, name, args):
+    connection = cupspool.ReconnectingConnection(factory)
+    getattr(connection, name)
+    first = connection._connection
+    getattr(first, name).side_effect = cups.HTTPError(-1)
+
+    with pytest.raises(cups.HTTPError):
+        getattr(connection, name)(*args)
+
+    # the next call goes to a new connection
+    connection.finishDocument('printer')
+    assert factory.call_count == 2
+    assert not first.finishDocument.called
+
+
+def test_refusal_not_retried(factory):
+    connection = cupspool.ReconnectingConnection(factory)
+    connection.printFile
+    first = connection._connection
+    first.printFile.side_effect = cups.IPPError(0x0400, 'bad request')
+
+    with pytest.raises(cups.IPPError):
+        connection.printFile('printer', 'path', 'title', {})
+
+    assert factory.call_count == 1
+
+
+def test_idle_connection_checked(factory):
+    pool = cupspool.ConnectionPool(factory, size=1, idle_check=0)
+    connection = pool.checkout()
+    connection.getPrinters()
+    connection._connection.getDefault.side_effect = transport_error()
+    pool.checkin(connection)
+
+    assert pool.checkout() is connection
+    connection.getPrinters()
+
+    assert factory.call_count == 2
+
+
+def test_pool_size(factory):
+    pool = cupspool.ConnectionPool(factory, size=1)
+    first = pool.checkout()
+    checked_out = []
+
+    thread = threading.Thread(target=lambda: checked_out.append(
+        pool.checkout()
+    ))
+    thread.start()
+    thread.join(0.1)
+    assert not checked_out
+
+    pool.checkin(first)
+    thread.join(5)
+    assert checked_out == [first]
@@ -0,0 +1,97 @@
+import threading
+
+import mock
+import pytest
+
+from cloudprint.executor import JobExecutor
+
+
+def make_printer(printer_id):
+    printer = mock.Mock(name='printer ' + printer_id)
+    printer.id = printer_id
+    return printer
+
+
+@pytest.yield_fixture
+def executor():
+    executors = []
+
+    def executor(process, **kwargs):
+        job_executor = JobExecutor(process, **kwargs)
+        executors.append(job_executor)
+        return job_executor
+
+    yield executor
+
+    for job_executor in executors:
+        job_executor.stop()
+
+
+def test_fifo_per_printer(executor):
+    done = []
+    job_executor = executor(
+        lambda conn, cpp, printer, job: done.append(job['id']),
+        workers=4,
+    )
+    printer = make_printer('1')
+
+    for i in range(20):
+        job_executor.submit(None, printer, {'id': i})
+
+    assert job_executor.join(5)
+    assert done == list(range(20))
+
+
+def test_printers_overlap(executor):
+    release = threading.Event()
+    started = []
+
+    def process(conn, cpp, printer, job):
+        started.append(printer.id)
+        if printer.id == 'slow':
+            release.wait(5)
+
+    job_executor = executor(process, workers=2)
+    job_executor.submit(None, make_printer('slow'), {'id': 'big'})
+    job_executor.submit(None, make_printer('slow'), {'id': 'queued'})
+    job_executor.submit(None, make_printer('fast'), {'id': 'small'})
+
+    # the fast printer is not stuck behind the slow one
+    assert not job_executor.join(0.5)
+    assert started == ['slow', 'fast']
+
+    release.set()
+    assert job_executor.join(5)
+
+
+def test_duplicate_submit(executor):
+    release = threading.Event()
+    job_executor = executor(
+        lambda conn, cpp, printer, job: release.wait(5),
+        workers=1,
+    )
+    printer = make_printer('1')
+
+    assert job_executor.submit(None, printer, {'id': 'job_1'})
+    assert not job_executor.submit(None, printer, {'id': 'job_1'})
+    release.set()
+    assert job_executor.join(5)
+    assert job_executor.submit(None, printer, {'id': 'job_1'})
+
+
+def test_connection_per_worker(executor):
+    cups = mock.Mock(name='cups')
+    connections = []
+    job_executor = executor(
+        lambda conn, cpp, printer, job: connections.append(conn),
+        workers=1,
+        connection_factory=lambda: cups,
+    )
+
+    job_executor.submit(None, make_printer('1'), {'id': 'job_1'})
+    job_executor.submit(None, make_printer('1'), {'id': 'job_2'})
+    assert job_executor.join(5)
+    # checked out of a pool, so the second job reuses the connection
+    assert connections[0] is connections[1]
+    connections[0].getPrinters()
+    assert cups.getPrinters.called
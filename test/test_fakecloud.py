@@ -0,0 +1,75 @@
+import mock
+import pytest
+import requests
+
+from cloudprint import cloudprint
+from cloudprint import fakecloud
+
+
+@pytest.yield_fixture
+def cloud(monkeypatch):
+    with fakecloud.FakeCloudPrint() as cloud:
+        monkeypatch.setattr(cloudprint, 'PRINT_CLOUD_URL', cloud.url)
+        yield cloud
+
+
+@pytest.fixture
+def proxy(tmpdir):
+    auth = cloudprint.CloudPrintAuth(str(tmpdir.join('auth.json')))
+    fakecloud.authorize(auth)
+    return cloudprint.CloudPrintProxy(auth)
+
+
+@pytest.fixture
+def xmpp_conn():
+    xmpp_conn = mock.Mock(name='xmpp')
+    xmpp_conn.await_notification.return_value = False
+    return xmpp_conn
+
+
+def test_sync_registers(cloud, proxy, cups, monkeypatch):
+    monkeypatch.setattr(
+        'cloudprint.cloudprint.get_printer_info',
+        lambda cups, name, attrs=None: ('ppd for ' + name, name),
+    )
+    cups.test_add_printer('printer')
+
+    cloudprint.sync_printers(cups, proxy)
+
+    assert [p['name'] for p in cloud.printers.values()] == ['printer']
+    assert [p.name for p in proxy.get_printers()] == ['printer']
+
+
+def test_jobs_printed(cloud, proxy, cups, xmpp_conn):
+    printer_id = cloud.add_printer('printer')
+    job_ids = cloud.add_jobs(printer_id, 3, size=100)
+    proxy.stream_jobs = False
+
+    cloudprint.process_jobs_once(cups, proxy, xmpp_conn)
+
+    assert cloud.wait_for_jobs(job_ids, 5)
+    assert [cloud.jobs[j].status for j in job_ids] == ['DONE'] * 3
+    assert cups.printFile.call_count == 3
+    assert len(cloud.job_latencies()) == 3
+    assert proxy.get_jobs(printer_id) == []
+
+
+def test_error_injection():
+    with fakecloud.FakeCloudPrint(error_rate=1.0,
+                                  error_endpoints=['fetch']) as cloud:
+        assert requests.post(cloud.url + 'fetch').status_code == 500
+        assert requests.post(cloud.url + 'list').status_code == 200
+        assert cloud.requests == {'fetch': 1, 'list': 1}
+
+
+def test_in_progress_does_not_end_job(cloud, proxy):
+    printer_id = cloud.add_printer('printer')
+    job_id, = cloud.add_jobs(printer_id, 1, size=100)
+
+    proxy.progress_job(job_id)
+    assert cloud.jobs[job_id].status == 'QUEUED'
+    assert cloud.job_latencies() == []
+
+    proxy.finish_job(job_id)
+    assert cloud.jobs[job_id].status == 'DONE'
+    assert len(cloud.job_latencies()) == 1
@@ -0,0 +1,38 @@
+from cloudprint import inflight
+
+
+def test_claim_once():
+    tracker = inflight.JobTracker()
+    job = {'id': 'job_1', 'updateTime': '1'}
+
+    assert tracker.claim(job)
+    assert not tracker.claim(job)
+    assert tracker.is_inflight('job_1')
+
+    tracker.release(job)
+
+    assert not tracker.is_inflight('job_1')
+    assert tracker.claim(job)
+
+
+def test_completed_keyed_on_update_time():
+    tracker = inflight.JobTracker()
+    job = {'id': 'job_1', 'updateTime': '1'}
+
+    tracker.claim(job)
+    tracker.release(job, completed=True)
+
+    assert not tracker.claim(job)
+    assert tracker.claim({'id': 'job_1', 'updateTime': '2'})
+
+
+def test_completed_is_bounded():
+    tracker = inflight.JobTracker(completed_size=2)
+    jobs = [{'id': 'job_%d' % i} for i in range(3)]
+    for job in jobs:
+        tracker.claim(job)
+        tracker.release(job, completed=True)
+
+    # the oldest has been forgotten
+    assert tracker.claim(jobs[0])
+    assert not tracker.claim(jobs[2])
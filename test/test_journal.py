@@ -0,0 +1,61 @@
+from cloudprint import journal
+
+
+def test_states(tmpdir):
+    path = str(tmpdir.join('journal.sqlite'))
+    job_journal = journal.JobJournal(path)
+
+    assert job_journal.state('job_1') is None
+    job_journal.fetched('job_1', 'printer')
+    assert job_journal.state('job_1') == journal.FETCHED
+    job_journal.submitted('job_1', 42)
+    assert job_journal.state('job_1') == journal.SUBMITTED
+    assert job_journal.cups_job_id('job_1') == 42
+    job_journal.acknowledged('job_1')
+    assert job_journal.state('job_1') == journal.ACKNOWLEDGED
+    assert job_journal.cups_job_id('job_1') == 42
+
+
+def test_survives_reopen(tmpdir):
+    path = str(tmpdir.join('journal.sqlite'))
+    job_journal = journal.JobJournal(path)
+    job_journal.fetched('job_1', 'printer')
+    job_journal.submitted('job_1', 1)
+    job_journal.fetched('job_2', 'printer')
+    job_journal.submitted('job_2', 2)
+    job_journal.acknowledged('job_2')
+    job_journal.fetched('job_3', 'printer')
+    # no close(): the process died
+
+    assert journal.JobJournal(path).pending_acks() == [
+        ('job_1', 'printer', journal.SUBMITTED),
+    ]
+
+
+def test_prune():
+    job_journal = journal.JobJournal()
+    job_journal.fetched('job_1', 'printer')
+    job_journal.acknowledged('job_1')
+    job_journal.fetched('job_2', 'printer')
+    job_journal.submitted('job_2', 2)
+
+    job_journal.prune(keep=-1)
+
+    assert job_journal.state('job_1') is None
+    assert job_journal.state('job_2') == journal.SUBMITTED
+
+
+def test_pending_acks(tmpdir):
+    job_journal = journal.JobJournal(str(tmpdir.join('journal.sqlite')))
+    job_journal.fetched('job_1', 'printer')
+    job_journal.submitted('job_1', 1)
+    job_journal.fetched('job_2', 'printer')
+    job_journal.failed('job_2')
+    job_journal.fetched('job_3', 'printer')
+    job_journal.submitted('job_3', 3)
+    job_journal.acknowledged('job_3')
+
+    assert job_journal.pending_acks() == [
+        ('job_1', 'printer', journal.SUBMITTED),
+        ('job_2', 'printer', journal.FAILED),
+    ]
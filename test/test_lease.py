@@ -0,0 +1,89 @@
+import time
+
+import pytest
+
+from cloudprint import lease
+
+
+@pytest.fixture(params=['local', 'sqlite'])
+def nodes(request, tmpdir):
+    """Two nodes sharing their leases"""
+    if request.param == 'local':
+        store = {}
+        return [
+            lease.LocalLeases('node-%d' % i, ttl=60, store=store)
+            for i in range(2)
+        ]
+    path = str(tmpdir.join('leases.sqlite'))
+    return [
+        lease.SQLiteLeases(path, 'node-%d' % i, ttl=60) for i in range(2)
+    ]
+
+
+def test_one_holder(nodes):
+    a, b = nodes
+
+    assert a.acquire('job_1')
+    assert a.acquire('job_1')
+    assert not b.acquire('job_1')
+    assert b.acquire('job_2')
+    assert a.held() == set(['job_1'])
+
+
+def test_release(nodes):
+    a, b = nodes
+    a.acquire('job_1')
+
+    a.release('job_1')
+
+    assert b.acquire('job_1')
+
+
+def test_done_lease_runs_out(nodes):
+    a, b = nodes
+    a.acquire('job_1')
+
+    a.done('job_1')
+
+    assert not a.held()
+    assert not b.acquire('job_1')
+    a.ttl = b.ttl = -1
+    a.acquire('job_2')
+    assert b.acquire('job_2')
+
+
+def test_expired_lease_is_taken(nodes):
+    a, b = nodes
+    a.ttl = -1
+    a.acquire('job_1')
+
+    assert b.acquire('job_1')
+
+    a.renew()
+    assert not a.held()
+
+
+def test_watch(nodes):
+    a, b = nodes
+    a.acquire('job_1')
+    expires = time.time() + a.ttl
+
+    assert not b.acquire('job_1')
+    b.watch('printer', 'job_1')
+
+    assert b.next_due_in() == pytest.approx(a.ttl, abs=1)
+    assert b.due_printers() == set()
+    assert b.due_printers(now=expires + 1) == set(['printer'])
+    assert b.next_due_in() is None
+
+
+def test_renew(nodes):
+    a, b = nodes
+    a.ttl = 0.01
+    a.acquire('job_1')
+    a.ttl = 60
+
+    a.renew()
+    time.sleep(0.02)
+
+    assert not b.acquire('job_1')
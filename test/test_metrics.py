@@ -0,0 +1,92 @@
+import pytest
+
+try:
+    from urllib.request import urlopen
+except ImportError:
+    from urllib2 import urlopen
+
+from cloudprint import metrics
+
+
+@pytest.fixture
+def registry():
+    return metrics.Registry()
+
+
+def test_counter(registry):
+    counter = metrics.Counter(
+        'jobs_total', 'Jobs.', ['printer', 'outcome'], registry=registry,
+    )
+    counter.labels('a', 'done').inc()
+    counter.labels('a', 'done').inc(2)
+    counter.labels('b', 'error').inc()
+
+    assert registry.render() == (
+        '# HELP jobs_total Jobs.\n'
+        '# TYPE jobs_total counter\n'
+        'jobs_total{printer="a",outcome="done"} 3\n'
+        'jobs_total{printer="b",outcome="error"} 1\n'
+    )
+
+
+def test_unlabelled_counter(registry):
+    counter = metrics.Counter('reconnects_total', 'R.', registry=registry)
+    counter.inc()
+
+    assert 'reconnects_total 1\n' in registry.render()
+
+
+def test_wrong_labels(registry):
+    counter = metrics.Counter('c', 'C.', ['printer'], registry=registry)
+
+    with pytest.raises(ValueError):
+        counter.labels('a', 'b')
+
+
+def test_histogram(registry):
+    histogram = metrics.Histogram(
+        'seconds', 'S.', ['printer'], buckets=(1, 5), registry=registry,
+    )
+    for value in (0.5, 1, 3, 10):
+        histogram.labels('a').observe(value)
+
+    assert registry.render().splitlines()[2:] == [
+        'seconds_bucket{printer="a",le="1"} 2',
+        'seconds_bucket{printer="a",le="5"} 3',
+        'seconds_bucket{printer="a",le="+Inf"} 4',
+        'seconds_sum{printer="a"} 14.5',
+        'seconds_count{printer="a"} 4',
+    ]
+    assert histogram.labels('a').count == 4
+
+
+def test_label_escaping(registry):
+    counter = metrics.Counter('c', 'C.', ['printer'], registry=registry)
+    counter.labels('say "hi"\\\n').inc()
+
+    assert 'c{printer="say \\"hi\\"\\\\\\n"} 1' in registry.render()
+
+
+def test_dump(registry, tmpdir):
+    metrics.Counter('c', 'C.', registry=registry).inc()
+    path = str(tmpdir.join('metrics.prom'))
+
+    metrics.dump(path, registry)
+
+    with open(path) as f:
+        assert f.read() == registry.render()
+    assert tmpdir.listdir() == [tmpdir.join('metrics.prom')]
+
+
+def test_serve(registry):
+    metrics.Counter('c', 'C.', registry=registry).inc()
+    server = metrics.serve(0, registry=registry)
+    try:
+        response = urlopen('http://127.0.0.1:{0}/metrics'.format(
+            server.server_address[1]
+        ))
+        assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+        assert response.read().decode('utf-8') == registry.render()
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -166,3 +166,53 @@ def test_fail_job(proxy, requests):
     data = parse.parse_qs(requests.request_history[0].text)
     assert data['jobid'][0] == '1'
     assert data['status'][0] == 'ERROR'
+
+
+def test_get_printers_caps(proxy, requests):
+    requests.post(
+        PRINT_CLOUD_URL + 'list',
+        json={
+            'printers': [
+                {
+                    'id': '1',
+                    'name': 'printer 1',
+                    'capsHash': 'abc123',
+                    'description': 'printer_description',
+                },
+            ]
+        },
+    )
+
+    printer, = proxy.get_printers()
+
+    assert printer.caps_hash == 'abc123'
+    assert printer.description == 'printer_description'
+
+
+def test_registry(proxy, requests):
+    requests.post(
+        PRINT_CLOUD_URL + 'list',
+        json={
+            'printers': [
+                {
+                    'id': '1',
+                    'name': 'printer 1',
+                },
+            ]
+        },
+    )
+    requests.post(
+        PRINT_CLOUD_URL + 'fetch',
+        json={
+            'success': False,
+            'errorCode': 1,
+        }
+    )
+
+    assert proxy.registry.get('1').name.endswith('printer 1')
+    assert proxy.registry.get('1').name.endswith('printer 1')
+    assert requests.call_count == 1
+
+    assert proxy.get_jobs(printer_id='1') == []
+    assert proxy.registry.printers()[0].id == '1'
+    assert requests.call_count == 3
@@ -1,7 +1,21 @@
+import io
+import json
+import select
+import threading
+import time
+
 import mock
 import pytest
+from cups import IPP_JOB_COMPLETED
 
+from cloudprint import ack
 from cloudprint import cloudprint
+from cloudprint import completion
+from cloudprint import executor
+from cloudprint import journal
+from cloudprint import lease
+from cloudprint import metrics
+from cloudprint import tracing
 
 
 @pytest.fixture
@@ -12,8 +26,6 @@ def xmpp_conn(monkeypatch):
 
 
 def test_print(requests, cups, cpp, xmpp_conn):
-    cloudprint.num_retries = 0
-
     printer = cpp.test_add_printer('printer')
     printer.get_jobs.return_value = [{
         'fileUrl': 'http://print_job.pdf',
@@ -47,12 +59,10 @@ def test_print(requests, cups, cpp, xmpp_conn):
     )
     cpp.finish_job.assert_called_with('job_1')
     assert xmpp_conn.await_notification.called
-    assert cloudprint.num_retries == 0
+    assert cpp.retries.attempts('job_1') == 0
 
 
 def test_retry(requests, cups, cpp, xmpp_conn):
-    cloudprint.num_retries = 0
-
     printer = cpp.test_add_printer('printer')
     printer.get_jobs.return_value = [{
         'fileUrl': 'http://print_job.pdf',
@@ -65,12 +75,69 @@ def test_retry(requests, cups, cpp, xmpp_conn):
 
     cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
 
-    assert cloudprint.num_retries == 1
+    assert cpp.retries.attempts('job_1') == 1
+    assert cpp.retries.is_scheduled('job_1')
+    assert not cpp.fail_job.called
 
 
-def test_failed(requests, cups, cpp, xmpp_conn):
-    cloudprint.num_retries = 0
+class WakeableXmpp(object):
+    """An XMPP connection with no notifications, waiting at most a second
+    on what it is asked to wake for"""
+
+    def __init__(self):
+        self.waits = []
+
+    def is_connected(self):
+        return True
+
+    def await_notification(self, timeout, wakeup=()):
+        start = time.time()
+        select.select(list(wakeup), [], [], min(timeout, 1))
+        self.waits.append((timeout, time.time() - start))
+        return False
+
+
+def test_retry_from_worker(requests, cups, cpp):
+    cpp.sleeptime = 3600
+    cpp.retries.delay = 0.2
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'id': 'job_1',
+    }]
+    downloads = []
+
+    def download(request, context):
+        downloads.append(time.time())
+        context.status_code = 500
+        return ''
+
+    requests.get('http://print_job.pdf', text=download)
+    job_executor = executor.JobExecutor(cloudprint.process_job, workers=1)
+    xmpp_conn = WakeableXmpp()
+
+    printer_ids = None
+    for _ in range(5):
+        if len(downloads) == 2:
+            break
+        printer_ids = cloudprint.process_jobs_once(
+            cups, cpp, xmpp_conn, job_executor, printer_ids,
+        )
+    job_executor.stop()
 
+    # the failure on the worker cut the hour long wait short, and the
+    # retry ran on its own timer
+    assert len(downloads) == 2
+    assert downloads[1] - downloads[0] < 0.2 * 1.25 + 0.5
+    timeout, waited = xmpp_conn.waits[0]
+    assert 3599 < timeout <= 3600
+    assert waited < 0.5
+    assert xmpp_conn.waits[1][0] <= 0.2 * 1.25
+
+
+def test_failed(requests, cups, cpp, xmpp_conn):
     printer = cpp.test_add_printer('printer')
     printer.get_jobs.return_value = [{
         'fileUrl': 'http://print_job.pdf',
@@ -81,8 +148,626 @@ def test_failed(requests, cups, cpp, xmpp_conn):
 
     requests.get(url='http://print_job.pdf', status_code=500)
 
-    for _ in range(cloudprint.RETRIES + 1):
+    for _ in range(cpp.retries.retries + 1):
         cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
 
     cpp.fail_job.assert_called_with('job_1')
-    assert cloudprint.num_retries == 0
+    assert cpp.retries.attempts('job_1') == 0
+    assert not cpp.retries.is_scheduled('job_1')
+
+
+def test_retry_is_per_job(requests, cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://bad.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'bad',
+        'ownerId': 'owner',
+        'id': 'bad',
+    }, {
+        'fileUrl': 'http://good.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'good',
+        'ownerId': 'owner',
+        'id': 'good',
+    }]
+
+    requests.get(url='http://bad.pdf', status_code=500)
+    requests.get(url='http://good.pdf', text='This is a PDF')
+    requests.get(url='http://ticket', json={'request': ''})
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    # the job that printed doesn't reset the one that failed
+    cpp.finish_job.assert_called_with('good')
+    assert cpp.retries.attempts('bad') == 1
+    assert cpp.retries.attempts('good') == 0
+
+
+def test_scheduled_job_skipped_by_poll(requests, cups, cpp, xmpp_conn):
+    cpp.retries.delay = 3600
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'id': 'job_1',
+    }]
+
+    requests.get(url='http://print_job.pdf', status_code=500)
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    downloads = [
+        r for r in requests.request_history
+        if r.url == 'http://print_job.pdf/'
+    ]
+    assert len(downloads) == 1
+    assert cpp.retries.attempts('job_1') == 1
+
+
+def test_submit_to_executor(cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('printer')
+    job = {'id': 'job_1'}
+    printer.get_jobs.return_value = [job]
+    job_executor = mock.Mock(name='executor')
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn, job_executor)
+
+    job_executor.submit.assert_called_with(cpp, printer, job)
+    assert not cups.printFile.called
+
+
+def test_stream_print(requests, cups, cpp, xmpp_conn):
+    cpp.stream_jobs = True
+    cups.createJob.return_value = 42
+    cups.startDocument.return_value = cloudprint.cups.HTTP_CONTINUE
+    cups.writeRequestData.return_value = cloudprint.cups.HTTP_CONTINUE
+
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={'a': 1})
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    cups.createJob.assert_called_with('printer', '[owner]title', {'a': '1'})
+    cups.startDocument.assert_called_with(
+        'printer', 42, '[owner]title', mock.ANY, 1,
+    )
+    data = b''.join(
+        call[0][0] for call in cups.writeRequestData.call_args_list
+    )
+    assert data == b'This is a PDF'
+    cups.finishDocument.assert_called_with('printer')
+    assert not cups.printFile.called
+    cpp.finish_job.assert_called_with('job_1')
+
+
+def test_stream_print_cancels_on_error(requests, cups, cpp, xmpp_conn):
+    cpp.stream_jobs = True
+    cups.createJob.return_value = 42
+    cups.startDocument.return_value = cloudprint.cups.HTTP_CONTINUE
+    cups.writeRequestData.return_value = 500
+
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={})
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    cups.cancelJob.assert_called_with(42)
+    assert not cpp.finish_job.called
+
+
+def test_ticket_and_document_fetched_together(cups, cpp):
+    ticket_started = threading.Event()
+    document_started = threading.Event()
+
+    def get(url, stream=False):
+        response = mock.Mock(name=url)
+        if url == 'http://ticket':
+            ticket_started.set()
+            assert document_started.wait(5)
+            response.json.return_value = {'a': 1}
+        else:
+            document_started.set()
+            assert ticket_started.wait(5)
+            response.raw = io.BytesIO(b'This is a PDF')
+        return response
+
+    cpp.auth.session = mock.Mock(name='session')
+    cpp.auth.session.get.side_effect = get
+
+    printer = cpp.test_add_printer('printer')
+    cloudprint.process_job(cups, cpp, printer, {
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'title',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    })
+
+    cups.printFile.assert_called_with(
+        'printer', mock.ANY, '[owner]title', {'a': '1'},
+    )
+    cpp.finish_job.assert_called_with('job_1')
+
+
+def test_targeted_fetch(cups, cpp, xmpp_conn):
+    printer_1 = cpp.test_add_printer('printer 1')
+    printer_1.id = '1'
+    printer_1.get_jobs.return_value = []
+    printer_2 = cpp.test_add_printer('printer 2')
+    printer_2.id = '2'
+    printer_2.get_jobs.return_value = []
+
+    xmpp_conn.await_notification.return_value = True
+    xmpp_conn.pop_notified_printers.return_value = set(['2'])
+
+    printer_ids = cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+    assert printer_ids == set(['2'])
+    assert printer_1.get_jobs.called
+    assert printer_2.get_jobs.called
+
+    printer_1.get_jobs.reset_mock()
+    printer_2.get_jobs.reset_mock()
+    xmpp_conn.await_notification.return_value = False
+
+    # woken before the sweep is due: nothing more to fetch next time
+    assert cloudprint.process_jobs_once(
+        cups, cpp, xmpp_conn, printer_ids=printer_ids,
+    ) == set()
+    assert not printer_1.get_jobs.called
+    assert printer_2.get_jobs.called
+
+
+def test_sweep_despite_steady_notifications(cups, cpp, xmpp_conn):
+    printer_1 = cpp.test_add_printer('printer 1')
+    printer_1.id = '1'
+    printer_1.get_jobs.return_value = []
+    printer_2 = cpp.test_add_printer('printer 2')
+    printer_2.id = '2'
+    printer_2.get_jobs.return_value = []
+
+    xmpp_conn.await_notification.return_value = True
+    xmpp_conn.pop_notified_printers.return_value = set(['2'])
+
+    printer_ids = cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+    sweep_at = cpp.sweep_at
+    assert sweep_at > time.time()
+    timeout = xmpp_conn.await_notification.call_args[0][0]
+    assert cloudprint.POLL_PERIOD - 1 < timeout <= cloudprint.POLL_PERIOD
+
+    printer_1.get_jobs.reset_mock()
+    printer_ids = cloudprint.process_jobs_once(
+        cups, cpp, xmpp_conn, printer_ids=printer_ids,
+    )
+    assert not printer_1.get_jobs.called
+
+    # a push arriving every loop doesn't push the sweep back
+    assert cpp.sweep_at == sweep_at
+
+    cpp.sweep_at = time.time() - 1
+    cloudprint.process_jobs_once(
+        cups, cpp, xmpp_conn, printer_ids=printer_ids,
+    )
+    assert printer_1.get_jobs.called
+
+
+def test_no_list_in_steady_state(cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = []
+    xmpp_conn.await_notification.return_value = False
+
+    for _ in range(3):
+        cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    assert cpp.get_printers.call_count == 1
+    assert printer.get_jobs.call_count == 3
+
+
+def test_journal_records_print(requests, cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+    cups.printFile.return_value = 7
+
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={'request': ''})
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
+    assert cpp.journal.cups_job_id('job_1') == 7
+
+
+def test_submitted_job_not_reprinted(cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{'id': 'job_1', 'title': 'job'}]
+    cpp.journal.fetched('job_1', printer.id)
+    cpp.journal.submitted('job_1', 7)
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    assert not cups.printFile.called
+    cpp.finish_job.assert_called_with('job_1')
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
+
+
+def test_ack_lost_is_retried_without_reprint(requests, cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+    cpp.finish_job.side_effect = [Exception('control failed'), None]
+
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={'request': ''})
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    assert cups.printFile.call_count == 1
+    assert cpp.finish_job.call_count == 2
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
+
+
+def test_acknowledge_submitted(cpp):
+    cpp.journal.fetched('job_1', 'printer')
+    cpp.journal.submitted('job_1', 7)
+    cpp.journal.fetched('job_2', 'printer')
+
+    cloudprint.acknowledge_submitted(cpp)
+
+    cpp.finish_job.assert_called_once_with('job_1')
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
+    assert cpp.journal.state('job_2') == journal.FETCHED
+
+
+def test_inflight_job_not_dispatched_twice(cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('printer')
+    job = {'id': 'job_1', 'updateTime': '1'}
+    printer.get_jobs.return_value = [job]
+    job_executor = mock.Mock(name='executor')
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn, job_executor)
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn, job_executor, None)
+
+    job_executor.submit.assert_called_once_with(cpp, printer, job)
+
+
+def test_completed_job_dropped(cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('printer')
+    job = {'id': 'job_1', 'title': 'job', 'updateTime': '1'}
+    printer.get_jobs.return_value = [job]
+    # printed, but a fetch that raced the acknowledgement still has it
+    cpp.jobs.claim(job)
+    cpp.jobs.release(job, completed=True)
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    assert cpp.journal.state('job_1') is None
+    assert not cpp.finish_job.called
+
+
+def test_job_leased_elsewhere_skipped(cups, cpp, xmpp_conn):
+    store = {}
+    other_node = lease.LocalLeases('other', store=store)
+    cpp.leases = lease.LocalLeases('this', store=store)
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{'id': 'job_1'}, {'id': 'job_2'}]
+    job_executor = mock.Mock(name='executor')
+    other_node.acquire('job_1')
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn, job_executor)
+
+    job_executor.submit.assert_called_once_with(
+        cpp, printer, {'id': 'job_2'}
+    )
+    assert not cpp.jobs.is_inflight('job_1')
+
+
+def test_job_leased_to_dead_node(cups, cpp, xmpp_conn):
+    store = {}
+    other_node = lease.LocalLeases('other', ttl=0.2, store=store)
+    cpp.leases = lease.LocalLeases('this', store=store)
+    cpp.sleeptime = 3600
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{'id': 'job_1'}]
+    job_executor = mock.Mock(name='executor')
+    other_node.acquire('job_1')
+    xmpp_conn.await_notification.return_value = False
+
+    printer_ids = cloudprint.process_jobs_once(
+        cups, cpp, xmpp_conn, job_executor
+    )
+    assert not job_executor.submit.called
+    # woken once the lease ran out, not after the hour long poll period
+    assert xmpp_conn.await_notification.call_args[0][0] <= 0.2
+    time.sleep(0.2)
+
+    cloudprint.process_jobs_once(
+        cups, cpp, xmpp_conn, job_executor, printer_ids
+    )
+    job_executor.submit.assert_called_once_with(
+        cpp, printer, {'id': 'job_1'}
+    )
+
+
+def test_claim_released_when_lease_fails(cups, cpp, xmpp_conn, monkeypatch):
+    monkeypatch.setattr(cloudprint, 'FAIL_RETRY', 0)
+    cpp.leases = lease.LocalLeases('this')
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{'id': 'job_1'}]
+    job_executor = mock.Mock(name='executor')
+
+    with mock.patch.object(cpp.leases, '_acquire',
+                           side_effect=Exception('database is locked')):
+        cloudprint.process_jobs_once(cups, cpp, xmpp_conn, job_executor)
+    assert not cpp.jobs.is_inflight('job_1')
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn, job_executor)
+    job_executor.submit.assert_called_once_with(
+        cpp, printer, {'id': 'job_1'}
+    )
+
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_job_metrics(requests, cups, cpp, xmpp_conn, stream):
+    cpp.stream_jobs = stream
+    cups.startDocument.return_value = cloudprint.cups.HTTP_CONTINUE
+    cups.writeRequestData.return_value = cloudprint.cups.HTTP_CONTINUE
+    name = 'metered {0}'.format(stream)
+    printer = cpp.test_add_printer(name)
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={})
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    download_bytes = metrics.DOWNLOAD_BYTES.labels(name)
+    assert download_bytes.count == 1
+    assert download_bytes.sum == len('This is a PDF')
+    for histogram in (metrics.DOWNLOAD_SECONDS, metrics.TICKET_SECONDS,
+                      metrics.SUBMIT_SECONDS, metrics.CONTROL_SECONDS):
+        assert histogram.labels(name).count == 1
+    assert metrics.JOBS.labels(name, 'done').value == 1
+
+
+def test_retry_metrics(requests, cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('metered retry')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+
+    requests.get(url='http://print_job.pdf', status_code=500)
+
+    for _ in range(cpp.retries.retries + 1):
+        cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    assert metrics.RETRIES.labels('metered retry').value == \
+        cpp.retries.retries
+    assert metrics.JOBS.labels('metered retry', 'error').value == 1
+
+
+def test_job_traced(requests, cups, cpp, xmpp_conn, tmpdir):
+    path = tmpdir.join('trace.jsonl')
+    cpp.tracer = tracing.Tracer(str(path))
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = []
+    cups.printFile.return_value = 7
+    xmpp_conn.await_notification.return_value = True
+    xmpp_conn.pop_notified_printers.return_value = set([printer.id])
+
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={})
+
+    printer_ids = cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn, None, printer_ids)
+
+    [trace] = [json.loads(line) for line in path.readlines()]
+    assert trace['outcome'] == 'done'
+    spans = dict((s['name'], s) for s in trace['spans'])
+    assert set(spans) == set([
+        'notification', 'fetch', 'ticket', 'download_first_byte',
+        'download', 'submit', 'control',
+    ])
+    assert spans['notification']['start'] == 0
+    assert spans['submit']['cups_job_id'] == 7
+    assert spans['download']['bytes'] == len('This is a PDF')
+
+
+def test_acknowledged_in_background(requests, cups, cpp, xmpp_conn):
+    cpp.acks = ack.Acknowledger(cpp, delay=0)
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={})
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    assert cups.printFile.called
+    assert not cpp.finish_job.called
+    assert cpp.journal.state('job_1') == journal.SUBMITTED
+    assert not cpp.jobs.is_inflight('job_1')
+
+    cpp.acks.start()
+    assert cpp.acks.join(5)
+    cpp.finish_job.assert_called_once_with('job_1')
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
+    cpp.acks.stop()
+
+
+def test_failed_job_not_reprinted(cups, cpp, xmpp_conn):
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{'id': 'job_1', 'title': 'job'}]
+    cpp.journal.fetched('job_1', printer.id)
+    cpp.journal.failed('job_1')
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    assert not cups.printFile.called
+    cpp.fail_job.assert_called_once_with('job_1')
+
+
+def test_acknowledge_queued_from_journal(cpp):
+    cpp.acks = ack.Acknowledger(cpp)
+    cpp.journal.fetched('job_1', 'printer')
+    cpp.journal.submitted('job_1', 1)
+    cpp.journal.fetched('job_2', 'printer')
+    cpp.journal.failed('job_2')
+
+    cloudprint.acknowledge_submitted(cpp)
+
+    assert cpp.acks.pending() == 2
+    assert not cpp.finish_job.called
+
+
+def test_done_once_printed(requests, cups, cpp, xmpp_conn):
+    cpp.completions = completion.CompletionTracker(mock.Mock())
+    cups.printFile.return_value = 7
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={})
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+
+    cpp.progress_job.assert_called_once_with('job_1')
+    assert not cpp.finish_job.called
+    assert cups.printFile.call_count == 1
+    assert cpp.completions.is_tracking('job_1')
+    assert cpp.journal.state('job_1') == journal.SUBMITTED
+
+
+def test_tracked_from_journal(cpp):
+    cpp.completions = completion.CompletionTracker(mock.Mock())
+    cpp.journal.fetched('job_1', 'printer')
+    cpp.journal.submitted('job_1', 7)
+
+    cloudprint.acknowledge_submitted(cpp)
+
+    assert not cpp.finish_job.called
+    assert cpp.completions.is_tracking('job_1')
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_printed_before_tracked(requests, cups, cpp, xmpp_conn, background):
+    if background:
+        cpp.acks = ack.Acknowledger(cpp, delay=0)
+    cpp.completions = completion.CompletionTracker(mock.Mock())
+    # CUPS says job 7 ended before process_job gets to track it
+    cpp.completions._ended(7, IPP_JOB_COMPLETED)
+    cups.printFile.return_value = 7
+    printer = cpp.test_add_printer('printer')
+    printer.get_jobs.return_value = [{
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }]
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={})
+    sent = []
+    cpp.progress_job.side_effect = lambda job_id: sent.append('IN_PROGRESS')
+    cpp.finish_job.side_effect = lambda job_id: sent.append('DONE')
+
+    cloudprint.process_jobs_once(cups, cpp, xmpp_conn)
+    if background:
+        cpp.acks.start()
+        assert cpp.acks.join(5)
+        cpp.acks.stop()
+
+    assert sent[-1] == 'DONE'
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
+    assert not cpp.completions.is_tracking('job_1')
+
+
+def test_printed_never_failed(requests, cups, cpp, xmpp_conn):
+    cups.printFile.return_value = 7
+    cpp.retries.delay = 0
+    cpp.finish_job.side_effect = Exception('control failed')
+    printer = cpp.test_add_printer('printer')
+    job = {
+        'fileUrl': 'http://print_job.pdf',
+        'ticketUrl': 'http://ticket',
+        'title': 'job',
+        'ownerId': 'owner',
+        'id': 'job_1',
+    }
+    requests.get('http://print_job.pdf', text='This is a PDF')
+    requests.get('http://ticket', json={})
+
+    for _ in range(cpp.retries.retries + 3):
+        cpp.jobs.claim(job)
+        cloudprint.process_job(cups, cpp, printer, job)
+
+    assert cups.printFile.call_count == 1
+    assert not cpp.fail_job.called
+    assert cpp.journal.state('job_1') == journal.SUBMITTED
+    assert cpp.retries.is_scheduled('job_1')
+
+    cpp.finish_job.side_effect = None
+    cpp.jobs.claim(job)
+    cloudprint.process_job(cups, cpp, printer, job)
+    assert cpp.journal.state('job_1') == journal.ACKNOWLEDGED
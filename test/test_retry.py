@@ -0,0 +1,84 @@
+import select
+
+import mock
+
+from cloudprint import retry
+
+
+def job(job_id):
+    return {'id': job_id}
+
+
+def test_backoff_doubles():
+    scheduler = retry.RetryScheduler(delay=10, max_delay=35, jitter=0)
+
+    assert scheduler.backoff(1) == 10
+    assert scheduler.backoff(2) == 20
+    assert scheduler.backoff(3) == 35
+
+
+def test_backoff_jitter():
+    scheduler = retry.RetryScheduler(delay=10, jitter=0.5)
+
+    for _ in range(100):
+        assert 5 <= scheduler.backoff(1) <= 15
+
+
+def test_exhausted():
+    scheduler = retry.RetryScheduler(retries=2, delay=0)
+    printer = mock.Mock()
+
+    assert scheduler.failed(printer, job('a'))
+    assert scheduler.pop_due() == [(printer, job('a'))]
+    assert scheduler.failed(printer, job('a'))
+    assert scheduler.attempts('a') == 2
+    assert scheduler.pop_due() == [(printer, job('a'))]
+    assert not scheduler.failed(printer, job('a'))
+    assert scheduler.attempts('a') == 0
+
+
+def test_pop_due_in_order():
+    scheduler = retry.RetryScheduler(retries=3, delay=10, jitter=0)
+    printer = mock.Mock()
+
+    with mock.patch('time.time', return_value=1000):
+        scheduler.failed(printer, job('a'))
+        scheduler.failed(printer, job('b'))
+        scheduler.pop_due(now=1011)
+        scheduler.failed(printer, job('b'))
+
+    assert scheduler.next_due_in(now=1015) == 5
+    assert scheduler.pop_due(now=1015) == []
+    assert scheduler.is_scheduled('b')
+    assert scheduler.pop_due(now=1020) == [(printer, job('b'))]
+    assert scheduler.next_due_in(now=1020) is None
+    assert len(scheduler) == 0
+
+
+def test_succeeded_cancels_retry():
+    scheduler = retry.RetryScheduler(delay=0)
+    printer = mock.Mock()
+
+    scheduler.failed(printer, job('a'))
+    scheduler.succeeded('a')
+
+    assert not scheduler.is_scheduled('a')
+    assert scheduler.next_due_in() is None
+    assert scheduler.pop_due() == []
+
+
+def test_wakeup():
+    scheduler = retry.RetryScheduler(retries=3, delay=10, jitter=0)
+    printer = mock.Mock()
+
+    assert not scheduler.clear_wakeup()
+    with mock.patch('time.time', return_value=1000):
+        scheduler.failed(printer, job('a'))
+    assert select.select([scheduler], [], [], 0)[0] == [scheduler]
+    assert scheduler.clear_wakeup()
+    assert select.select([scheduler], [], [], 0)[0] == []
+
+    # a retry due after one already waiting needs no wakeup
+    with mock.patch('time.time', return_value=1001):
+        scheduler.failed(printer, job('b'))
+    assert not scheduler.clear_wakeup()
@@ -1,4 +1,5 @@
 import mock
+import pytest
 
 from cloudprint import cloudprint
 
@@ -48,3 +49,135 @@ def test_sync_update_printer(cups, cpp):
         old_printer.description,
         old_printer.ppd,
     )
+
+
+def test_sync_unchanged_printer(cups, cpp):
+    cups.test_add_printer('old')
+    old_printer = cpp.test_add_printer('old')
+    old_printer.caps_hash = cloudprint.caps_hash(old_printer.ppd)
+
+    result = cloudprint.sync_printers(cups, cpp)
+
+    assert not old_printer.update.called
+    assert result == cloudprint.SyncResult(
+        added=0, updated=0, unchanged=1, removed=0,
+    )
+
+
+def test_sync_counts(cups, cpp):
+    cups.test_add_printer('new')
+    cups.test_add_printer('changed')
+    cpp.test_add_printer('changed')
+    cpp.test_add_printer('gone')
+
+    result = cloudprint.sync_printers(cups, cpp)
+
+    assert result == cloudprint.SyncResult(
+        added=1, updated=1, unchanged=0, removed=1,
+    )
+
+
+def test_get_printer_info_bulk_attrs(tmpdir):
+    ppd_path = tmpdir.join('ppd')
+    ppd_path.write('this is a ppd')
+
+    cups = mock.Mock(name='cups')
+    cups.getPPD.return_value = str(ppd_path)
+
+    ppd, description = cloudprint.get_printer_info(
+        cups, 'foo', {'printer-info': 'desc'}
+    )
+
+    assert ppd == 'this is a ppd'
+    assert description == 'desc'
+    assert not cups.getPrinterAttributes.called
+    assert not ppd_path.check()
+
+
+def test_printer_info_cache_change_time(tmpdir, monkeypatch):
+    monkeypatch.setattr(cloudprint, 'CUPS_PPD_DIR', str(tmpdir.join('none')))
+
+    def get_ppd(name):
+        ppd_path = tmpdir.join(name)
+        ppd_path.write('this is a ppd')
+        return str(ppd_path)
+
+    cups = mock.Mock(name='cups')
+    cups.getPPD.side_effect = get_ppd
+    cache = cloudprint.PrinterInfoCache()
+    attrs = {'printer-info': 'desc', 'printer-state-change-time': 1}
+
+    first = cache.get(cups, 'foo', attrs)
+    second = cache.get(cups, 'foo', attrs)
+
+    assert first == second == (
+        'this is a ppd', 'desc', cloudprint.caps_hash('this is a ppd'),
+    )
+    assert cups.getPPD.call_count == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    attrs['printer-state-change-time'] = 2
+    cache.get(cups, 'foo', attrs)
+    assert cups.getPPD.call_count == 2
+
+
+def test_printer_info_cache_ppd_file(tmpdir, monkeypatch):
+    monkeypatch.setattr(cloudprint, 'CUPS_PPD_DIR', str(tmpdir))
+    ppd_path = tmpdir.join('foo.ppd')
+    ppd_path.write('this is a ppd')
+
+    cups = mock.Mock(name='cups')
+    cache = cloudprint.PrinterInfoCache()
+    attrs = {'printer-info': 'desc'}
+
+    assert cache.get(cups, 'foo', attrs)[0] == 'this is a ppd'
+    assert cache.get(cups, 'foo', attrs)[0] == 'this is a ppd'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    ppd_path.write('this is a longer ppd')
+    assert cache.get(cups, 'foo', attrs)[0] == 'this is a longer ppd'
+    assert not cups.getPPD.called
+
+
+def test_sync_fills_registry(cups, cpp):
+    cups.test_add_printer('old')
+    old_printer = cpp.test_add_printer('old')
+
+    cloudprint.sync_printers(cups, cpp)
+
+    assert cpp.registry.get_by_name('old') is old_printer
+    assert cpp.get_printers.call_count == 1
+
+
+def test_printer_filter():
+    printer_filter = cloudprint.PrinterFilter(
+        include=['lp', 'office'],
+        exclude=['lp-broken'],
+    )
+
+    assert printer_filter('lp2up')
+    assert printer_filter('office-1')
+    assert not printer_filter('lp-broken')
+    assert not printer_filter('GCP-lp')
+
+
+def test_printer_filter_default():
+    printer_filter = cloudprint.PrinterFilter()
+
+    assert printer_filter('anything')
+
+
+def test_printer_filter_invalid():
+    with pytest.raises(ValueError):
+        cloudprint.PrinterFilter(include=['lp('])
+
+
+def test_sync_filters(cups, cpp):
+    cups.test_add_printer('lp')
+    cups.test_add_printer('GCP-lp')
+    cpp.printer_filter = cloudprint.PrinterFilter(exclude=['GCP-'])
+
+    result = cloudprint.sync_printers(cups, cpp)
+
+    cpp.add_printer.assert_called_once_with('lp', mock.ANY, mock.ANY)
+    assert result.added == 1
@@ -0,0 +1,80 @@
+import json
+
+import mock
+
+from cloudprint import tracing
+
+
+def printer(name='printer'):
+    printer = mock.Mock()
+    printer.name = name
+    return printer
+
+
+def traces(path):
+    with open(str(path)) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_disabled():
+    tracer = tracing.Tracer()
+
+    assert not tracer.enabled
+    assert tracer.fetched('p', 0) is None
+    tracer.begin('job_1', printer())
+    tracer.span('job_1', 'ticket', 0, 1)
+    tracer.finish('job_1', 'done')
+
+
+def test_trace(tmpdir):
+    path = tmpdir.join('trace.jsonl')
+    tracer = tracing.Tracer(str(path))
+
+    tracer.notified(['p'])
+    fetch = tracer.fetched('p', 100.0)
+    tracer.begin('job_1', printer(), fetch)
+    tracer.span('job_1', 'submit', fetch[2], fetch[2] + 1, cups_job_id=7)
+    tracer.finish('job_1', 'done')
+
+    [trace] = traces(path)
+    assert len(trace['trace_id']) == 32
+    assert trace['job_id'] == 'job_1'
+    assert trace['printer'] == 'printer'
+    assert trace['outcome'] == 'done'
+    assert trace['start'] == 100.0
+    assert [s['name'] for s in trace['spans']] == [
+        'fetch', 'notification', 'submit',
+    ]
+    assert trace['spans'][0]['start'] == 0
+    assert trace['spans'][2]['duration'] == 1
+    assert trace['spans'][2]['cups_job_id'] == 7
+
+
+def test_notification_used_once(tmpdir):
+    tracer = tracing.Tracer(str(tmpdir.join('trace.jsonl')))
+
+    tracer.notified(['p'])
+    assert tracer.fetched('p', 0)[0] is not None
+    assert tracer.fetched('p', 0)[0] is None
+
+
+def test_unsampled(tmpdir):
+    path = tmpdir.join('trace.jsonl')
+    tracer = tracing.Tracer(str(path), sample_rate=0)
+
+    tracer.begin('job_1', printer())
+    tracer.finish('job_1', 'done')
+
+    assert path.read() == ''
+
+
+def test_slow_written_unsampled(tmpdir):
+    path = tmpdir.join('trace.jsonl')
+    tracer = tracing.Tracer(str(path), sample_rate=0, slow=5)
+
+    tracer.begin('fast', printer())
+    tracer.finish('fast', 'done')
+    tracer.begin('slow', printer(), (None, 0.0, 1.0))
+    tracer.finish('slow', 'done')
+
+    assert [t['job_id'] for t in traces(path)] == ['slow']
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+import base64
+import os
+from xml.etree.ElementTree import XMLParser
+
+import mock
+import pytest
+
+from cloudprint import xmpp
+
+STREAM_START = (
+    '<stream:stream from="gmail.com" '
+    'xmlns:stream="http://etherx.jabber.org/streams" '
+    'xmlns="jabber:client">'
+)
+
+
+def push(printer_id):
+    return (
+        '<message from="cloudprint.google.com" to="me@example.com">'
+        '<push:push channel="cloudprint.google.com" xmlns:push="google:push">'
+        '<push:recipient to="me@example.com"></push:recipient>'
+        '<push:data>%s</push:data>'
+        '</push:push>'
+        '</message>'
+    ) % base64.b64encode(printer_id.encode('utf-8')).decode('ascii')
+
+
+def connection(*stanzas):
+    conn = xmpp.XmppConnection()
+    conn._handler = xmpp.XmppXmlHandler()
+    conn._xmlparser = XMLParser(target=conn._handler)
+    conn._xmlparser.feed(STREAM_START)
+    for stanza in stanzas:
+        conn._xmlparser.feed(stanza)
+    return conn
+
+
+def test_parse_push():
+    conn = connection(push('printer-1'))
+    assert xmpp.parse_push(conn._handler.get_elem()) == 'printer-1'
+
+
+def test_parse_push_not_push():
+    conn = connection('<iq type="result" id="1"/>')
+    assert xmpp.parse_push(conn._handler.get_elem()) is None
+
+
+def test_notified_printers():
+    conn = connection(push('printer-1'), push('printer-2'), push('printer-1'))
+
+    assert conn._check_for_notification()
+    assert conn.pop_notified_printers() == set(['printer-1', 'printer-2'])
+    assert not conn._check_for_notification()
+    assert conn.pop_notified_printers() == set()
+
+
+def test_undecodable_notification_sweeps():
+    conn = connection(
+        push('printer-1'),
+        '<message><push:push xmlns:push="google:push">'
+        '<push:data>!!!</push:data></push:push></message>',
+    )
+
+    assert conn._check_for_notification()
+    assert conn.pop_notified_printers() is None
+
+
+class FakeSocket(object):
+    """Hands out the given chunks, one per recv_into call"""
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, buf):
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def pending(self):
+        return len(self.chunks) > 1
+
+
+def test_read_socket_split_utf8():
+    message = push('printer-1').replace('to="me@', 'to="mé@')
+    message = message.encode('utf-8')
+    split = message.index(b'\xc3') + 1
+
+    conn = connection()
+    conn._wrappedsock = FakeSocket(message[:split], message[split:])
+    conn._read_socket()
+    assert not conn._check_for_notification()
+    conn._read_socket()
+
+    assert conn._check_for_notification()
+    assert conn.pop_notified_printers() == set(['printer-1'])
+
+
+def test_read_socket_feeds_bytes():
+    fed = []
+    conn = connection()
+    conn._xmlparser = mock.Mock(name='parser')
+    conn._xmlparser.feed.side_effect = fed.append
+    conn._wrappedsock = FakeSocket(push('1').encode('utf-8'))
+
+    conn._read_socket()
+
+    # python 2's pyexpat rejects anything but a string
+    assert [type(data) for data in fed] == [bytes]
+    assert fed[0] == push('1').encode('utf-8')
+
+
+def test_read_socket_drains_tls_buffer():
+    conn = connection()
+    conn._wrappedsock = FakeSocket(push('1'), push('2'), push('3'))
+    conn._wrappedsock.chunks = [
+        c.encode('utf-8') for c in conn._wrappedsock.chunks
+    ]
+
+    conn._read_socket()
+
+    assert conn._check_for_notification()
+    assert conn.pop_notified_printers() == set(['1', '2'])
+
+
+def test_stanzas_are_detached():
+    conn = connection(push('printer-1'), ' ', push('printer-2'))
+
+    assert conn._handler._builder is None
+    assert conn._check_for_notification()
+    assert not conn._handler._results
+
+
+@pytest.mark.skipif(
+    not os.environ.get('CLOUDPRINT_SOAK'),
+    reason='set CLOUDPRINT_SOAK=1 to run the soak test',
+)
+def test_soak_memory_flat():
+    resource = pytest.importorskip('resource')
+
+    conn = connection()
+    batch = (push('printer-1') * 1000).encode('utf-8')
+
+    for i in range(1000):
+        conn._xmlparser.feed(batch)
+        conn._check_for_notification()
+        if i == 100:
+            # let allocator pools and caches warm up first
+            warm_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is kilobytes on Linux and bytes on OS X; either way a leak
+    # of a million stanzas is far more than this
+    assert rss - warm_rss < 5 * 1024
+    assert conn.pop_notified_printers() == set(['printer-1'])
+
+
+def test_await_notifications_several():
+    import socket
+
+    pairs = [socket.socketpair() for _ in range(3)]
+    conns = []
+    for ours, theirs in pairs:
+        conn = connection()
+        conn._wrappedsock = ours
+        conn._connected = True
+        conns.append(conn)
+    try:
+        pairs[1][1].sendall(push('printer-1').encode('utf-8'))
+
+        assert xmpp.await_notifications(conns, 5) == [conns[1]]
+        assert conns[1].pop_notified_printers() == set(['printer-1'])
+        assert xmpp.await_notifications(conns, 0.05) == []
+
+        # a connection dropping doesn't take the others with it
+        pairs[0][1].close()
+        pairs[2][1].sendall(push('printer-2').encode('utf-8'))
+        assert xmpp.await_notifications(conns, 5) == [conns[2]]
+        assert not conns[0].is_connected()
+        assert conns[2].is_connected()
+    finally:
+        for ours, theirs in pairs:
+            ours.close()
+            theirs.close()
+
+
+def test_await_woken():
+    import socket
+    import time
+
+    ours, theirs = socket.socketpair()
+    wake_r, wake_w = socket.socketpair()
+    conn = connection()
+    conn._wrappedsock = ours
+    conn._connected = True
+    try:
+        wake_w.sendall(b'x')
+        start = time.time()
+        assert not conn.await_notification(5, [wake_r])
+        assert xmpp.await_notifications([conn], 5, [wake_r]) == []
+        assert time.time() - start < 1
+        assert conn.is_connected()
+    finally:
+        for sock in (ours, theirs, wake_r, wake_w):
+            sock.close()
+
+
+@pytest.mark.skipif(
+    not any(
+        os.access(os.path.join(d, 'openssl'), os.X_OK)
+        for d in os.environ.get('PATH', '').split(os.pathsep)
+    ),
+    reason='needs openssl to make a certificate',
+)
+def test_fake_server_handshake():
+    from cloudprint import fakexmpp
+
+    class Auth(object):
+        xmpp_jid = 'proxy@example.com'
+        access_token = 'token'
+
+    with fakexmpp.FakeXmppServer(tokens=['token']) as server:
+        conn = xmpp.XmppConnection()
+        conn.connect(server.address[0], server.address[1], Auth())
+        assert server.wait_for_subscribers(1, 5)
+
+        server.push('printer-1')
+        assert conn.await_notification(5)
+        assert conn.pop_notified_printers() == set(['printer-1'])
+
+        server.drop_connections()
+        with pytest.raises(Exception):
+            conn.await_notification(5)
+        assert not conn.is_connected()